@@ -0,0 +1,286 @@
+"""
+gating_adaptive.py
+
+This module contains the adaptive gating mode of the gating experiment and a simulator of the session time it saves.
+
+In the standard mode every gate of every item is presented. Once a participant has identified an item consistently,
+its remaining later gates add little information, so the adaptive mode skips them:
+
+    - For every item (speaker, name and condition) the accuracy of the participant is modelled with a Beta posterior,
+      starting from a uniform prior and updated after every response to the item.
+    - An upcoming trial of an item is skipped if the posterior probability that the participant identifies the item
+      above chance level exceeds the threshold, and its gate is later than the earliest gate at which the item was
+      identified correctly. Earlier gates are still presented, because they decide the isolation point.
+    - The randomized order is kept: a trial is only skipped if the trial after it may follow the last presented trial
+      under the sequencing constraints of the randomization (see may_follow() in gating_randomization.py), so the
+      speaker blocks, the gate 7 stimuli at the end of every block and the run limits stay intact.
+
+Skipped trials have no row in the results file; the trial numbers keep counting them, so the results can be matched
+with the randomization list and an interrupted session can be resumed. In the analysis (gating_analysis.py) the skipped
+gates count as not presented.
+
+The simulator runs simulated test sessions with the randomization of the experiment and a participant model in which
+every item is identified from a random gate on, and reports the number of presented trials, the session time and the
+change of the isolation points with the adaptive mode for a range of thresholds.
+
+Usage:
+    python gating_adaptive.py stimuli/gated/test --sessions 200 --thresholds 0.8 0.9 0.95
+
+Functions:
+    - beta_tail: Returns the probability that a Beta distributed accuracy is above a criterion.
+    - simulate_savings: Simulates sessions with and without the adaptive mode.
+
+Classes:
+    - AdaptiveGating: Decides which trials of a phase are skipped.
+"""
+
+import os
+import csv
+import math
+import random
+import argparse
+from collections import defaultdict
+import numpy as np
+
+if __name__ == '__main__':
+    # The simulator needs no display or audio hardware
+    os.environ.setdefault('GATING_BACKEND', 'simulated')
+
+from gating_randomization import randomize_stimuli, may_follow, advance_state, INITIAL_STATE
+from gating_analysis import isolation_points, GATES
+from gating_timeline import FIXATION_DURATION, POST_SOUND_DURATION, POST_RESPONSE_DURATION
+
+# Probability of identifying an item from a gate on, in the participant model of the simulator ('None': never)
+ISOLATION_GATE_PROBABILITIES = {2: 0.15, 3: 0.2, 4: 0.25, 5: 0.2, 7: 0.15, None: 0.05}
+IDENTIFIED_ACCURACY = 0.95
+CHANCE_ACCURACY = 0.5
+
+
+def _item(stimulus):
+    """Return the item of a stimulus: its speaker, name and condition."""
+    return stimulus['speaker'], stimulus['name_stim'], stimulus['condition']
+
+
+def beta_tail(correct, incorrect, criterion, prior=(1, 1)):
+    """
+    Return the posterior probability that the accuracy is above a criterion, for a Beta prior with integer parameters.
+
+    Uses the identity P(p > x) = P(Binomial(a + b - 1, x) < a) for p ~ Beta(a, b), so no special functions are needed.
+
+    Parameters:
+    correct (int): The number of correct responses.
+    incorrect (int): The number of incorrect responses.
+    criterion (float): The accuracy criterion, e.g. 0.5 for chance level.
+    prior (tuple of int, optional): The (a, b) parameters of the prior. Defaults to the uniform prior (1, 1).
+
+    Returns:
+    float: The posterior probability.
+    """
+    a, b = prior[0] + correct, prior[1] + incorrect
+    n = a + b - 1
+    return sum(math.comb(n, j) * criterion ** j * (1 - criterion) ** (n - j) for j in range(a))
+
+
+class AdaptiveGating:
+    """
+    Decides which trials of a phase are skipped, from the responses given so far.
+
+    Parameters:
+    threshold (float, optional): The posterior probability above which the later gates of an item are skipped.
+        Defaults to 0.9.
+    criterion (float, optional): The accuracy that counts as identified. Defaults to 0.5 (above chance).
+    """
+
+    def __init__(self, threshold=0.9, criterion=CHANCE_ACCURACY):
+        self.threshold = threshold
+        self.criterion = criterion
+        self.presented = 0
+        self.skipped = defaultdict(int)  # gate -> number of skipped trials
+        self._responses = defaultdict(lambda: [0, 0])  # item -> [correct, incorrect]
+        self._earliest_correct = {}  # item -> earliest gate answered correctly
+        self._state = INITIAL_STATE
+        self._speaker = None
+
+    def confidence(self, stimulus):
+        """Return the posterior probability that the participant identifies the item of a stimulus."""
+        correct, incorrect = self._responses[_item(stimulus)]
+        return beta_tail(correct, incorrect, self.criterion)
+
+    def _may_follow(self, stimulus):
+        """Check whether a stimulus may directly follow the last presented trial."""
+        return stimulus['speaker'] != self._speaker or may_follow(self._state, stimulus)
+
+    def skip(self, stimulus, next_stimulus=None):
+        """
+        Decide whether a trial is skipped. Skipped trials are counted.
+
+        Parameters:
+        stimulus (dict): The stimulus data of the trial.
+        next_stimulus (dict, optional): The stimulus data of the following trial, None for the last trial.
+
+        Returns:
+        bool: True if the trial is skipped.
+        """
+        earliest_correct = self._earliest_correct.get(_item(stimulus))
+        if (earliest_correct is None or int(stimulus['gate']) <= earliest_correct
+                or self.confidence(stimulus) < self.threshold
+                or (next_stimulus is not None and not self._may_follow(next_stimulus))):
+            return False
+        self.skipped[int(stimulus['gate'])] += 1
+        return True
+
+    def record(self, stimulus, accuracy):
+        """
+        Record the response to a presented trial.
+
+        Parameters:
+        stimulus (dict): The stimulus data of the trial.
+        accuracy (int): 1 if the response was correct, 0 otherwise.
+        """
+        item = _item(stimulus)
+        self._responses[item][0 if accuracy else 1] += 1
+        if accuracy:
+            self._earliest_correct[item] = min(self._earliest_correct.get(item, 8), int(stimulus['gate']))
+        if stimulus['speaker'] != self._speaker:
+            self._state, self._speaker = INITIAL_STATE, stimulus['speaker']
+        self._state = advance_state(self._state, stimulus)
+        self.presented += 1
+
+    def replay(self, output_filename, stimulus_data):
+        """
+        Record the responses of a results file again, e.g. when an interrupted phase is resumed.
+
+        Parameters:
+        output_filename (str): The path of the results CSV file.
+        stimulus_data (callable): Returns the stimulus data of a stimulus filename.
+        """
+        with open(output_filename, newline='') as results_file:
+            for row in csv.DictReader(results_file):
+                self.record(stimulus_data(row['stimulus']), int(row['accuracy']))
+
+    def metrics(self):
+        """
+        Return the counters of the adaptive mode.
+
+        Returns:
+        dict: The number of presented and skipped trials, the skipped trials by gate and the threshold.
+        """
+        return {'presented': self.presented, 'skipped': sum(self.skipped.values()),
+                'skipped_by_gate': {str(gate): count for gate, count in sorted(self.skipped.items())},
+                'threshold': self.threshold}
+
+
+def _trial_time(duration, rng):
+    """The duration of a trial with a stimulus of the given duration and a log-normal response time."""
+    return FIXATION_DURATION + duration + POST_SOUND_DURATION + 0.8 * math.exp(rng.gauss(0, 0.35)) + \
+        POST_RESPONSE_DURATION
+
+
+def _isolation_gates(order, rng):
+    """Draw the gate from which the simulated participant identifies every item."""
+    gates, weights = zip(*ISOLATION_GATE_PROBABILITIES.items())
+    items = {_item(stimulus) for stimulus in order}
+    return {item: rng.choices(gates, weights)[0] for item in sorted(items)}
+
+
+def _isolation_points(items, responses):
+    """The isolation gate of every item (NaN if not isolated) from the responses (item -> gate -> accuracy)."""
+    accuracy = np.full((1, len(items), len(GATES)), np.nan)
+    for item_index, item in enumerate(items):
+        for gate, correct in responses[item].items():
+            accuracy[0, item_index, gate - 1] = correct
+    return isolation_points(accuracy)[0]
+
+
+def simulate_savings(stimulus_data, thresholds=(0.8, 0.9, 0.95), sessions=100, seed=None):
+    """
+    Simulate test sessions with and without the adaptive mode.
+
+    Every session is randomized like in the experiment, and the simulated participant identifies every item from a
+    random gate on (see ISOLATION_GATE_PROBABILITIES): from that gate on the responses are correct with a probability
+    of 0.95, before it with chance probability. The same responses are used with and without the adaptive mode, so
+    the isolation points can be compared.
+
+    Parameters:
+    stimulus_data (list): The stimulus data of the test stimuli (e.g. the records of a stimulus manifest), with
+        'filename', 'speaker', 'gate', 'name_stim', 'condition' and 'duration'.
+    thresholds (tuple of float, optional): The thresholds of the adaptive mode to simulate.
+    sessions (int, optional): The number of simulated sessions. Defaults to 100.
+    seed (int, optional): The seed of the simulation.
+
+    Returns:
+    list of dict: Per threshold: the mean number of presented trials, the mean session time in minutes with and
+    without the adaptive mode, the fraction of time saved and the mean absolute change of the isolation points
+    (in gates) and of the number of isolated items.
+    """
+    rng = random.Random(seed)
+    by_filename = {data['filename']: data for data in stimulus_data}
+    totals = {threshold: defaultdict(float) for threshold in thresholds}
+
+    for _ in range(sessions):
+        order = [by_filename[f] for f in randomize_stimuli(list(by_filename), rng=rng)]
+        isolation_gates = _isolation_gates(order, rng)
+        responses = []
+        for stimulus in order:
+            isolation_gate = isolation_gates[_item(stimulus)]
+            identified = isolation_gate is not None and int(stimulus['gate']) >= isolation_gate
+            p_correct = IDENTIFIED_ACCURACY if identified else CHANCE_ACCURACY
+            responses.append((int(rng.random() < p_correct), _trial_time(stimulus['duration'], rng)))
+
+        items = sorted(isolation_gates)
+        full = defaultdict(dict)
+        for stimulus, (correct, _) in zip(order, responses):
+            full[_item(stimulus)][int(stimulus['gate'])] = correct
+        full_points = _isolation_points(items, full)
+        full_time = sum(seconds for _, seconds in responses)
+
+        for threshold in thresholds:
+            adaptive = AdaptiveGating(threshold)
+            presented = defaultdict(dict)
+            session_time = 0.0
+            for index, (stimulus, (correct, seconds)) in enumerate(zip(order, responses)):
+                if adaptive.skip(stimulus, order[index + 1] if index + 1 < len(order) else None):
+                    continue
+                adaptive.record(stimulus, correct)
+                presented[_item(stimulus)][int(stimulus['gate'])] = correct
+                session_time += seconds
+            points = _isolation_points(items, presented)
+
+            total = totals[threshold]
+            total['trials'] += adaptive.presented
+            total['full_time'] += full_time
+            total['adaptive_time'] += session_time
+            both = ~np.isnan(full_points) & ~np.isnan(points)
+            total['point_change'] += float(np.abs(points[both] - full_points[both]).mean()) if both.any() else 0.0
+            total['isolated_change'] += int((~np.isnan(points)).sum() - (~np.isnan(full_points)).sum())
+
+    return [{'threshold': threshold,
+             'trials': total['trials'] / sessions,
+             'full_minutes': total['full_time'] / sessions / 60,
+             'adaptive_minutes': total['adaptive_time'] / sessions / 60,
+             'time_saved': 1 - total['adaptive_time'] / total['full_time'],
+             'isolation_point_change': total['point_change'] / sessions,
+             'isolated_items_change': total['isolated_change'] / sessions}
+            for threshold, total in totals.items()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the session time saved by the adaptive gating mode.')
+    parser.add_argument('stimuli_path', help='test stimulus folder')
+    parser.add_argument('--sessions', type=int, default=100, help='number of simulated sessions')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.8, 0.9, 0.95], help='thresholds to simulate')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the simulation')
+    args = parser.parse_args()
+
+    from gating_manifest import load_manifest
+    from gating_stimulus_bank import open_stimulus_source
+    manifest = load_manifest(args.stimuli_path, open_stimulus_source(args.stimuli_path))
+    simulation = simulate_savings(list(manifest), args.thresholds, args.sessions, args.seed)
+
+    print(f"{len(manifest)} stimuli, {args.sessions} simulated sessions")
+    print(f"{'threshold':>10}{'trials':>10}{'minutes':>10}{'full min':>10}{'saved':>10}{'IP change':>12}"
+          f"{'isolated':>10}")
+    for row in simulation:
+        print(f"{row['threshold']:>10.2f}{row['trials']:>10.1f}{row['adaptive_minutes']:>10.1f}"
+              f"{row['full_minutes']:>10.1f}{row['time_saved']:>10.1%}{row['isolation_point_change']:>12.2f}"
+              f"{row['isolated_items_change']:>+10.2f}")
@@ -0,0 +1,244 @@
+"""
+gating_aggregate.py
+
+This module aggregates the results of all participants into one columnar store and summarizes them.
+
+The results of a session are spread over timestamped CSV files per subject and phase
+('results/<subject>/<phase>_<experiment>_<subject>_<timestamp>.csv'). Instead of parsing all of them for every
+analysis, the aggregation ingests each CSV file once into a typed NPZ chunk in 'results/aggregate/'. An index records
+the modification time, size and SHA-256 hash of every ingested file; on the next run only new files and files whose
+content changed (e.g. a resumed session) are parsed again, and the chunks of removed files are dropped. The chunks are
+combined into 'results/aggregate/results.npz', which is rebuilt only when a chunk changed.
+
+Columns:
+    - subject, phase, stimulus, item, response, speaker, name_stim, condition: strings, returned as categories (an
+      int32 code array and the array of category values);
+    - trial, block, gate, accuracy: integers;
+    - reaction_time: float64 seconds.
+
+The summaries (accuracy and reaction time by gate, condition, speaker, item or any combination) are computed with
+numpy bincounts over the group codes, without a loop over the rows.
+
+Usage:
+    python gating_aggregate.py
+    python gating_aggregate.py --by gate condition --by speaker --phase test
+
+Functions:
+    - update_store: Ingests new and changed results files and returns the combined table.
+    - summarize: Computes the accuracy and reaction time by group.
+    - save_summary: Writes a summary to a CSV file.
+"""
+
+import os
+import re
+import csv
+import json
+import hashlib
+import argparse
+import numpy as np
+
+AGGREGATE_DIRECTORY = 'aggregate'
+INDEX_FILENAME = 'index.json'
+STORE_FILENAME = 'results.npz'
+
+STRING_COLUMNS = ('subject', 'phase', 'stimulus', 'item', 'response', 'speaker', 'name_stim', 'condition')
+INT_COLUMNS = {'trial': np.int32, 'block': np.int16, 'gate': np.int8, 'accuracy': np.int8}
+FLOAT_COLUMNS = ('reaction_time',)
+
+_RESULTS_FILENAME = re.compile(r'^(practice|test)_.+_\d{8}_\d{6}\.csv$')
+
+
+def _file_hash(filepath):
+    """Return the SHA-256 hash of a file."""
+    with open(filepath, 'rb') as results_file:
+        return hashlib.sha256(results_file.read()).hexdigest()
+
+
+def _list_results_files(results_path):
+    """Return the paths of all results CSV files, relative to the results folder."""
+    results_files = []
+    for subject in sorted(os.listdir(results_path)):
+        subject_path = os.path.join(results_path, subject)
+        if subject == AGGREGATE_DIRECTORY or not os.path.isdir(subject_path):
+            continue
+        results_files.extend(os.path.join(subject, f) for f in sorted(os.listdir(subject_path))
+                             if _RESULTS_FILENAME.match(f))
+    return results_files
+
+
+def _read_results_file(filepath):
+    """Parse a results CSV file into typed column arrays."""
+    with open(filepath, newline='') as results_file:
+        rows = list(csv.DictReader(results_file))
+
+    columns = {'subject': np.array([row['subjectID'] for row in rows], dtype=str),
+               'item': np.array([row['stimulus'].rsplit('_g', 1)[0] for row in rows], dtype=str)}
+    for column in STRING_COLUMNS:
+        if column not in columns:
+            columns[column] = np.array([row[column] for row in rows], dtype=str)
+    for column, dtype in INT_COLUMNS.items():
+        columns[column] = np.array([int(row[column]) for row in rows], dtype=dtype)
+    for column in FLOAT_COLUMNS:
+        columns[column] = np.array([float(row[column]) if row[column] else np.nan for row in rows])
+    return columns
+
+
+def _combine(chunks):
+    """Concatenate chunks and convert the string columns into categories."""
+    table = {}
+    for column in STRING_COLUMNS:
+        values = np.concatenate([chunk[column] for chunk in chunks]) if chunks else np.array([], dtype=str)
+        categories, codes = np.unique(values, return_inverse=True)
+        table[column] = codes.astype(np.int32)
+        table[f"{column}_categories"] = categories
+    for column in list(INT_COLUMNS) + list(FLOAT_COLUMNS):
+        table[column] = np.concatenate([chunk[column] for chunk in chunks]) if chunks else np.array([])
+    return table
+
+
+def update_store(results_path='results'):
+    """
+    Ingest new and changed results files into the columnar store and return the combined table.
+
+    Parameters:
+    results_path (str, optional): The results folder. Defaults to 'results'.
+
+    Returns:
+    dict: Column -> numpy array. A string column holds category codes; its values are in '<column>_categories'.
+    """
+    aggregate_path = os.path.join(results_path, AGGREGATE_DIRECTORY)
+    os.makedirs(aggregate_path, exist_ok=True)
+    index_path = os.path.join(aggregate_path, INDEX_FILENAME)
+    store_path = os.path.join(aggregate_path, STORE_FILENAME)
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+
+    changed = False
+    new_index = {}
+    for results_file in _list_results_files(results_path):
+        filepath = os.path.join(results_path, results_file)
+        stat = os.stat(filepath)
+        entry = index.get(results_file)
+        if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            new_index[results_file] = entry
+            continue
+
+        content_hash = _file_hash(filepath)
+        chunk_name = f"{content_hash[:16]}.npz"
+        if (entry is None or entry['sha256'] != content_hash
+                or not os.path.exists(os.path.join(aggregate_path, chunk_name))):
+            try:
+                np.savez(os.path.join(aggregate_path, chunk_name), **_read_results_file(filepath))
+            except (KeyError, ValueError) as error:
+                print(f"Warning: {filepath} could not be read and is left out: {error}")
+                continue
+            changed = True
+        new_index[results_file] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': content_hash,
+                                   'chunk': chunk_name}
+
+    # Drop the chunks of removed or changed files
+    used_chunks = {entry['chunk'] for entry in new_index.values()}
+    for results_file, entry in index.items():
+        if entry['chunk'] not in used_chunks:
+            changed = True
+            if os.path.exists(os.path.join(aggregate_path, entry['chunk'])):
+                os.remove(os.path.join(aggregate_path, entry['chunk']))
+
+    if changed or not os.path.exists(store_path):
+        chunks = []
+        for entry in new_index.values():
+            with np.load(os.path.join(aggregate_path, entry['chunk'])) as chunk:
+                chunks.append(dict(chunk))
+        table = _combine(chunks)
+        np.savez(store_path, **table)
+    else:
+        with np.load(store_path) as store:
+            table = dict(store)
+
+    with open(index_path + '.tmp', 'w') as index_file:
+        json.dump(new_index, index_file, indent=1)
+    os.replace(index_path + '.tmp', index_path)
+    return table
+
+
+def summarize(table, by, phase='test'):
+    """
+    Compute the accuracy and reaction time by group.
+
+    Parameters:
+    table (dict): The table returned by update_store().
+    by (list of str): The columns to group by, e.g. ['gate', 'condition'].
+    phase (str, optional): Only rows of this phase are summarized; None for all. Defaults to 'test'.
+
+    Returns:
+    list of dict: One row per group with the group values, 'n', 'accuracy', 'rt_mean' and 'rt_sd' (seconds).
+    """
+    rows = np.ones(len(table['trial']), dtype=bool)
+    if phase is not None:
+        phase_codes = np.flatnonzero(table['phase_categories'] == phase)
+        rows = np.isin(table['phase'], phase_codes)
+
+    keys = np.stack([table[column][rows].astype(np.int64) for column in by], axis=1) if by else \
+        np.zeros((rows.sum(), 1), dtype=np.int64)
+    groups, group_codes = np.unique(keys, axis=0, return_inverse=True)
+    group_codes = group_codes.ravel()
+
+    n = np.bincount(group_codes, minlength=len(groups))
+    accuracy = np.bincount(group_codes, weights=table['accuracy'][rows], minlength=len(groups)) / np.maximum(n, 1)
+    rt = table['reaction_time'][rows]
+    valid = ~np.isnan(rt)
+    rt_n = np.bincount(group_codes[valid], minlength=len(groups))
+    rt_sum = np.bincount(group_codes[valid], weights=rt[valid], minlength=len(groups))
+    rt_squares = np.bincount(group_codes[valid], weights=rt[valid] ** 2, minlength=len(groups))
+    rt_mean = rt_sum / np.maximum(rt_n, 1)
+    rt_sd = np.sqrt(np.maximum(rt_squares / np.maximum(rt_n, 1) - rt_mean ** 2, 0))
+
+    summary = []
+    for group_index, group in enumerate(groups):
+        row = {}
+        for column, value in zip(by, group):
+            categories = table.get(f"{column}_categories")
+            row[column] = categories[value] if categories is not None else int(value)
+        row.update(n=int(n[group_index]), accuracy=float(accuracy[group_index]), rt_mean=float(rt_mean[group_index]),
+                   rt_sd=float(rt_sd[group_index]))
+        summary.append(row)
+    return summary
+
+
+def save_summary(summary, filepath):
+    """
+    Write a summary to a CSV file.
+
+    Parameters:
+    summary (list of dict): The summary returned by summarize().
+    filepath (str): The path of the CSV file.
+    """
+    with open(filepath, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(summary[0]) if summary else ['n'])
+        writer.writeheader()
+        writer.writerows(summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate and summarize the results of all participants.')
+    parser.add_argument('--results', default='results', help='results folder')
+    parser.add_argument('--by', nargs='+', action='append', default=None,
+                        help='columns to group by; can be given several times')
+    parser.add_argument('--phase', default='test', help="phase to summarize ('all' for all phases)")
+    args = parser.parse_args()
+
+    results_table = update_store(args.results)
+    groupings = args.by or [['gate'], ['condition'], ['gate', 'condition'], ['speaker'], ['item']]
+    print(f"{len(results_table['trial'])} trials of {len(results_table['subject_categories'])} subjects")
+    for grouping in groupings:
+        group_summary = summarize(results_table, grouping, None if args.phase == 'all' else args.phase)
+        summary_path = os.path.join(args.results, AGGREGATE_DIRECTORY, f"summary_by_{'_'.join(grouping)}.csv")
+        save_summary(group_summary, summary_path)
+        print(f"\nBy {', '.join(grouping)} ({summary_path}):")
+        for summary_row in group_summary:
+            group_label = ', '.join(str(summary_row[column]) for column in grouping)
+            print(f"  {group_label:<40} n={summary_row['n']:<6} accuracy={summary_row['accuracy']:.3f} "
+                  f"rt={summary_row['rt_mean']:.3f}±{summary_row['rt_sd']:.3f} s")
@@ -0,0 +1,241 @@
+"""
+gating_analysis.py
+
+This module computes the main analysis of the gating study from the aggregated results (see gating_aggregate.py):
+
+    - Identification curves: the proportion of correct responses at every gate, for each condition and overall.
+    - Isolation points: for every subject and item, the earliest gate from which on all presented gates of the item
+      were identified correctly; averaged over the subjects per item and condition. Items a subject never identified
+      correctly up to the last gate have no isolation point and are counted as not isolated.
+
+The trials of all subjects are arranged into one array of accuracies by subject, item and gate (NaN where a gate was
+not presented), so the curves and isolation points of all subjects are computed at once with numpy broadcasting; the
+isolation points use a reverse cumulative AND along the gate axis.
+
+Confidence intervals are computed by bootstrapping the subjects: the subjects are resampled with replacement and the
+curves and mean isolation points are recomputed for every resample. The resamples are split into chunks that run in
+a process pool, each with its own seed derived from the seed of the analysis, so the result doesn't depend on the
+number of processes. The 2.5 and 97.5 percentiles of the resamples give the 95 % interval.
+
+Usage:
+    python gating_analysis.py --resamples 10000 --seed 1
+
+Functions:
+    - accuracy_array: Arranges the trials into an array of accuracies by subject, item and gate.
+    - identification_curves: Computes the proportion correct by gate per subject.
+    - isolation_points: Computes the isolation gate per subject and item.
+    - bootstrap: Computes bootstrap confidence intervals of the curves and isolation points.
+    - analyze: Runs the whole analysis and saves the tables.
+"""
+
+import os
+import csv
+import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gating_aggregate import update_store, AGGREGATE_DIRECTORY
+
+GATES = np.arange(1, 8)
+
+
+def accuracy_array(table, phase='test'):
+    """
+    Arrange the trials into an array of accuracies by subject, item and gate.
+
+    Parameters:
+    table (dict): The table returned by gating_aggregate.update_store().
+    phase (str, optional): The phase to analyze. Defaults to 'test'.
+
+    Returns:
+    numpy.ndarray: Accuracies (1.0, 0.0 or NaN if not presented), shape (subjects, items, 7).
+    numpy.ndarray: The subject IDs.
+    numpy.ndarray: The items.
+    numpy.ndarray: The condition of every item.
+    """
+    rows = table['phase'] == np.flatnonzero(table['phase_categories'] == phase)[0] \
+        if phase in table['phase_categories'] else np.zeros(len(table['phase']), dtype=bool)
+    subject_codes, subjects = np.unique(table['subject'][rows], return_inverse=True)
+    item_codes, items = np.unique(table['item'][rows], return_inverse=True)
+
+    accuracy = np.full((len(subject_codes), len(item_codes), len(GATES)), np.nan)
+    accuracy[subjects.ravel(), items.ravel(), table['gate'][rows].astype(np.int64) - 1] = table['accuracy'][rows]
+
+    # The condition of an item is the same in all of its trials
+    item_conditions = np.empty(len(item_codes), dtype=np.int64)
+    item_conditions[items.ravel()] = table['condition'][rows]
+    return (accuracy, table['subject_categories'][subject_codes], table['item_categories'][item_codes],
+            table['condition_categories'][item_conditions])
+
+
+def identification_curves(accuracy, item_mask=None):
+    """
+    Compute the proportion of correct responses by gate for every subject.
+
+    Parameters:
+    accuracy (numpy.ndarray): The array of accuracy_array(), shape (subjects, items, 7).
+    item_mask (numpy.ndarray, optional): Boolean mask of the items to include, e.g. those of one condition.
+
+    Returns:
+    numpy.ndarray: Proportion correct, shape (subjects, 7); NaN for gates that were not presented.
+    """
+    if item_mask is not None:
+        accuracy = accuracy[:, item_mask]
+    presented = ~np.isnan(accuracy)
+    with np.errstate(invalid='ignore'):
+        return np.nansum(accuracy, axis=1) / presented.sum(axis=1)
+
+
+def isolation_points(accuracy):
+    """
+    Compute the isolation point of every subject and item: the earliest presented gate from which on all presented
+    gates were identified correctly.
+
+    Parameters:
+    accuracy (numpy.ndarray): The array of accuracy_array(), shape (subjects, items, 7).
+
+    Returns:
+    numpy.ndarray: The isolation gate, shape (subjects, items); NaN if the item was not isolated or not presented.
+    """
+    presented = ~np.isnan(accuracy)
+    # Gates that were not presented don't interrupt a run of correct responses
+    correct = np.where(presented, accuracy == 1, True)
+    correct_from_here = np.logical_and.accumulate(correct[..., ::-1], axis=-1)[..., ::-1] & presented
+    isolated = correct_from_here.any(axis=-1)
+    return np.where(isolated, GATES[np.argmax(correct_from_here, axis=-1)], np.nan)
+
+
+def _summaries(curves_by_condition, points):
+    """The statistics that are bootstrapped: the mean curves and the mean isolation point of every item."""
+    with warnings.catch_warnings():
+        # Means of all-NaN slices (gates that were never presented) are NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        curve_means = {condition: np.nanmean(curves, axis=-2) for condition, curves in curves_by_condition.items()}
+        point_means = np.nanmean(points, axis=-2)
+    return curve_means, point_means
+
+
+def _bootstrap_chunk(curves_by_condition, points, n_resamples, seed_sequence):
+    """Compute the statistics of a chunk of resamples. Runs in a worker process."""
+    rng = np.random.default_rng(seed_sequence)
+    n_subjects = points.shape[0]
+    resampled = rng.integers(0, n_subjects, size=(n_resamples, n_subjects))
+    # Indexing with the (resamples, subjects) array gives all resamples at once
+    return _summaries({condition: curves[resampled] for condition, curves in curves_by_condition.items()},
+                      points[resampled])
+
+
+def bootstrap(curves_by_condition, points, n_resamples=10000, seed=None, workers=None, chunk_size=500):
+    """
+    Compute 95 % bootstrap confidence intervals of the mean curves and mean isolation points by resampling subjects.
+
+    Parameters:
+    curves_by_condition (dict): Condition -> curves of identification_curves(), shape (subjects, 7).
+    points (numpy.ndarray): The isolation points of isolation_points(), shape (subjects, items).
+    n_resamples (int, optional): The number of resamples. Defaults to 10000.
+    seed (int, optional): The seed of the resampling.
+    workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+    chunk_size (int, optional): The number of resamples per task. Defaults to 500.
+
+    Returns:
+    dict: Condition -> (lower, upper) bounds of the curve, each of shape (7,).
+    tuple of numpy.ndarray: The (lower, upper) bounds of the mean isolation point of every item.
+    """
+    chunks = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_bootstrap_chunk, [curves_by_condition] * len(chunks), [points] * len(chunks),
+                                    chunks, seed_sequences))
+
+    with warnings.catch_warnings():
+        # Means of all-NaN slices (gates that were never presented) are NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        curve_intervals = {}
+        for condition in curves_by_condition:
+            resampled_curves = np.concatenate([curve_means[condition] for curve_means, _ in results])
+            curve_intervals[condition] = tuple(np.nanpercentile(resampled_curves, [2.5, 97.5], axis=0))
+        resampled_points = np.concatenate([point_means for _, point_means in results])
+        point_intervals = tuple(np.nanpercentile(resampled_points, [2.5, 97.5], axis=0))
+    return curve_intervals, point_intervals
+
+
+def _write_csv(filepath, fieldnames, rows):
+    with open(filepath, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def analyze(table, output_path, phase='test', n_resamples=10000, seed=None, workers=None):
+    """
+    Compute the identification curves and isolation points with confidence intervals and save them as
+    'identification_curves.csv' and 'isolation_points.csv'.
+
+    Parameters:
+    table (dict): The table returned by gating_aggregate.update_store().
+    output_path (str): The folder the tables are written to.
+    phase (str, optional): The phase to analyze. Defaults to 'test'.
+    n_resamples (int, optional): The number of bootstrap resamples. Defaults to 10000.
+    seed (int, optional): The seed of the bootstrap.
+    workers (int, optional): The number of worker processes.
+
+    Returns:
+    list of dict: The rows of the identification curves.
+    list of dict: The rows of the isolation points.
+    """
+    accuracy, subjects, items, conditions = accuracy_array(table, phase)
+    if len(subjects) == 0:
+        raise ValueError(f"There are no {phase} results to analyze")
+
+    curves_by_condition = {'all': identification_curves(accuracy)}
+    for condition in np.unique(conditions):
+        curves_by_condition[str(condition)] = identification_curves(accuracy, conditions == condition)
+    points = isolation_points(accuracy)
+
+    curve_means, point_means = _summaries(curves_by_condition, points)
+    curve_intervals, point_intervals = bootstrap(curves_by_condition, points, n_resamples, seed, workers)
+
+    curve_rows = []
+    for condition, curves in curves_by_condition.items():
+        for gate_index, gate in enumerate(GATES):
+            n_subjects = int((~np.isnan(curves[:, gate_index])).sum())
+            if n_subjects:
+                curve_rows.append({'condition': condition, 'gate': int(gate), 'n_subjects': n_subjects,
+                                   'proportion_correct': curve_means[condition][gate_index],
+                                   'ci_lower': curve_intervals[condition][0][gate_index],
+                                   'ci_upper': curve_intervals[condition][1][gate_index]})
+
+    presented = ~np.isnan(accuracy).all(axis=-1)
+    point_rows = []
+    for item_index, item in enumerate(items):
+        n_subjects = int(presented[:, item_index].sum())
+        point_rows.append({'item': item, 'condition': conditions[item_index], 'n_subjects': n_subjects,
+                           'n_isolated': int((~np.isnan(points[:, item_index])).sum()),
+                           'isolation_point': point_means[item_index],
+                           'ci_lower': point_intervals[0][item_index], 'ci_upper': point_intervals[1][item_index]})
+
+    os.makedirs(output_path, exist_ok=True)
+    _write_csv(os.path.join(output_path, 'identification_curves.csv'), list(curve_rows[0]), curve_rows)
+    _write_csv(os.path.join(output_path, 'isolation_points.csv'), list(point_rows[0]), point_rows)
+    return curve_rows, point_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute identification curves and isolation points.')
+    parser.add_argument('--results', default='results', help='results folder')
+    parser.add_argument('--phase', default='test', help='phase to analyze')
+    parser.add_argument('--resamples', type=int, default=10000, help='number of bootstrap resamples')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the bootstrap')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    output_folder = os.path.join(args.results, AGGREGATE_DIRECTORY)
+    curve_table, point_table = analyze(update_store(args.results), output_folder, args.phase, args.resamples,
+                                       args.seed, args.workers)
+
+    print("Identification curves (proportion correct [95 % CI]):")
+    for curve_row in curve_table:
+        print(f"  {curve_row['condition']:<5} gate {curve_row['gate']}: {curve_row['proportion_correct']:.3f} "
+              f"[{curve_row['ci_lower']:.3f}, {curve_row['ci_upper']:.3f}]  n={curve_row['n_subjects']}")
+    print(f"Isolation points of {len(point_table)} items saved to {os.path.join(output_folder, 'isolation_points.csv')}")
@@ -0,0 +1,115 @@
+"""
+gating_audio.py
+
+This module contains the low-level audio helpers shared by the stimulus handling modules of the gating experiment.
+
+WAV files are decoded with the standard library 'wave' module and converted to NumPy float32 arrays in the range
+[-1, 1], which is the format PsychoPy's sound.Sound accepts as a value. Only uncompressed PCM files (8, 16, 24 or
+32 bit) are supported, which is what Praat writes for the gated stimuli.
+
+Functions:
+    - read_wav: Decodes a WAV file into a float32 sample array and its sample rate.
+    - write_wav: Writes a sample array to a 16 bit PCM WAV file.
+    - resample: Resamples a sample array to a different sample rate by linear interpolation.
+"""
+
+import wave
+import numpy as np
+
+
+def _pcm_to_float(raw, sample_width, n_channels):
+    """
+    Convert raw little-endian PCM bytes into a float32 array in the range [-1, 1].
+
+    Parameters:
+    raw (bytes): The raw PCM frames as read from the WAV file.
+    sample_width (int): The number of bytes per sample (1, 2, 3 or 4).
+    n_channels (int): The number of interleaved channels.
+
+    Returns:
+    numpy.ndarray: A float32 array of shape (frames,) for mono or (frames, channels) otherwise.
+    """
+    if sample_width == 1:
+        # 8 bit WAV is unsigned
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif sample_width == 2:
+        samples = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768.0
+    elif sample_width == 3:
+        # 24 bit samples are padded into 32 bit integers before conversion
+        bytes_24 = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        padded = np.zeros((bytes_24.shape[0], 4), dtype=np.uint8)
+        padded[:, 1:] = bytes_24
+        samples = padded.view('<i4').reshape(-1).astype(np.float32) / 2147483648.0
+    elif sample_width == 4:
+        samples = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2147483648.0
+    else:
+        raise ValueError(f"Unsupported sample width: {sample_width} bytes")
+
+    if n_channels > 1:
+        samples = samples.reshape(-1, n_channels)
+    return samples
+
+
+def read_wav(filepath):
+    """
+    Decode a WAV file into a float32 sample array.
+
+    Parameters:
+    filepath (str): Path to the WAV file.
+
+    Returns:
+    numpy.ndarray: The samples, shape (frames,) for mono or (frames, channels) otherwise.
+    int: The sample rate of the file in Hz.
+    """
+    with wave.open(filepath, 'rb') as wav_file:
+        n_channels = wav_file.getnchannels()
+        sample_width = wav_file.getsampwidth()
+        sample_rate = wav_file.getframerate()
+        raw = wav_file.readframes(wav_file.getnframes())
+
+    return _pcm_to_float(raw, sample_width, n_channels), sample_rate
+
+
+def write_wav(filepath, samples, sample_rate):
+    """
+    Write a sample array to a 16 bit PCM WAV file, the format Praat uses for the gated stimuli.
+
+    Parameters:
+    filepath (str): Path of the WAV file to write.
+    samples (numpy.ndarray): The samples in the range [-1, 1], shape (frames,) or (frames, channels).
+    sample_rate (int): The sample rate in Hz.
+    """
+    n_channels = 1 if samples.ndim == 1 else samples.shape[1]
+    pcm = np.clip(np.round(np.asarray(samples) * 32768.0), -32768, 32767).astype('<i2')
+
+    with wave.open(filepath, 'wb') as wav_file:
+        wav_file.setnchannels(n_channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+
+
+def resample(samples, source_rate, target_rate):
+    """
+    Resample a sample array to a different sample rate using linear interpolation.
+
+    Parameters:
+    samples (numpy.ndarray): The samples, shape (frames,) or (frames, channels).
+    source_rate (int): The sample rate of the given samples in Hz.
+    target_rate (int): The desired sample rate in Hz.
+
+    Returns:
+    numpy.ndarray: The resampled float32 array (the input itself if the rates already match).
+    """
+    if source_rate == target_rate or len(samples) == 0:
+        return samples
+
+    n_frames = len(samples)
+    n_target = int(round(n_frames * target_rate / source_rate))
+    source_times = np.arange(n_frames) / source_rate
+    target_times = np.arange(n_target) / target_rate
+
+    if samples.ndim == 1:
+        return np.interp(target_times, source_times, samples).astype(np.float32)
+    return np.stack([np.interp(target_times, source_times, samples[:, channel])
+                     for channel in range(samples.shape[1])], axis=1).astype(np.float32)
@@ -0,0 +1,65 @@
+"""
+gating_backend.py
+
+This module selects the backend that provides the window, sound, keyboard, dialog and clock interfaces of the gating
+experiment. All modules of the experiment import these interfaces from here instead of from PsychoPy:
+
+    from gating_backend import visual, sound, core, event, keyboard
+
+The backend is selected by the GATING_BACKEND environment variable, which has to be set before the first module of
+the experiment is imported (gating_experiment.py sets it when it is started with --simulate):
+
+    - 'psychopy' (default): PsychoPy, with the PTB audio library preferred. The sound stack, the slowest part of the
+      import, is only imported when 'sound' is first used, so the participant dialog can open before it is loaded
+      (see gating_startup.py).
+    - 'simulated': the headless simulation of gating_simulation.py, with a virtual clock and a simulated participant.
+      PsychoPy is not needed.
+
+Interfaces:
+    - monitors, visual, gui, core, sound, event, keyboard: The PsychoPy modules of the same names, or their simulated
+      counterparts.
+    - wall_time: Returns the time of day as a time.time() value, advancing with core.getTime().
+    - BACKEND: The name of the selected backend.
+"""
+
+import os
+import time
+
+BACKEND = os.environ.get('GATING_BACKEND', 'psychopy')
+
+if BACKEND == 'simulated':
+    from gating_simulation import monitors, visual, gui, core, sound, event, keyboard
+elif BACKEND == 'psychopy':
+    from psychopy import prefs
+    # Set the audio library preference
+    prefs.hardware['audioLib'] = ['ptb', 'sounddevice', 'pygame', 'pyo']
+    from psychopy import monitors, visual, gui, core, event
+    from psychopy.hardware import keyboard
+else:
+    raise ValueError(f"Unknown backend '{BACKEND}' in GATING_BACKEND - use 'psychopy' or 'simulated'")
+
+# The time of day at which core.getTime() was 0
+_CLOCK_EPOCH = time.time() - core.getTime()
+
+
+def wall_time():
+    """
+    Return the time of day as a time.time() value, advancing with core.getTime().
+
+    With PsychoPy this is the time of day (unaffected by adjustments of the system clock during the session). In a
+    simulated session it advances with the virtual time, so the start and end times of the trials in the results are
+    as far apart as they would be in a real session.
+
+    Returns:
+    float: Seconds since the epoch.
+    """
+    return _CLOCK_EPOCH + core.getTime()
+
+
+def __getattr__(name):
+    """Import PsychoPy's sound stack when 'sound' is first used."""
+    if name == 'sound':
+        global sound
+        from psychopy import sound
+        return sound
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
@@ -0,0 +1,224 @@
+"""
+gating_benchmark.py
+
+This module contains the benchmark suite of the hot paths of the gating experiment.
+
+The suite measures, on synthetic stimulus sets of 240, 2,400 and 24,000 stimuli (4 speakers, 6 names, both conditions
+and the gates 2, 3, 4, 5 and 7, like the test set):
+
+    - get_stimulus_data: parsing the metadata of all stimuli.
+    - constraint_randomization: ordering all stimuli that are not gate 7 with the sequencing constraints.
+    - randomize_stimuli: randomizing the whole set in speaker blocks.
+    - sound.Sound: creating the sound of a stimulus from its samples, as in the trial loop.
+    - TextStim: creating the text stimulus of a message, as show_message() did before the screen cache.
+    - cached screen: getting the text stimulus of a message from the screen cache and drawing it, as in show_message().
+    - append_result_to_csv: writing and fsyncing one result row.
+
+The first three are measured on the whole set, so they show how the randomizer scales with the number of stimuli.
+The last four don't depend on the size of the set; they are measured per call, over BENCHMARK_CALLS calls.
+
+Every benchmark is repeated and the median time is reported. The results can be saved as the baseline of the
+backend ('benchmarks/baseline_<backend>.json'); later runs are compared against it, and benchmarks that became slower
+than the baseline by more than the tolerance are flagged as regressions (the exit code is then 1).
+
+The suite runs on the simulated backend (see gating_backend.py) unless GATING_BACKEND is set, so it needs no display
+or audio hardware; sound.Sound and TextStim then measure the overhead of the simulated interfaces only. Run it with
+GATING_BACKEND=psychopy on the lab machine to measure PsychoPy itself.
+
+Usage:
+    python gating_benchmark.py --save-baseline
+    python gating_benchmark.py
+    python gating_benchmark.py --sizes 240 2400 --repeat 3 --tolerance 0.5
+
+Functions:
+    - synthetic_stimuli: Creates the filenames of a synthetic stimulus set.
+    - run_benchmarks: Runs the benchmarks.
+    - compare_with_baseline: Flags the benchmarks that are slower than the baseline.
+"""
+
+import os
+import csv
+import json
+import random
+import argparse
+import tempfile
+import statistics
+import time
+
+# The benchmarks run headless unless another backend is selected
+os.environ.setdefault('GATING_BACKEND', 'simulated')
+
+import numpy as np
+from gating_backend import BACKEND, visual, sound
+from gating_configuration import append_result_to_csv, sample_rate
+from gating_functions import RESULT_FIELDNAMES
+from gating_instructions import begin
+from gating_screens import screen_cache
+from gating_randomization import get_stimulus_data, constraint_randomization, randomize_stimuli
+
+SIZES = (240, 2400, 24000)
+BENCHMARK_CALLS = 200
+BASELINE_DIRECTORY = 'benchmarks'
+
+_NAMES = ('manni', 'moni_', 'leni_', 'lilli', 'mimmi', 'nelli')
+_GATES = (2, 3, 4, 5, 7)
+_SPEAKERS = ('06', '07', '11', '12')
+
+
+def synthetic_stimuli(n_stimuli):
+    """
+    Create the filenames of a synthetic stimulus set with the structure of the test set.
+
+    Parameters:
+    n_stimuli (int): The number of stimuli, a multiple of 20.
+
+    Returns:
+    list of str: The filenames.
+    """
+    items_per_speaker = n_stimuli // (len(_SPEAKERS) * len(_GATES))
+    stimuli_files = []
+    for speaker in _SPEAKERS:
+        for item in range(items_per_speaker):
+            item_code = f"C{item // 1000 + 1:02d}_b{item // 100 % 10 + 1}_t{item % 100:02d}"
+            name = _NAMES[item % len(_NAMES)]
+            condition = ('bra', 'nob')[item // len(_NAMES) % 2]
+            for gate in _GATES:
+                stimuli_files.append(f"{speaker}_{item_code}_{name}_{condition}_g{gate}.wav")
+    return stimuli_files
+
+
+def _time(function, repeat):
+    """Return the median time of a function over a number of runs, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _size_benchmarks(stimuli_files):
+    """The benchmarks of the functions that are measured on the whole stimulus set."""
+    stimulus_data = [get_stimulus_data(f) for f in stimuli_files]
+    other_stimuli = [data for data in stimulus_data if int(data['gate']) != 7]
+    return {
+        'get_stimulus_data': lambda: [get_stimulus_data(f) for f in stimuli_files],
+        'constraint_randomization': lambda: constraint_randomization(other_stimuli, rng=random.Random(1)),
+        'randomize_stimuli': lambda: randomize_stimuli(list(stimuli_files), rng=random.Random(1)),
+    }
+
+
+def _call_benchmarks(output_directory):
+    """The benchmarks of the functions that are measured per call."""
+    window = visual.Window(size=(800, 600), fullscr=False, color=(255, 255, 255))
+    samples = np.random.default_rng(1).uniform(-0.1, 0.1, int(0.6 * sample_rate)).astype(np.float32)
+    result = dict.fromkeys(RESULT_FIELDNAMES, 'x')
+    output_filename = os.path.join(output_directory, 'results.csv')
+
+    def write_results():
+        with open(output_filename, 'w', newline='') as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=RESULT_FIELDNAMES)
+            for call in range(BENCHMARK_CALLS):
+                append_result_to_csv(writer, result, call > 0, output_file)
+
+    return window, {
+        'sound.Sound': lambda: [sound.Sound(samples, sampleRate=sample_rate) for _ in range(BENCHMARK_CALLS)],
+        'TextStim': lambda: [visual.TextStim(window, text=begin, wrapWidth=2, height=0.1, color="black")
+                             for _ in range(BENCHMARK_CALLS)],
+        'cached screen': lambda: [screen_cache.get(window, begin).draw() for _ in range(BENCHMARK_CALLS)],
+        'append_result_to_csv': write_results,
+    }
+
+
+def run_benchmarks(sizes=SIZES, repeat=5, only=None):
+    """
+    Run the benchmarks.
+
+    Parameters:
+    sizes (iterable of int): The sizes of the synthetic stimulus sets.
+    repeat (int, optional): How often every benchmark is repeated. Defaults to 5.
+    only (iterable of str, optional): The names of the benchmarks to run. Defaults to all.
+
+    Returns:
+    dict: Benchmark key ('<name>@<size>' or '<name>/call') -> median time in seconds.
+    """
+    results = {}
+    for size in sizes:
+        stimuli_files = synthetic_stimuli(size)
+        for name, function in _size_benchmarks(stimuli_files).items():
+            if only is None or name in only:
+                results[f"{name}@{size}"] = _time(function, repeat)
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        window, benchmarks = _call_benchmarks(output_directory)
+        for name, function in benchmarks.items():
+            if only is None or name in only:
+                results[f"{name}/call"] = _time(function, repeat) / BENCHMARK_CALLS
+        window.close()
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Flag the benchmarks that are slower than the baseline by more than the tolerance.
+
+    Parameters:
+    results (dict): The results of run_benchmarks().
+    baseline (dict): The baseline results.
+    tolerance (float): The allowed slowdown, e.g. 0.25 for 25 %.
+
+    Returns:
+    list of str: The keys of the regressed benchmarks.
+    """
+    return [key for key, seconds in results.items()
+            if key in baseline and seconds > baseline[key] * (1 + tolerance)]
+
+
+def _format_time(seconds):
+    """Format a time in seconds with a suitable unit."""
+    if seconds >= 1:
+        return f"{seconds:.3f} s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.3f} ms"
+    return f"{seconds * 1e6:.3f} us"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the gating experiment.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='sizes of the stimulus sets')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every benchmark')
+    parser.add_argument('--only', nargs='+', default=None, help='names of the benchmarks to run')
+    parser.add_argument('--baseline', default=os.path.join(BASELINE_DIRECTORY, f"baseline_{BACKEND}.json"),
+                        help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(args.sizes, args.repeat, args.only)
+
+    baseline_results = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)['results']
+
+    print(f"Backend: {BACKEND}")
+    print(f"{'benchmark':<36}{'median':>14}{'baseline':>14}{'change':>10}")
+    for key, median in benchmark_results.items():
+        if key in baseline_results:
+            print(f"{key:<36}{_format_time(median):>14}{_format_time(baseline_results[key]):>14}"
+                  f"{(median / baseline_results[key] - 1) * 100:>+9.1f}%")
+        else:
+            print(f"{key:<36}{_format_time(median):>14}{'-':>14}{'-':>10}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'backend': BACKEND, 'repeat': args.repeat, 'results': {**baseline_results, **benchmark_results}},
+                      baseline_file, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+    else:
+        regressions = compare_with_baseline(benchmark_results, baseline_results, args.tolerance)
+        for key in regressions:
+            print(f"REGRESSION: {key} is more than {args.tolerance:.0%} slower than the baseline")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,218 @@
+"""
+gating_build.py
+
+This module builds the gated stimulus folders from the ungated recordings, in parallel and incrementally.
+
+Every recording is cut by its own task in a process pool (see gating_gates.py for the cutting rules). A cache file in
+the output folder stores a content hash of every recording's inputs - the WAV file, its TextGrid, the gates and the
+segment tier. Recordings whose hash hasn't changed since the last build, and whose gates all still exist, are skipped.
+Gates of recordings that were removed from the ungated folder are deleted, and so are the gates a rebuilt recording no
+longer has (e.g. when fewer gates are built). The cache is saved as soon as each recording is written, so an
+interrupted or failed build keeps the work already done.
+
+The gates are named 'NAME_gN.wav' after their recording, which gives the 'NN_C01_b1_tXX_name_cond_gN.wav' names
+get_stimulus_data() depends on.
+
+After the build a timing summary shows how long reading, cutting and writing took for every rebuilt recording.
+
+Usage:
+    python gating_build.py stimuli/ungated/test stimuli/gated/test --gates 2 3 4 5 7
+    python gating_build.py stimuli/ungated/practice stimuli/gated/practice --gates 2 3 4 5 7 --workers 4
+
+Functions:
+    - hash_recording: Computes the content hash of a recording's inputs.
+    - build_gates: Builds the gates of all changed recordings of a folder.
+    - print_timing_summary: Prints the per-recording timings of a build.
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from gating_audio import read_wav, write_wav
+from gating_gates import read_textgrid, gate_boundaries, cut_gates, gate_filename, list_recordings, ALL_GATES, \
+    SEGMENT_TIER
+
+CACHE_FILENAME = '.build_cache.json'
+
+
+def hash_recording(ungated_path, recording_name, gates, tier):
+    """
+    Compute the content hash of everything the gates of a recording depend on.
+
+    Parameters:
+    ungated_path (str): The folder containing the recordings and their TextGrids.
+    recording_name (str): The name of the recording (without extension).
+    gates (tuple): The gates that are built.
+    tier (int): The segment tier of the TextGrids (1-based).
+
+    Returns:
+    str: The SHA-256 hex digest.
+    """
+    content_hash = hashlib.sha256(f"{sorted(gates)}|{tier}|".encode('utf-8'))
+    for extension in ('.wav', '.TextGrid'):
+        with open(os.path.join(ungated_path, recording_name + extension), 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def _build_recording(ungated_path, gated_path, recording_name, gates, tier):
+    """
+    Cut one recording into gates and write them. Runs in a worker process.
+
+    Returns:
+    tuple: The recording name, the written filenames and a dict with the seconds spent reading, cutting and writing.
+    """
+    timings = {}
+
+    stage_start = time.perf_counter()
+    samples, sample_rate = read_wav(os.path.join(ungated_path, recording_name + '.wav'))
+    tiers = read_textgrid(os.path.join(ungated_path, recording_name + '.TextGrid'))
+    timings['read'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    cut = cut_gates(samples, sample_rate, gate_boundaries(tiers[tier - 1]['intervals']), gates)
+    timings['cut'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    written = []
+    for gate, gate_samples in cut.items():
+        write_wav(os.path.join(gated_path, gate_filename(recording_name, gate)), gate_samples, sample_rate)
+        written.append(gate_filename(recording_name, gate))
+    timings['write'] = time.perf_counter() - stage_start
+
+    return recording_name, written, timings
+
+
+def _load_cache(cache_path):
+    """Load the build cache, or return an empty cache if there is none or it is unreadable."""
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache_path, cache):
+    """Write the build cache atomically."""
+    with open(cache_path + '.tmp', 'w') as cache_file:
+        json.dump(cache, cache_file, indent=1, sort_keys=True)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def _remove_outputs(gated_path, outputs):
+    """Delete gates of an earlier build."""
+    for stale_file in outputs:
+        if os.path.exists(os.path.join(gated_path, stale_file)):
+            os.remove(os.path.join(gated_path, stale_file))
+
+
+def build_gates(ungated_path, gated_path, gates=ALL_GATES, tier=SEGMENT_TIER, workers=None, force=False):
+    """
+    Build the gates of all recordings whose inputs changed since the last build.
+
+    Parameters:
+    ungated_path (str): The folder containing the recordings and their TextGrids.
+    gated_path (str): The folder to write the gates to. It is created if it doesn't exist.
+    gates (tuple, optional): The gates to build. Defaults to all gates.
+    tier (int, optional): The segment tier of the TextGrids (1-based). Defaults to 3.
+    workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+    force (bool, optional): Rebuild all recordings, whatever their hashes in the cache. Defaults to False.
+
+    Returns:
+    dict: Recording name -> timings dict ('read', 'cut', 'write' and 'total' seconds) of every rebuilt recording.
+
+    Raises:
+    Exception: If some recordings could not be built. The others are built and cached.
+    """
+    os.makedirs(gated_path, exist_ok=True)
+    cache_path = os.path.join(gated_path, CACHE_FILENAME)
+    # The cache is read even when the build is forced, so the outputs of the last build are known
+    cache = _load_cache(cache_path)
+
+    # Find the recordings whose inputs changed or whose gates are missing
+    recordings = list_recordings(ungated_path)
+    hashes = {name: hash_recording(ungated_path, name, gates, tier) for name in recordings}
+    changed = [name for name in recordings
+               if force or cache.get(name, {}).get('hash') != hashes[name]
+               or not all(os.path.exists(os.path.join(gated_path, f)) for f in cache[name]['outputs'])]
+
+    # Delete the gates of recordings that no longer exist
+    removed = set(cache) - set(recordings)
+    for name in removed:
+        _remove_outputs(gated_path, cache.pop(name)['outputs'])
+    if removed:
+        _save_cache(cache_path, cache)
+
+    timings = {}
+    failed = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_build_recording, ungated_path, gated_path, name, tuple(gates), tier): name
+                   for name in changed}
+        for future in as_completed(futures):
+            name = futures[future]
+            old_outputs = cache.get(name, {}).get('outputs', [])
+            try:
+                name, written, recording_timings = future.result()
+            except Exception as error:
+                print(f"Warning: building the gates of {name} failed: {error}")
+                failed[name] = error
+                # Rebuild the recording next time, and keep track of the gates it may have left
+                cache[name] = {'hash': None,
+                               'outputs': sorted(set(old_outputs) | {gate_filename(name, gate) for gate in gates})}
+                _save_cache(cache_path, cache)
+                continue
+            recording_timings['total'] = sum(recording_timings.values())
+            timings[name] = recording_timings
+            # Delete the gates of the last build that were not written again
+            _remove_outputs(gated_path, set(old_outputs) - set(written))
+            cache[name] = {'hash': hashes[name], 'outputs': written}
+            _save_cache(cache_path, cache)
+
+    if failed:
+        raise Exception(f"Building the gates of {len(failed)} recordings failed: {', '.join(sorted(failed))}") \
+            from next(iter(failed.values()))
+    return timings
+
+
+def print_timing_summary(timings, n_recordings, elapsed, top=10):
+    """
+    Print the timings of a build, slowest recordings first.
+
+    Parameters:
+    timings (dict): Recording name -> timings dict, as returned by build_gates().
+    n_recordings (int): The number of recordings in the ungated folder.
+    elapsed (float): The wall-clock duration of the build in seconds.
+    top (int, optional): The number of recordings to list. Defaults to 10.
+    """
+    print(f"Rebuilt {len(timings)} of {n_recordings} recordings in {elapsed:.2f} s "
+          f"({n_recordings - len(timings)} unchanged)")
+    if not timings:
+        return
+
+    print(f"{'recording':<32}{'read ms':>10}{'cut ms':>10}{'write ms':>10}{'total ms':>10}")
+    for name, recording_timings in sorted(timings.items(), key=lambda item: item[1]['total'], reverse=True)[:top]:
+        print(f"{name:<32}" + ''.join(f"{recording_timings[stage] * 1000:>10.1f}"
+                                      for stage in ('read', 'cut', 'write', 'total')))
+
+    totals = {stage: sum(t[stage] for t in timings.values()) for stage in ('read', 'cut', 'write', 'total')}
+    print(f"{'sum over workers':<32}" + ''.join(f"{totals[stage] * 1000:>10.1f}"
+                                                for stage in ('read', 'cut', 'write', 'total')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the gated stimuli of all changed recordings in parallel.')
+    parser.add_argument('ungated_path', help='folder containing the recordings and their TextGrids')
+    parser.add_argument('gated_path', help='folder to write the gates to')
+    parser.add_argument('--gates', type=int, nargs='+', default=list(ALL_GATES), help='gates to build')
+    parser.add_argument('--tier', type=int, default=SEGMENT_TIER, help='segment tier of the TextGrids (1-based)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='rebuild all recordings, ignoring the cache')
+    args = parser.parse_args()
+
+    build_start = time.perf_counter()
+    build_timings = build_gates(args.ungated_path, args.gated_path, args.gates, args.tier, args.workers, args.force)
+    print_timing_summary(build_timings, len(list_recordings(args.ungated_path)), time.perf_counter() - build_start)
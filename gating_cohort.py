@@ -0,0 +1,188 @@
+"""
+gating_cohort.py
+
+This module pre-generates the randomization lists of a whole cohort before anyone comes into the lab.
+
+Every subject gets a practice and a test list, randomized with randomize_phase() (the test list in speaker blocks
+with the gate 7 stimuli at the end of each block). Each list has a random number generator of its own, seeded with a
+seed derived from the cohort seed, the subject ID and the phase, so the seed recorded for a list reproduces that list
+on its own: randomize_phase(sorted(stimuli_files), phase, rng=random.Random(seed)). The lists are therefore
+reproducible: the same cohort seed always gives the same list for a subject, independently of the order or the number
+of processes the lists are generated in. The stimulus filenames are sorted before randomizing, so the directory
+listing order doesn't matter either.
+
+The lists are generated in parallel, one task per subject, and written to
+'randomization_lists/<subject>/<subject>_<phase>_seed<seed>_pregenerated_gating_stimuli.csv'. At session start
+load_and_randomize() looks the list up by subject ID instead of randomizing.
+
+For auditing, 'randomization_lists/cohort_index.csv' lists every generated list with its seed, the statistics of the
+constraint solver and the longest condition, gate and name runs that occur in it. Generating lists again replaces the
+lists and index rows of those subjects only.
+
+Usage:
+    python gating_cohort.py --count 40 --prefix P --seed 2024
+    python gating_cohort.py --subjects S01 S02 S03 --seed 2024 --workers 4
+
+Functions:
+    - subject_seed: Derives the seed of a subject or of a list from the cohort seed.
+    - audit_sequence: Computes the longest runs and constraint violations of a randomized list.
+    - generate_cohort: Generates and saves the lists of all subjects of a cohort.
+"""
+
+import os
+import csv
+import random
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+if __name__ == '__main__':
+    # Generating lists needs no display or audio hardware
+    os.environ.setdefault('GATING_BACKEND', 'simulated')
+
+from gating_configuration import practice_stimuli_path, test_stimuli_path
+from gating_randomization import load_stimuli, randomize_phase, get_stimulus_data, pregenerated_list_path, \
+    load_pregenerated, SEPARATED_GATES
+
+INDEX_FIELDS = ['subject', 'phase', 'seed', 'n_stimuli', 'attempts', 'backtracks', 'max_condition_run',
+                'max_gate_run', 'max_name_run', 'separated_gate_violations', 'path']
+
+
+def subject_seed(cohort_seed, subject):
+    """
+    Derive the seed of a subject from the cohort seed and the subject ID. The seed of a list is derived the same way
+    from '<subject>:<phase>'.
+
+    Parameters:
+    cohort_seed (int): The seed of the cohort.
+    subject (str): The subject ID, or '<subject>:<phase>' for the seed of a list.
+
+    Returns:
+    int: A 32 bit seed.
+    """
+    return int(hashlib.sha256(f"{cohort_seed}:{subject}".encode('utf-8')).hexdigest()[:8], 16)
+
+
+def audit_sequence(randomized_stimuli):
+    """
+    Compute the longest condition, gate and name runs within the speaker blocks of a randomized list, and the number
+    of adjacent stimuli of the same item with gates 5, 6 or 7. The gate 7 stimuli at the end of every speaker block
+    are left out of the gate runs, as they are all of the same gate by design.
+
+    Parameters:
+    randomized_stimuli (list of str): The randomized list of stimuli file names.
+
+    Returns:
+    dict: The keys 'max_condition_run', 'max_gate_run', 'max_name_run' and 'separated_gate_violations'.
+    """
+    audit = {'max_condition_run': 0, 'max_gate_run': 0, 'max_name_run': 0, 'separated_gate_violations': 0}
+    runs = {'condition': 0, 'gate': 0, 'name_stim': 0}
+    previous = None
+    for stimulus in map(get_stimulus_data, randomized_stimuli):
+        same_block = previous is not None and previous['speaker'] == stimulus['speaker']
+        for key in runs:
+            runs[key] = runs[key] + 1 if same_block and previous[key] == stimulus[key] else 1
+        audit['max_condition_run'] = max(audit['max_condition_run'], runs['condition'])
+        audit['max_name_run'] = max(audit['max_name_run'], runs['name_stim'])
+        if int(stimulus['gate']) != 7:
+            audit['max_gate_run'] = max(audit['max_gate_run'], runs['gate'])
+        if (same_block and previous['name_stim'] == stimulus['name_stim']
+                and previous['condition'] == stimulus['condition']
+                and int(previous['gate']) in SEPARATED_GATES and int(stimulus['gate']) in SEPARATED_GATES):
+            audit['separated_gate_violations'] += 1
+        previous = stimulus
+    return audit
+
+
+def _generate_subject(subject, cohort_seed, phase_files):
+    """
+    Randomize and save the lists of one subject, each with its own seed. Runs in a worker process.
+
+    Returns:
+    list of dict: One row of the cohort index per phase.
+    """
+    rows = []
+    for phase, stimuli_files in phase_files:
+        seed = subject_seed(cohort_seed, f"{subject}:{phase}")
+        stats = {}
+        randomized_stimuli = randomize_phase(list(stimuli_files), phase, rng=random.Random(seed), stats=stats)
+
+        path = pregenerated_list_path(subject, phase, seed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Remove lists generated earlier with another seed, only one list per subject and phase may exist
+        while load_pregenerated(subject, phase) is not None:
+            os.remove(pregenerated_list_path(subject, phase, load_pregenerated(subject, phase)[1]))
+
+        with open(path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["filename"])  # header
+            for row in randomized_stimuli:
+                writer.writerow([row])
+
+        rows.append(dict(subject=subject, phase=phase, seed=seed, n_stimuli=len(randomized_stimuli),
+                         attempts=stats.get('attempts', 0), backtracks=stats.get('backtracks', 0), path=path,
+                         **audit_sequence(randomized_stimuli)))
+    return rows
+
+
+def generate_cohort(subjects, cohort_seed, phase_paths=None, workers=None):
+    """
+    Generate and save the practice and test lists of all subjects of a cohort, in parallel.
+
+    Parameters:
+    subjects (list of str): The subject IDs.
+    cohort_seed (int): The seed of the cohort.
+    phase_paths (dict, optional): Phase -> stimulus directory. Defaults to the practice and test paths of the
+        configuration.
+    workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+    list of dict: The rows of the cohort index, which is also written to 'randomization_lists/cohort_index.csv'.
+    """
+    if phase_paths is None:
+        phase_paths = {'practice': practice_stimuli_path, 'test': test_stimuli_path}
+    phase_files = [(phase, sorted(load_stimuli(path))) for phase, path in phase_paths.items()]
+
+    index = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_generate_subject, subject, cohort_seed, phase_files) for subject in subjects]
+        for future in futures:
+            index.extend(future.result())
+
+    # Keep the index rows of the subjects that were not generated again
+    index_path = os.path.join('randomization_lists', 'cohort_index.csv')
+    kept_rows = []
+    if os.path.exists(index_path):
+        with open(index_path, newline='') as csvfile:
+            kept_rows = [row for row in csv.DictReader(csvfile) if row['subject'] not in set(subjects)]
+
+    os.makedirs('randomization_lists', exist_ok=True)
+    with open(index_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=INDEX_FIELDS)
+        writer.writeheader()
+        writer.writerows(kept_rows + index)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-generate seeded randomization lists for a cohort.')
+    subject_group = parser.add_mutually_exclusive_group(required=True)
+    subject_group.add_argument('--subjects', nargs='+', help='subject IDs')
+    subject_group.add_argument('--count', type=int, help='number of subjects, named <prefix>001, <prefix>002, ...')
+    parser.add_argument('--prefix', default='P', help='prefix of the generated subject IDs')
+    parser.add_argument('--seed', type=int, required=True, help='seed of the cohort')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    cohort = args.subjects or [f"{args.prefix}{number:03d}" for number in range(1, args.count + 1)]
+    cohort_index = generate_cohort(cohort, args.seed, workers=args.workers)
+
+    for audit_phase in sorted({row['phase'] for row in cohort_index}):
+        phase_rows = [row for row in cohort_index if row['phase'] == audit_phase]
+        print(f"{audit_phase}: {len(phase_rows)} lists, "
+              f"attempts max {max(row['attempts'] for row in phase_rows)}, "
+              f"backtracks max {max(row['backtracks'] for row in phase_rows)}, "
+              f"longest condition run {max(row['max_condition_run'] for row in phase_rows)}, "
+              f"longest gate run {max(row['max_gate_run'] for row in phase_rows)}, "
+              f"gate 5/6/7 violations {sum(row['separated_gate_violations'] for row in phase_rows)}")
@@ -0,0 +1,400 @@
+"""
+gating_collector.py
+
+This module contains the results collector of the gating experiment, for labs that run several stations at once.
+
+Every station writes its results to its own 'results' folder as before. If collector_host is set in
+gating_configuration.py, a CollectorSink additionally streams every result to a collector process on another machine
+(or the same one), which writes the results of all stations into one results folder with the same layout
+('<collector folder>/<subject>/<phase>_<experiment>_<subject>_<timestamp>.csv'). The collector folder can be
+aggregated and analyzed like a station's results folder (see gating_aggregate.py).
+
+Protocol:
+    The sink connects over TCP and sends batches of results as JSON lines:
+        {"station": "booth-1", "batch": 7, "records": [{"file": "<subject>/<csv filename>", "result": {...}}, ...]}
+    The collector appends the records to their CSV files, fsyncs them and answers with {"ack": 7, "written": n,
+    "rejected": m}. Records of a file whose trial is in the file already are skipped, so a batch that is sent again
+    (e.g. after a lost ack) is written once. Invalid records are rejected with a warning; the sink doesn't send them
+    again (they are in the CSV files of the station).
+
+The sink never blocks the experiment:
+
+    - It is fed by the background results writer (see gating_results_writer.py) after a result is in the local CSV
+      file, so the trial loop doesn't even wait for the queue of the sink.
+    - A sender thread sends one batch at a time and waits for its ack before sending the next one, so a slow collector
+      slows down the sender only (backpressure). The queue of the sink is bounded; results that don't fit into it are
+      appended to a local spool file instead.
+    - If the collector can't be reached or doesn't answer in time, the batch and all following results are spooled
+      ('results/collector_spool.jsonl'). Connecting is retried every few seconds; once the collector is reachable,
+      the spool is sent first, also at the start of the next session.
+
+Usage:
+    python gating_collector.py --port 5555 --output collected_results
+    python gating_collector.py --host 127.0.0.1 --port 5555 --output collected_results
+
+Classes:
+    - ResultsCollector: The collector server.
+    - CollectorSink: Streams results to the collector.
+"""
+
+import os
+import csv
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+
+DEFAULT_PORT = 5555
+SPOOL_FILENAME = 'collector_spool.jsonl'
+
+_CLOSE = object()
+
+
+def _record_file(output_filename):
+    """Return the '<subject>/<csv filename>' part of the path of a results file."""
+    return '/'.join(os.path.normpath(output_filename).split(os.sep)[-2:])
+
+
+class _CollectorHandler(socketserver.StreamRequestHandler):
+    """Receives the batches of one station connection."""
+
+    def handle(self):
+        station = None
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                station, batch, records = message['station'], message['batch'], list(message['records'])
+            except (ValueError, KeyError, TypeError) as error:
+                print(f"Warning: invalid batch from {station or self.client_address[0]} dropped: {error}")
+                self.wfile.write(json.dumps({'error': str(error)}).encode('utf-8') + b'\n')
+                continue
+            written, rejected = self.server.write_records(records, station)
+            self.wfile.write(json.dumps({'ack': batch, 'written': written, 'rejected': rejected}).encode('utf-8')
+                             + b'\n')
+        if station is not None:
+            print(f"Station {station} disconnected")
+
+
+class ResultsCollector(socketserver.ThreadingTCPServer):
+    """
+    The collector server. Writes the results sent by all stations into one results folder.
+
+    Parameters:
+    address (tuple): The (host, port) to listen on. Port 0 picks a free port (see server_address).
+    output_path (str): The results folder of the collector. It is created if it doesn't exist.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, output_path):
+        self.output_path = output_path
+        self.received = 0
+        self.written = 0
+        self.rejected = 0
+        self._written_trials = {}  # results file -> set of trials in the file
+        self._lock = threading.Lock()
+        os.makedirs(output_path, exist_ok=True)
+        super().__init__(address, _CollectorHandler)
+
+    def _output_filename(self, record_file):
+        """Return the path of a results file in the collector folder; the record can't point outside of it."""
+        subject, filename = record_file.split('/')
+        subject, filename = os.path.basename(subject), os.path.basename(filename)
+        if subject in ('', '.', '..') or not filename.endswith('.csv'):
+            raise ValueError(f"invalid results file '{record_file}'")
+        return os.path.join(self.output_path, subject, filename)
+
+    def _trials_in(self, output_filename):
+        """Return the trials in a results file, reading the file when it is first used."""
+        trials = self._written_trials.get(output_filename)
+        if trials is None:
+            trials = set()
+            if os.path.exists(output_filename):
+                with open(output_filename, newline='') as output_file:
+                    trials = {row['trial'] for row in csv.DictReader(output_file)}
+            self._written_trials[output_filename] = trials
+        return trials
+
+    def write_records(self, records, station=None):
+        """
+        Append records to their results files and fsync them; records that are in their file already are skipped.
+
+        Parameters:
+        records (list of dict): The records of a batch, each with 'file' and 'result'.
+        station (str, optional): The station that sent the records, for the warnings about invalid records.
+
+        Returns:
+        int: The number of records written.
+        int: The number of invalid records.
+        """
+        by_file = {}
+        rejected = 0
+        for record in records:
+            try:
+                str(record['result']['trial'])
+                by_file.setdefault(self._output_filename(record['file']), []).append(record['result'])
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                print(f"Warning: invalid record from {station} rejected: {error!r}")
+                rejected += 1
+
+        written = 0
+        with self._lock:
+            self.received += len(records)
+            self.rejected += rejected
+            for output_filename, results in by_file.items():
+                trials = self._trials_in(output_filename)
+                new_results = {}
+                for result in results:
+                    if str(result['trial']) not in trials:
+                        new_results.setdefault(str(result['trial']), result)
+                new_results = list(new_results.values())
+                if not new_results:
+                    continue
+                os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+                file_exists = os.path.exists(output_filename) and os.path.getsize(output_filename) > 0
+                with open(output_filename, 'a', newline='') as output_file:
+                    writer = csv.DictWriter(output_file, fieldnames=list(new_results[0]))
+                    if not file_exists:
+                        writer.writeheader()
+                    writer.writerows(new_results)
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+                trials.update(str(result['trial']) for result in new_results)
+                written += len(new_results)
+            self.written += written
+        return written, rejected
+
+
+class CollectorSink:
+    """
+    Streams results to the collector on a sender thread, with a bounded queue and a local spool file.
+
+    Parameters:
+    address (tuple): The (host, port) of the collector.
+    station (str): The name of the station, e.g. its host name.
+    spool_filename (str): The spool file for results that couldn't be sent.
+    max_queue (int, optional): The number of results the queue holds before results are spooled. Defaults to 1000.
+    batch_size (int, optional): The maximum number of results per batch. Defaults to 64.
+    timeout (float, optional): Seconds to wait for a connection or an ack. Defaults to 2.
+    retry_interval (float, optional): Seconds between two connection attempts. Defaults to 5.
+    """
+
+    def __init__(self, address, station, spool_filename, max_queue=1000, batch_size=64, timeout=2.0,
+                 retry_interval=5.0):
+        self.address = address
+        self.station = station
+        self.spool_filename = spool_filename
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.submitted = 0
+        self.sent = 0
+        self.spooled = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.failed_connections = 0
+        self.ack_latencies = []  # seconds from sending a batch until its ack
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spool_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._abandoned = threading.Event()  # close() timed out: spool instead of sending
+        self._socket = None
+        self._reader = None
+        self._next_attempt = 0.0
+        self._batch = 0
+        self._thread = threading.Thread(target=self._run, name='CollectorSink', daemon=True)
+        self._thread.start()
+
+    def submit(self, result, output_filename):
+        """
+        Queue a result for the collector. Never blocks; if the queue is full, the result is spooled.
+
+        Parameters:
+        result (dict): A dictionary containing the data for a single trial.
+        output_filename (str): The path of the local results file of the result.
+        """
+        record = {'file': _record_file(output_filename), 'result': result}
+        self.submitted += 1
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._spool([record])
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def close(self, timeout=10.0):
+        """
+        Send the queued results (or spool them) and stop the sender thread. Never blocks for much longer than the
+        timeout: the results that haven't been sent by then are spooled.
+
+        Parameters:
+        timeout (float, optional): The maximum time to wait for the sender thread in seconds. Defaults to 10.
+        """
+        self._closing.set()
+        try:
+            self._queue.put_nowait(_CLOSE)
+        except queue.Full:
+            pass  # the sender thread stops once it has emptied the queue
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            return
+
+        # The collector is too slow: spool the rest; a batch the sender thread is sending is spooled if it fails
+        self._abandoned.set()
+        records = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not _CLOSE:
+                records.append(record)
+        if records:
+            self._spool(records)
+        print(f"Warning: the collector didn't take the results within {timeout:.0f} s; {len(records)} results were "
+              f"spooled and are sent at the next session.")
+
+    def metrics(self):
+        """
+        Return the metrics of the sink.
+
+        Returns:
+        dict: The number of submitted, sent, spooled and rejected results, the maximum queue depth, the number of
+        failed connection attempts and the median and maximum ack latency in milliseconds.
+        """
+        latencies = sorted(self.ack_latencies)
+        metrics = {'submitted': self.submitted, 'sent': self.sent, 'spooled': self.spooled, 'rejected': self.rejected,
+                   'max_queue_depth': self.max_queue_depth, 'failed_connections': self.failed_connections}
+        if latencies:
+            metrics.update(ack_median_ms=latencies[len(latencies) // 2] * 1000, ack_max_ms=latencies[-1] * 1000)
+        return metrics
+
+    def _spool(self, records):
+        """Append records to the spool file."""
+        with self._spool_lock:
+            try:
+                with open(self.spool_filename, 'a') as spool_file:
+                    for record in records:
+                        spool_file.write(json.dumps(record) + '\n')
+            except OSError as error:
+                # The results are still in the local CSV files
+                print(f"Warning: {len(records)} results could not be spooled for the collector: {error}")
+                return
+            self.spooled += len(records)
+
+    def _connect(self):
+        """Return True if connected to the collector; connecting is only attempted every retry_interval seconds."""
+        if self._socket is not None:
+            return True
+        if time.monotonic() < self._next_attempt:
+            return False
+        try:
+            self._socket = socket.create_connection(self.address, timeout=self.timeout)
+            self._reader = self._socket.makefile('rb')
+            return True
+        except OSError:
+            self.failed_connections += 1
+            self._next_attempt = time.monotonic() + self.retry_interval
+            return False
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+        self._socket = self._reader = None
+        self._next_attempt = time.monotonic() + self.retry_interval
+
+    def _send(self, records):
+        """Send a batch and wait for its ack. Returns False if the collector is unreachable or didn't ack."""
+        if not self._connect():
+            return False
+        self._batch += 1
+        message = json.dumps({'station': self.station, 'batch': self._batch, 'records': records}) + '\n'
+        sent = time.perf_counter()
+        try:
+            self._socket.sendall(message.encode('utf-8'))
+            ack = json.loads(self._reader.readline() or b'{}')
+        except (OSError, ValueError):
+            self._disconnect()
+            return False
+        if 'error' in ack:
+            # Sending the batch again wouldn't help; its results are in the local CSV files
+            print(f"Warning: the collector rejected a batch of {len(records)} results: {ack['error']}")
+            self.rejected += len(records)
+            return True
+        if ack.get('ack') != self._batch:
+            self._disconnect()
+            return False
+        self.ack_latencies.append(time.perf_counter() - sent)
+        self.sent += len(records) - ack.get('rejected', 0)
+        self.rejected += ack.get('rejected', 0)
+        return True
+
+    def _send_spool(self):
+        """Send the spooled results, oldest first. Returns True if the spool is empty afterwards."""
+        sending_filename = self.spool_filename + '.sending'
+        while True:
+            if not os.path.exists(sending_filename):
+                with self._spool_lock:
+                    if not os.path.exists(self.spool_filename):
+                        return True
+                    os.replace(self.spool_filename, sending_filename)
+            records = []
+            with open(sending_filename) as sending_file:
+                for line in sending_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A torn line of a crashed session; its result is in the local CSV file
+                        continue
+            for start in range(0, len(records), self.batch_size):
+                if self._abandoned.is_set() or not self._send(records[start:start + self.batch_size]):
+                    return False
+            os.remove(sending_filename)
+
+    def _run(self):
+        """The sender thread: send the queued results in batches, the spool first."""
+        closing = False
+        while not closing:
+            try:
+                records = [self._queue.get(timeout=self.retry_interval)]
+            except queue.Empty:
+                records = []
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _CLOSE in records:
+                closing = True
+                records.remove(_CLOSE)
+            elif self._closing.is_set() and self._queue.empty():
+                closing = True  # close() couldn't queue _CLOSE into the full queue
+
+            if self._abandoned.is_set():
+                if records:
+                    self._spool(records)
+                break
+            if not (self._send_spool() and (not records or self._send(records))):
+                if records:
+                    self._spool(records)
+        self._disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect the results of several stations in one results folder.')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--output', default='collected_results', help='results folder of the collector')
+    args = parser.parse_args()
+
+    with ResultsCollector((args.host, args.port), args.output) as collector:
+        print(f"Collecting results on {args.host}:{collector.server_address[1]} into {args.output} (Ctrl+C to stop)")
+        try:
+            collector.serve_forever()
+        except KeyboardInterrupt:
+            print(f"Stopped - {collector.written} of {collector.received} received results written, "
+                  f"{collector.rejected} rejected")
@@ -18,6 +18,48 @@ Setup Paths:
     - results_path: Path to the directory where results are stored.
     - pics_path: Path to the directory where pictures are stored.
     - random_path: Path to the directory where randomization lists are stored.
+    - ungated_test_path: Path to the ungated test recordings and their TextGrids.
+    - ungated_practice_path: Path to the ungated practice recordings and their TextGrids.
+    - stimulus_cache_path: Path to the cache of playback-ready stimuli written by gating_validate.py.
+
+Stimulus Settings:
+    - sample_rate: Sample rate (Hz) all stimuli are converted to before playback.
+    - stimulus_memory_limit_mb: Maximum memory (MB) the preloaded stimuli of one phase (and the recordings the gates are
+      generated from, see generate_gates) may occupy.
+    - preload_stimuli: If True, the stimuli of a phase are decoded before its first trial, as far as the memory limit
+      allows.
+    - prefetch_window: The number of upcoming stimuli that are decoded ahead during the phase if they are not
+      preloaded (see gating_prefetch.py).
+    - generate_gates: If True, the gates are generated in memory from the ungated recordings instead of being read
+      from the gated folders.
+    - presented_gates: The gates of every recording that are presented when the gates are generated.
+    - stimulus_peak_level: If set, the stimuli are read from the cache files normalized to this peak level
+      (gating_validate.py --cache --peak-level); None plays the stimuli at their recorded level.
+
+Timing Settings:
+    - scheduled_timeline: If True, every phase is compiled into a timeline of target times and the sound is scheduled
+      for the flip that shows the audio pictogram (see gating_timeline.py).
+    - response_deadline: The time (s) the participant has to respond after the response screen; a trial without a
+      response is coded as a timeout (see gating_response.py). None waits for the response indefinitely.
+
+Adaptive Settings:
+    - adaptive_gating: If True, later gates of an item are skipped in the test phase once the participant has
+      identified the item consistently (see gating_adaptive.py).
+    - adaptive_threshold: The posterior probability of identification above which the later gates are skipped.
+
+Collector Settings:
+    - collector_host: The host of the results collector the results are streamed to in addition to the local CSV
+      files (see gating_collector.py); None to disable streaming.
+    - collector_port: The port of the results collector.
+    - station_name: The name of this station in the collector's log.
+
+Monitor Settings:
+    - monitor_host: The host the viewer of the live monitor runs on (see gating_monitor.py).
+    - monitor_port: The port of the viewer; None to disable the live monitor.
+
+Diagnostics Settings:
+    - trace_trials: If True, the timing of every stage of every trial is written to a trace file next to the results
+      (see gating_trace.py).
 
 Functions:
     - create_window: Creates and initializes the experiment window.
@@ -26,10 +68,11 @@ Functions:
     - append_result_to_csv: Appends the result of a trial to a CSV file.
 """
 
-from psychopy import monitors, visual, gui, core
+from gating_backend import monitors, visual, gui, core
 import random
 import os
 import datetime
+import platform
 import sys
 
 
@@ -53,6 +96,38 @@ practice_stimuli_path = resource_path('stimuli/gated/practice/')
 results_path = resource_path('results/')
 pics_path = resource_path('pics/')
 random_path = resource_path('randomization/')
+ungated_test_path = resource_path('stimuli/ungated/test/')
+ungated_practice_path = resource_path('stimuli/ungated/practice/')
+stimulus_cache_path = resource_path('stimuli/cache/')
+
+# Stimulus settings
+sample_rate = 44100
+stimulus_memory_limit_mb = 512
+preload_stimuli = True
+prefetch_window = 8
+generate_gates = False
+presented_gates = (2, 3, 4, 5, 7)
+stimulus_peak_level = None
+
+# Timing settings
+scheduled_timeline = False
+response_deadline = None
+
+# Adaptive settings
+adaptive_gating = False
+adaptive_threshold = 0.9
+
+# Collector settings
+collector_host = None
+collector_port = 5555
+station_name = platform.node()
+
+# Monitor settings
+monitor_host = '127.0.0.1'
+monitor_port = 5556
+
+# Diagnostics settings
+trace_trials = False
 
 
 # def create_window():
@@ -97,12 +172,13 @@ def create_window():
                          )
 
 
-def initialize_stimuli(window):
+def initialize_stimuli(window, bracket_position=None):
     """
     Initialize textstim, pics and fixation cross.
 
     Parameters:
     window : A PsychoPy visual.Window object where the stimuli will be displayed.
+    bracket_position : 'left' or 'right' to place the pictograms as in an interrupted session instead of randomly.
 
     Returns:
     fixation_cross : A PsychoPy visual.ShapeStim object, a fixation cross.
@@ -118,6 +194,9 @@ def initialize_stimuli(window):
     # Positions and labels are shuffled in the same order
     indices = list(range(len(positions)))
     random.shuffle(indices)
+    if bracket_position is not None and labels[indices[1]] != bracket_position:
+        # Keep the positions of the interrupted session
+        indices.reverse()
     positions = [positions[i] for i in indices]
     labels = [labels[i] for i in indices]
 
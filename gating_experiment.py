@@ -16,46 +16,161 @@ and manages user interface during the practice and test phases.
 
 Data Collection: Records participant responses, computes performance metrics, and stores
 the data in a structured CSV format for future analysis.
+
+Resuming: Started with --resume, the script continues the interrupted session of the participant entered in the
+dialog, using the saved randomization lists and skipping all completed trials.
+
+Startup: The stimuli of both phases are scanned and decoded and the audio backend is initialized in the background
+while the participant dialog is open (see gating_startup.py). A report of the startup times is printed and saved.
+
+Simulation: Started with --simulate, the script runs the whole session headless on the simulated backend of
+gating_simulation.py, with a virtual clock and a simulated participant, and writes the same output files.
+
+Real-time mode: Started with --realtime, the garbage collector only runs in the block breaks, the priority of the
+process is raised and the presentation thread is pinned to one core (--cpu) while a phase is running (see
+gating_realtime.py).
+
+Usage:
+    python gating_experiment.py
+    python gating_experiment.py --resume
+    python gating_experiment.py --simulate --subject SIM001 --seed 1
+    python gating_experiment.py --realtime --cpu 3
 """
 
-from psychopy import core
+import time
+launch_time = time.perf_counter()
+
+import os
+import argparse
+
+parser = argparse.ArgumentParser(description='Run the gating experiment.')
+parser.add_argument('--resume', action='store_true', help='continue the interrupted session of a participant')
+parser.add_argument('--simulate', action='store_true', help='run headless with a simulated participant')
+parser.add_argument('--subject', default='SIM001', help='subject ID of the simulated participant')
+parser.add_argument('--seed', type=int, default=None, help='seed of the simulated participant')
+parser.add_argument('--realtime', action='store_true',
+                    help='collect garbage only in block breaks, raise the priority and pin the presentation thread')
+parser.add_argument('--cpu', type=int, default=None,
+                    help='core the presentation thread is pinned to in real-time mode (default: the last one)')
+args = parser.parse_args()
+
+if args.simulate:
+    # The backend has to be selected before any module of the experiment is imported
+    os.environ['GATING_BACKEND'] = 'simulated'
+
+from gating_backend import core
 from gating_path_check import check_config_paths
 from gating_configuration import create_window, initialize_stimuli, get_participant_info,  practice_stimuli_path, \
-    test_stimuli_path, results_path, pics_path, random_path
-from gating_functions import show_message, run_trial_phase
-from gating_instructions import begin, test, end
-from gating_randomization import load_and_randomize
+    test_stimuli_path, results_path, pics_path, random_path, ungated_test_path, ungated_practice_path, \
+    generate_gates, presented_gates, sample_rate, stimulus_memory_limit_mb, prefetch_window, \
+    stimulus_cache_path, stimulus_peak_level
+from gating_functions import show_message, run_trial_phase, RESULT_FIELDNAMES
+from gating_instructions import begin, test, end, resume
+from gating_randomization import load_and_randomize, load_saved_randomization
+from gating_resume import find_resume_point
+from gating_startup import StartupTimer, BackgroundPreparation, warm_up_audio
+from gating_prefetch import StimulusPrefetcher
+from gating_screens import screen_cache
+from gating_realtime import RealtimeMode
+
+if args.simulate:
+    import random
+    from gating_simulation import configure, SimulatedParticipant
+    random.seed(args.seed)
+    configure(subject=args.subject, participant=SimulatedParticipant(seed=args.seed))
+
+startup_timer = StartupTimer(launch_time)
+startup_timer.mark('imports')
 
 # Check if input and output paths exist
-check_config_paths(test_stimuli_path, practice_stimuli_path, results_path, pics_path, random_path)
+if generate_gates:
+    check_config_paths(test_stimuli_path, practice_stimuli_path, results_path, pics_path, random_path,
+                       ungated_test_path, ungated_practice_path)
+else:
+    check_config_paths(test_stimuli_path, practice_stimuli_path, results_path, pics_path, random_path)
+startup_timer.mark('path check')
+
+# While the dialog is open, prepare the stimulus sources (the gated folders, their packed containers or gates
+# generated from the ungated recordings), the stimulus manifests and the stimulus banks of both phases
+phase_paths = {'practice': (practice_stimuli_path, ungated_practice_path if generate_gates else None),
+               'test': (test_stimuli_path, ungated_test_path if generate_gates else None)}
+preparation = BackgroundPreparation(phase_paths, presented_gates, sample_rate, stimulus_memory_limit_mb,
+                                    cache_path=stimulus_cache_path, peak_level=stimulus_peak_level)
 
 # Get participant information
 participant_info = get_participant_info()
-
-practice_stimuli = load_and_randomize(practice_stimuli_path, participant_info)
-test_stimuli = load_and_randomize(test_stimuli_path, participant_info)
+startup_timer.mark('participant dialog')
+
+# Initialize the audio backend on the main thread, while the background preparation finishes
+warm_up_audio(sample_rate, startup_timer)
+
+prepared = preparation.result(startup_timer)
+practice_source, practice_manifest, practice_bank = prepared['practice']
+test_source, test_manifest, test_bank = prepared['test']
+
+practice_resume = test_resume = None
+if args.resume:
+    # Continue with the randomization lists of the interrupted session
+    practice_stimuli = load_saved_randomization(participant_info['subject'], 'practice')
+    test_stimuli = load_saved_randomization(participant_info['subject'], 'test')
+    if practice_stimuli is None or test_stimuli is None:
+        raise Exception(f"No saved randomization lists found for '{participant_info['subject']}' - the session "
+                        "cannot be resumed")
+    practice_resume = find_resume_point(participant_info, 'practice', practice_stimuli, RESULT_FIELDNAMES)
+    test_resume = find_resume_point(participant_info, 'test', test_stimuli, RESULT_FIELDNAMES)
+else:
+    practice_stimuli = load_and_randomize(practice_stimuli_path, participant_info, practice_source, 'practice',
+                                          practice_manifest)
+    test_stimuli = load_and_randomize(test_stimuli_path, participant_info, test_source, 'test', test_manifest)
+practice_done = practice_resume is not None and practice_resume['completed'] == len(practice_stimuli)
+
+# Keep the pictogram positions of the interrupted session
+last_resume = test_resume or practice_resume
+bracket_position = last_resume['bracket_pic_position'] if last_resume is not None else None
+startup_timer.mark('randomization')
 
 # Create the window
 window = create_window()
+startup_timer.mark('window')
 
 # Initialize screen
 fixation_cross, bracket_pic, bracket_pos_label, nobracket_pic, nobracket_pos_label, pictograms_order, \
-    audio_pic = initialize_stimuli(window)
-
-# Show instructions
-show_message(window, begin)
-window.flip()
-
-# Run practice phase
-run_trial_phase(practice_stimuli, 'practice', participant_info, practice_stimuli_path, fixation_cross, bracket_pic,
-                nobracket_pic, window, nobracket_pos_label, bracket_pos_label, audio_pic)
-
-# Show test start instructions
-show_message(window, test)
+    audio_pic = initialize_stimuli(window, bracket_position)
+startup_timer.mark('pictograms')
+
+# Create the text of all instruction, feedback and block-break screens, so showing them only needs a draw and a flip
+screen_cache.build(window)
+startup_timer.mark('screens')
+startup_timer.report(participant_info)
+
+# Prefetchers decode the stimuli that are not preloaded while the instructions are shown
+practice_prefetcher = StimulusPrefetcher(practice_bank, prefetch_window)
+test_prefetcher = StimulusPrefetcher(test_bank, prefetch_window)
+
+if test_resume is None:
+    if not practice_done:
+        # Show instructions
+        practice_prefetcher.start(practice_stimuli[practice_resume['completed'] if practice_resume else 0:])
+        show_message(window, resume if practice_resume is not None else begin, prefetcher=practice_prefetcher)
+        window.flip()
+
+        # Run practice phase
+        run_trial_phase(practice_stimuli, 'practice', participant_info, practice_stimuli_path, fixation_cross,
+                        bracket_pic, nobracket_pic, window, nobracket_pos_label, bracket_pos_label, audio_pic,
+                        practice_prefetcher, practice_manifest, practice_resume, RealtimeMode(args.realtime, args.cpu))
+
+    # Show test start instructions
+    test_prefetcher.start(test_stimuli)
+    show_message(window, test, prefetcher=test_prefetcher)
+else:
+    # The test phase was interrupted
+    test_prefetcher.start(test_stimuli[test_resume['completed']:])
+    show_message(window, resume, prefetcher=test_prefetcher)
 
 # Run test phase
 run_trial_phase(test_stimuli, 'test', participant_info, test_stimuli_path, fixation_cross, bracket_pic,
-                nobracket_pic, window, nobracket_pos_label, bracket_pos_label, audio_pic)
+                nobracket_pic, window, nobracket_pos_label, bracket_pos_label, audio_pic, test_prefetcher,
+                test_manifest, test_resume, RealtimeMode(args.realtime, args.cpu))
 
 # Show end screen
 show_message(window, end)
@@ -6,38 +6,69 @@ gating experiment.
 
 Functions:
 
-- present_trial(window, fixation_cross, bracket_pic, nobracket_pic, gated_stimulus, kb, audio_pic):
+- present_trial(window, fixation_cross, bracket_pic, nobracket_pic, gated_stimulus, responses, audio_pic,
+duration=None, tracer=NULL_TRACER, prefetcher=None):
   Present a trial with the given gated stimulus and pictograms order. The participant's response (left or right)
-  and reaction time are recorded.
+  and reaction times are collected by a response collector (see gating_response.py).
 
-- show_message(window, message, wait_for_keypress=True, duration=1, text_height=0.1):
+- show_message(window, message, wait_for_keypress=True, duration=1, text_height=0.1, prefetcher=None):
   Display a text message on the screen. This can either wait for a keypress before proceeding or display
-  for a fixed duration.
+  for a fixed duration. The text stimulus is taken from the screen cache (see gating_screens.py).
 
 - run_trial_phase(stimuli_files, phase, participant_info, stimuli_path, fixation_cross, bracket_pic, nobracket_pic,
-window, nobracket_pos_label, bracket_pos_label, audio_pic):
+window, nobracket_pos_label, bracket_pos_label, audio_pic, stimulus_bank=None, manifest=None, resume_point=None,
+realtime=None):
   Run a phase of the experiment (either practice or test). This function loops through the given list of stimuli files,
   presenting each in turn, and writes the participant's responses and reaction times to a CSV file. It also handles
-  the division of trials into blocks and gives feedback during the practice phase.
+  the division of trials into blocks and gives feedback during the practice phase. All stimuli of the phase are
+  decoded into a stimulus bank before the first trial, so no file is read between two trials. The stimulus metadata
+  is taken from the stimulus manifest if one is given. The results are written by a background thread (see
+  gating_results_writer.py), so the trial loop never waits for the disk; if collector_host is set, they are also
+  streamed to the results collector (see gating_collector.py). An interrupted phase can be resumed from
+  the resume point found by gating_resume.find_resume_point(). If trace_trials is set in the configuration, the
+  timing of every trial stage is written to a trace file (see gating_trace.py). If scheduled_timeline is set, the
+  phase is compiled into a timeline of target times and every trial is run by the scheduler of gating_timeline.py.
+  Stimuli that are not preloaded are decoded ahead by a prefetcher during block breaks and the pauses after the
+  responses (see gating_prefetch.py). If adaptive_gating is set, later gates of items the participant has identified
+  are skipped in the test phase (see gating_adaptive.py). The keyboard is polled by a background thread; if
+  response_deadline is set, a trial without a response in time is coded as a timeout. The pauses of the garbage
+  collector are recorded per block; in real-time mode, the garbage is only collected in the block breaks (see
+  gating_realtime.py). Every trial is published to the viewer of the live monitor (see gating_monitor.py).
 """
 
 
 # Import necessary libraries
-from psychopy import prefs
-# Set the audio library preference
-prefs.hardware['audioLib'] = ['ptb', 'sounddevice', 'pygame', 'pyo']
-# Now, import sound
-from psychopy import sound, core, event, visual
+from gating_backend import core, event, keyboard, wall_time
 import os
 import datetime
-import time
-from gating_configuration import append_result_to_csv
+from contextlib import nullcontext
+from functools import partial
+from gating_configuration import sample_rate, stimulus_memory_limit_mb, trace_trials, scheduled_timeline, \
+    preload_stimuli, prefetch_window, collector_host, collector_port, station_name, adaptive_gating, \
+    adaptive_threshold, response_deadline, monitor_host, monitor_port
 from gating_randomization import get_stimulus_data
-from psychopy.hardware import keyboard
-import csv
-
-
-def present_trial(window, fixation_cross, bracket_pic, nobracket_pic, gated_stimulus, kb, audio_pic):
+from gating_stimulus_bank import StimulusBank
+from gating_prefetch import StimulusPrefetcher
+from gating_session_log import log_session_event
+from gating_results_writer import ResultsWriter
+from gating_trial_log import TrialLog, FIELDNAMES
+from gating_collector import CollectorSink, SPOOL_FILENAME
+from gating_adaptive import AdaptiveGating
+from gating_response import ResponseCollector
+from gating_realtime import RealtimeMode, print_gc_report
+from gating_monitor import MonitorPublisher
+from gating_trace import TrialTracer, NULL_TRACER, summarize_trace, print_trace_summary
+from gating_timeline import compile_trial_timeline, compile_phase_timeline, run_trial_timeline, check_clocks, \
+    TimelineLog, FIXATION_DURATION, POST_SOUND_DURATION, POST_RESPONSE_DURATION
+from gating_screens import screen_cache, block_break_message, FEEDBACK_HEIGHT
+from gating_instructions import correct_feedback, incorrect_feedback
+
+# Columns of the results CSV files
+RESULT_FIELDNAMES = FIELDNAMES
+
+
+def present_trial(window, fixation_cross, bracket_pic, nobracket_pic, gated_stimulus, responses, audio_pic,
+                  duration=None, tracer=NULL_TRACER, prefetcher=None):
     """
     Present a trial with a given gated stimulus, displaying a fixation cross, bracket pictures and an audio
     pictogram on the specified window.
@@ -48,43 +79,56 @@ def present_trial(window, fixation_cross, bracket_pic, nobracket_pic, gated_stim
     bracket_pic (psychopy.visual.ImageStim): The bracket picture stimulus.
     nobracket_pic (psychopy.visual.ImageStim): The non-bracket picture stimulus.
     gated_stimulus (psychopy.sound.Sound): The gated stimulus sound.
-    kb (psychopy.hardware.keyboard.Keyboard): The keyboard to register responses from.
+    responses (ResponseCollector): Collects the response from the keyboard.
     audio_pic (psychopy.visual.ImageStim): The audio pictogram stimulus.
+    duration (float, optional): The duration of the gated stimulus in seconds, e.g. from the stimulus manifest.
+        Defaults to the duration of the sound object.
+    tracer (TrialTracer, optional): Records the time of every stage of the trial. Defaults to a tracer that records
+        nothing.
+    prefetcher (StimulusPrefetcher, optional): Decodes upcoming stimuli during the pause after the response.
 
     Returns:
-    str: The response key ('left' or 'right').
-    float: The reaction time in seconds.
+    Response: The response key ('left', 'right' or 'timeout') and the reaction times in seconds.
     """
 
     fixation_cross.draw()
     window.flip()
+    tracer.mark('fixation_flip')
     core.wait(1.0)
     window.flip()
+    tracer.mark('blank_flip')
+
+    if duration is None:
+        duration = gated_stimulus.getDuration()
 
     audio_pic.draw()
     gated_stimulus.play()
+    responses.sound_started(core.getTime(), duration)
+    tracer.mark('play')
     window.flip()
+    tracer.mark('audio_flip')
 
-    core.wait(gated_stimulus.getDuration() + 0.5)  # wait for the duration of the sound + 500ms
+    core.wait(duration + 0.5)  # wait for the duration of the sound + 500ms
+    tracer.mark('sound_wait')
 
     bracket_pic.draw()
     nobracket_pic.draw()
     window.flip()
-    kb.clearEvents()  # clear the keyboard buffer
-    kb.clock.reset()  # reset the clock
-    keys = kb.waitKeys(keyList=['left', 'right'])  # wait until a key is pressed
-
-    # Since waitKeys() waits for a key press, we can be sure that there is at least one key press
-    response_key = keys[0].name  # get the name of the key that was pressed
-    reaction_time = keys[0].rt  # get the reaction time
+    tracer.mark('response_flip')
+    responses.response_screen_shown()  # clear the keyboard buffer and reset the clock
+    response = responses.wait()  # wait until a key is pressed or the deadline has passed
+    tracer.mark('key')
 
     window.flip()
-    core.wait(1)
+    tracer.mark('end_flip')
+    with prefetcher.idle() if prefetcher is not None else nullcontext():
+        core.wait(1)
+    tracer.mark('end_wait')
 
-    return response_key, reaction_time
+    return response
 
 
-def show_message(window, message, wait_for_keypress=True, duration=1, text_height=0.1):
+def show_message(window, message, wait_for_keypress=True, duration=1, text_height=0.1, prefetcher=None):
     """
     Show a message on the screen.
 
@@ -93,18 +137,21 @@ def show_message(window, message, wait_for_keypress=True, duration=1, text_heigh
     wait_for_keypress (bool, optional): Whether to wait for a keypress. Defaults to True.
     duration (float, optional): Time in seconds to wait if wait_for_keypress is False. Defaults to 1.
     text_height (float, optional): The height of the text. Defaults to 0.1.
+    prefetcher (StimulusPrefetcher, optional): Decodes upcoming stimuli while the message is shown.
     """
-    text_stim = visual.TextStim(window, text=message, wrapWidth=2, height=text_height, color="black")
+    text_stim = screen_cache.get(window, message, text_height)
     text_stim.draw()
     window.flip()
-    if wait_for_keypress:
-        event.waitKeys(keyList=['return'])
-    else:
-        core.wait(duration)
+    with prefetcher.idle() if prefetcher is not None else nullcontext():
+        if wait_for_keypress:
+            event.waitKeys(keyList=['return'])
+        else:
+            core.wait(duration)
 
 
 def run_trial_phase(stimuli_files, phase, participant_info, stimuli_path, fixation_cross, bracket_pic, nobracket_pic,
-                    window, nobracket_pos_label, bracket_pos_label, audio_pic):
+                    window, nobracket_pos_label, bracket_pos_label, audio_pic, stimulus_bank=None, manifest=None,
+                    resume_point=None, realtime=None):
     """
     Run a phase of trials with the given stimuli files, phase and participant information.
 
@@ -120,14 +167,26 @@ def run_trial_phase(stimuli_files, phase, participant_info, stimuli_path, fixati
     nobracket_pos_label (str): The label for the position of the non-bracket picture ('left', 'right').
     bracket_pos_label (str): The label for the position of the bracket picture ('left', 'right').
     audio_pic (psychopy.visual.ImageStim): The audio pictogram stimulus.
+    stimulus_bank (StimulusBank or StimulusPrefetcher, optional): A bank holding the decoded stimuli, or a prefetcher
+        of such a bank started before the phase. If None, a bank is created. Unless preload_stimuli is disabled, the
+        bank is filled with the phase before the first trial, as far as the memory limit allows; the other stimuli
+        are prefetched.
+    manifest (StimulusManifest, optional): The manifest of the stimuli. If None, the stimulus data is parsed from the
+        file names and the durations are taken from the sound objects.
+    resume_point (dict, optional): Where to continue an interrupted phase, as returned by find_resume_point(). The
+        completed trials are skipped and the results are appended to the results file of the interrupted phase.
+    realtime (RealtimeMode, optional): Controls the garbage collector, the priority and the CPU affinity during the
+        phase. Defaults to None (the real-time mode is disabled; only the pauses of the garbage collector are recorded).
 
     Returns:
-    list: A list of dictionaries, where each dictionary contains the result data for one trial.
+    TrialLog: The results of the trials run in this call.
     """
 
-    results = []
+    # The sound stack is imported on first use, usually already by the audio warm-up during startup
+    from gating_backend import sound
 
-    kb = keyboard.Keyboard()  # Initialize the keyboard
+    # The keyboard is polled by a background thread, so waiting for a response never blocks beyond the deadline
+    responses = ResponseCollector(keyboard.Keyboard(), deadline=response_deadline)
 
     # path setup results per participant
     # Define the path in results for each subject
@@ -136,101 +195,183 @@ def run_trial_phase(stimuli_files, phase, participant_info, stimuli_path, fixati
     if not os.path.exists(subj_path_results):
         os.makedirs(subj_path_results)
 
-    start_time = time.time()
-    start_time_str = datetime.datetime.fromtimestamp(start_time).strftime('%H:%M:%S')
+    start_time = wall_time()
     trial_counter = 1
     block_counter = 1
     current_speaker = None
 
     # generate the base_filename based on task_name and phase
-    output_filename = f"{subj_path_results}/{phase}_{participant_info['experiment']}_{participant_info['subject']}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-
-    file_exists = os.path.exists(output_filename)  # Check if the file already exists before entering the loop
-
-    # Open file once, before the loop
-    with open(output_filename, 'a', newline='') as output_file:
-        writer = csv.DictWriter(output_file, fieldnames=['experiment',
-                                                         'subjectID',
-                                                         'date',
-                                                         'trial',
-                                                         'block',
-                                                         'phase',
-                                                         'stimulus',
-                                                         'response',
-                                                         'reaction_time',
-                                                         'accuracy',
-                                                         'speaker',
-                                                         'gate',
-                                                         'name_stim',
-                                                         'condition',
-                                                         'bracket_pic_position',
-                                                         'nobracket_pic_position',
-                                                         'start_time',
-                                                         'end_time',
-                                                         'duration'])
-
-        for stimulus_file in stimuli_files:
-            stimulus = get_stimulus_data(stimulus_file)
+    base_filename = f"{subj_path_results}/{phase}_{participant_info['experiment']}_{participant_info['subject']}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    output_filename = f"{base_filename}.csv"
+
+    if resume_point is not None:
+        # Continue the interrupted phase in its results file, skipping the completed trials
+        output_filename = resume_point['output_filename']
+        base_filename = output_filename[:-len('.csv')]
+        start_time = wall_time() - resume_point['elapsed']
+        trial_counter = resume_point['completed'] + 1
+        block_counter = resume_point['block']
+        current_speaker = resume_point['speaker']
+        stimuli_files = stimuli_files[resume_point['completed']:]
+
+    # Decode the stimuli of the phase before the first trial, as far as the bank can hold them; the prefetcher
+    # decodes the others during the idle periods of the phase
+    if stimulus_bank is None:
+        stimulus_bank = StimulusBank(stimuli_path, sample_rate=sample_rate, memory_limit_mb=stimulus_memory_limit_mb)
+    if isinstance(stimulus_bank, StimulusPrefetcher):
+        prefetcher, stimulus_bank = stimulus_bank, stimulus_bank.bank
+    else:
+        prefetcher = StimulusPrefetcher(stimulus_bank, prefetch_window)
+    if preload_stimuli:
+        stimulus_bank.preload(stimuli_files)
+    prefetcher.start(stimuli_files)
+
+    # The entries that are the same on every trial are stored once
+    trial_log = TrialLog({'experiment': participant_info['experiment'], 'subjectID': participant_info['subject'],
+                          'date': participant_info['cur_date'], 'phase': phase,
+                          'bracket_pic_position': bracket_pos_label, 'nobracket_pic_position': nobracket_pos_label,
+                          'start_time': start_time}, capacity=len(stimuli_files))
+
+    # Results are written by a background thread, so the trial loop never waits for the disk (or the collector)
+    collector_sink = CollectorSink((collector_host, collector_port), station_name,
+                                   os.path.join('results', SPOOL_FILENAME)) if collector_host else None
+    results_writer = ResultsWriter(output_filename, RESULT_FIELDNAMES, collector_sink)
+    tracer = TrialTracer(f"{base_filename}_trace.jsonl", window) if trace_trials else NULL_TRACER
+    # Every trial is published to the viewer of the live monitor; nothing waits for the viewer
+    monitor = MonitorPublisher((monitor_host, monitor_port), participant_info['subject'], phase) \
+        if monitor_port else None
+
+    def stimulus_data(stimulus_file):
+        return manifest[stimulus_file] if manifest is not None else get_stimulus_data(stimulus_file)
+
+    # In the adaptive mode, later gates of identified items are skipped; a resumed phase continues with the responses
+    # given so far
+    adaptive = AdaptiveGating(adaptive_threshold) if adaptive_gating and phase == 'test' else None
+    if adaptive is not None and resume_point is not None and resume_point['completed']:
+        adaptive.replay(output_filename, stimulus_data)
+
+    if scheduled_timeline:
+        # Compile the target times of all trials before the first trial. Without a manifest, the durations are only
+        # known once the stimuli are decoded, so the timeline of each trial is compiled from its prefetched stimulus.
+        timelines = compile_phase_timeline([manifest[f]['duration'] for f in stimuli_files],
+                                           window.monitorFramePeriod) if manifest is not None else None
+        timeline_log = TimelineLog()
+        timeline_stimuli = {'fixation_cross': fixation_cross, 'audio_pic': audio_pic, 'bracket_pic': bracket_pic,
+                            'nobracket_pic': nobracket_pic}
+
+    responses.start()
+    if realtime is None:
+        realtime = RealtimeMode(enabled=False)
+    try:
+        if scheduled_timeline:
+            # The sound onsets are scheduled on the clock of the flips
+            clock_error = check_clocks(window)
+            print(f"Predicted flip time off by {clock_error * 1000:.2f} ms")
+        # Enter the real-time mode once all background threads of the phase are running
+        realtime.start()
+        for trial_index, stimulus_file in enumerate(stimuli_files):
+            stimulus = stimulus_data(stimulus_file)
 
             if phase == 'test' and current_speaker and current_speaker != stimulus['speaker']:
                 # Speaker has changed, therefore one block has ended
-                remaining_blocks = 4 - block_counter
-                show_message(window, f"Block {block_counter} geschafft - noch {remaining_blocks} Block(s) übrig. \n Sie können eine Pause machen, wenn Sie dies wünschen. Drücken Sie die Eingabetaste (Enter), um weiterzumachen.")
+                realtime.block_break(block_counter)  # collect the garbage of the block
+                show_message(window, block_break_message(block_counter), prefetcher=prefetcher)
                 block_counter += 1
             current_speaker = stimulus['speaker']
 
-            gated_stimulus = sound.Sound(os.path.join(stimuli_path, stimulus_file), sampleRate=44100)
-            response_key, reaction_time = present_trial(window, fixation_cross, bracket_pic, nobracket_pic,
-                                                        gated_stimulus, kb, audio_pic)
+            if adaptive is not None and adaptive.skip(stimulus, stimulus_data(stimuli_files[trial_index + 1])
+                                                      if trial_index + 1 < len(stimuli_files) else None):
+                # The trial number keeps counting skipped trials, so it stays the position in the randomization list
+                trial_counter += 1
+                continue
+
+            tracer.begin_trial(trial_counter, stimulus_file)
+            responses.begin_trial(trial_counter)
+            samples = prefetcher.get(stimulus_file)
+            gated_stimulus = sound.Sound(samples, sampleRate=stimulus_bank.sample_rate, name=stimulus_file)
+            tracer.mark('sound_load')
+            trial_start = core.getTime()
+            if scheduled_timeline:
+                timeline = timelines[trial_index] if timelines is not None else \
+                    compile_trial_timeline(len(samples) / stimulus_bank.sample_rate, window.monitorFramePeriod)
+                response = run_trial_timeline(window, timeline, timeline_stimuli, gated_stimulus, responses,
+                                              trial_counter, timeline_log, tracer, prefetcher)
+            else:
+                response = present_trial(window, fixation_cross, bracket_pic, nobracket_pic, gated_stimulus,
+                                         responses, audio_pic, stimulus['duration'] if manifest is not None else None,
+                                         tracer, prefetcher)
+            trial_end = core.getTime()
+            response_key = response.key
 
             # Determine correct answer and accuracy
             correct_answer = 'left' if (stimulus['condition'] == 'nob' and nobracket_pos_label == 'left') or (
                         stimulus['condition'] == 'bra' and bracket_pos_label == 'left') else 'right'
-            accuracy = 1 if response_key == correct_answer else 0
+            accuracy = 1 if response_key == correct_answer else 0  # a timeout counts as incorrect
+            if adaptive is not None:
+                adaptive.record(stimulus, accuracy)
 
             if phase == 'practice':
-                feedback = "Richtig!" if response_key == correct_answer else "Falsch!"
-                show_message(window, feedback, wait_for_keypress=False, text_height=0.3)
-
-            # Record end time and duration
-            end_time = time.time()
-            end_time_str = datetime.datetime.fromtimestamp(end_time).strftime('%H:%M:%S')
-            duration = end_time - start_time
-            hours, remainder = divmod(duration, 3600)
-            minutes, seconds = divmod(remainder, 60)
-            duration_str = '{:02d}:{:02d}:{:02d}'.format(int(hours), int(minutes), int(seconds))
-
-            # Store trial data
-            trial_data = {
-                'experiment': participant_info['experiment'],
-                'subjectID': participant_info['subject'],
-                'date': participant_info['cur_date'],
-                'trial': trial_counter,
-                'block': block_counter,
-                'phase': phase,
-                'stimulus': stimulus_file,
-                'response': response_key,
-                'reaction_time': reaction_time,
-                'accuracy': accuracy,
-                'speaker': stimulus['speaker'],
-                'gate': stimulus['gate'],
-                'name_stim': stimulus['name_stim'],
-                'condition': stimulus['condition'],
-                'bracket_pic_position': bracket_pos_label,
-                'nobracket_pic_position': nobracket_pos_label,
-                'start_time': start_time_str,
-                'end_time': end_time_str,
-                'duration': duration_str
-            }
-            results.append(trial_data)
-
-            # Write data to csv file
-            append_result_to_csv(writer, trial_data, file_exists, output_file)
-
-            if not file_exists:
-                file_exists = True  # After first write, file definitely exists
+                feedback = correct_feedback if response_key == correct_answer else incorrect_feedback
+                show_message(window, feedback, wait_for_keypress=False, text_height=FEEDBACK_HEIGHT,
+                             prefetcher=prefetcher)
+
+            # Store the trial in the trial log; the result row is formatted on the writer thread
+            log_index = trial_log.append(trial_counter, block_counter, stimulus_file, response_key, response.rt,
+                                           accuracy, stimulus['speaker'], stimulus['gate'], stimulus['name_stim'],
+                                           stimulus['condition'], wall_time(), response.rt_onset, response.rt_offset)
+
+            # Queue data for writing to the csv file
+            results_writer.submit(partial(trial_log.record, log_index))
+            tracer.mark('csv_submit')
+
+            if monitor is not None:
+                if scheduled_timeline:
+                    timing_error = timeline_log.trial_error(trial_counter)
+                else:
+                    # The time the trial took beyond its nominal duration
+                    nominal = FIXATION_DURATION + (stimulus['duration'] if manifest is not None
+                                                   else gated_stimulus.getDuration()) + POST_SOUND_DURATION + \
+                        (response.rt if not response.timed_out else response_deadline) + POST_RESPONSE_DURATION
+                    timing_error = (trial_end - trial_start - nominal) * 1000
+                monitor.publish(trial_counter, block_counter, stimulus['gate'], accuracy, response.rt, timing_error)
+            tracer.end_trial()
 
             # Increment trial counter
             trial_counter += 1
-
-    return results
+    finally:
+        gc_blocks = realtime.stop(block_counter)
+        # Write the remaining results and wait until they are on disk
+        results_writer.close()
+        print(f"Results writer ({phase}): {results_writer.metrics()}")
+        if collector_sink is not None:
+            collector_sink.close()
+            log_session_event(participant_info, 'collector', phase=phase, **collector_sink.metrics())
+        tracer.close()
+        if monitor is not None:
+            monitor.close()
+        prefetcher.stop()
+        responses.stop()
+        if scheduled_timeline:
+            timeline_log.save(f"{base_filename}_timeline.csv")
+            print(f"Timeline errors ({phase}, median/max ms): {timeline_log.summary()}")
+
+    if trace_trials:
+        print(f"Trial timing ({phase}):")
+        print_trace_summary(summarize_trace(f"{base_filename}_trace.jsonl"))
+
+    # Report how long each stimulus took to load and how well the prefetching worked
+    prefetcher.save_load_times(f"{base_filename}_load_times.csv")
+    # Save every key press and release of the phase
+    responses.save(f"{base_filename}_keys.csv")
+    log_session_event(participant_info, 'responses', phase=phase, **responses.metrics())
+    if monitor is not None:
+        log_session_event(participant_info, 'monitor', phase=phase, **monitor.metrics())
+    print(f"Garbage collector ({phase}, real-time mode {'on' if realtime.enabled else 'off'}):")
+    print_gc_report(gc_blocks)
+    log_session_event(participant_info, 'gc', phase=phase, realtime=realtime.enabled, blocks=gc_blocks)
+    log_session_event(participant_info, 'prefetch', phase=phase, **prefetcher.metrics())
+    if adaptive is not None:
+        print(f"Adaptive gating ({phase}): {adaptive.metrics()}")
+        log_session_event(participant_info, 'adaptive', phase=phase, **adaptive.metrics())
+
+    return trial_log
@@ -0,0 +1,312 @@
+"""
+gating_gates.py
+
+This module cuts the ungated recordings into gates. It replaces stimuli/cutting_files_into_gates.praat and follows its
+rules exactly:
+
+    gate 1: Mo
+    gate 2: Moni (incl. possible pause)
+    gate 3: Moni und
+    gate 4: Moni und Li
+    gate 5: Moni und Lilli (incl. possible pause)
+    gate 6: Moni und Lilli und
+    gate 7: Moni und Lilli und Manu
+
+Every recording 'NAME.wav' needs a TextGrid 'NAME.TextGrid' in the same folder. The segments are annotated on tier 3:
+all gates start at the start of interval 2, gate 1 ends at the end of interval 3 and gate 7 ends at the start of the
+last interval. Gates 2 to 6 end at the intervals labelled 's4', 'c1', 's6', 's8' and 'c2', or at the end of the
+following pause ('p1' to 'p4') if there is one.
+
+The gates are slices of the decoded recording, so no audio is re-encoded. They can either be written as
+'NAME_gN.wav' files in batch, or generated on demand in memory by a GateGenerator, which is a stimulus source for the
+stimulus bank (see gating_stimulus_bank.py) and does not need the gated folders to exist. The generator keeps the
+recordings it has decoded, as long as the memory cap of the stimulus bank leaves room for them.
+
+Usage:
+    python gating_gates.py stimuli/ungated/test stimuli/gated/test --gates 2 3 4 5 7
+
+Functions:
+    - read_textgrid: Reads the tiers of a Praat TextGrid file.
+    - gate_boundaries: Computes the start and end time of every gate from the segment tier.
+    - cut_gates: Slices a recording into gates.
+    - gate_filename: Returns the filename of a gate of a recording.
+    - list_recordings: Lists the recordings of a folder that have a TextGrid.
+    - cut_recording: Reads a recording and its TextGrid and cuts it into gates.
+    - write_gates: Writes the gates of all recordings in a folder as WAV files.
+
+Classes:
+    - GateGenerator: A stimulus source generating gates on demand from the ungated recordings.
+"""
+
+import os
+import re
+import math
+import argparse
+import threading
+from collections import OrderedDict
+import numpy as np
+from gating_audio import read_wav, write_wav
+
+# The segment tier of the TextGrids (1-based, as in Praat)
+SEGMENT_TIER = 3
+
+# All gates a recording is cut into
+ALL_GATES = (1, 2, 3, 4, 5, 6, 7)
+
+# Gates 2 to 6 end at these labels, or at the end of the following pause
+GATE_END_LABELS = {2: ('s4', 'p1'), 3: ('c1', 'p2'), 5: ('s8', 'p3'), 6: ('c2', 'p4')}
+
+_TOKEN = re.compile(r'"((?:[^"]|"")*)"|(<exists>|<absent>)|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+_ITEM_HEADER = re.compile(r'^\s*\w+\s*\[\d*\]\s*:?\s*$')
+
+
+def _decode_textgrid(raw):
+    """Decode the bytes of a TextGrid file, which Praat writes as UTF-8 or UTF-16."""
+    if raw.startswith((b'\xff\xfe', b'\xfe\xff')):
+        return raw.decode('utf-16')
+    try:
+        return raw.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+
+def read_textgrid(filepath):
+    """
+    Read the tiers of a Praat TextGrid file (long or short text format).
+
+    Parameters:
+    filepath (str): Path to the TextGrid file.
+
+    Returns:
+    list of dict: One dict per tier with the keys 'class', 'name' and 'intervals'. For interval tiers 'intervals' is a
+    list of (start, end, label) tuples, for point tiers a list of (time, time, label) tuples.
+    """
+    with open(filepath, 'rb') as textgrid_file:
+        text = _decode_textgrid(textgrid_file.read())
+
+    # Both formats contain the same values in the same order; the long format adds 'key =' prefixes and item headers
+    values = []
+    for line in text.splitlines():
+        if '=' in line:
+            line = line.split('=', 1)[1]
+        elif _ITEM_HEADER.match(line):
+            continue
+        for quoted, flag, number in _TOKEN.findall(line):
+            if flag:
+                values.append(flag)
+            elif number:
+                values.append(float(number))
+            else:
+                values.append(quoted.replace('""', '"'))
+
+    # Header: file type, object class, xmin, xmax, <exists>, number of tiers
+    position = 6
+    tiers = []
+    for _ in range(int(values[5])):
+        tier_class, tier_name, n_items = values[position], values[position + 1], int(values[position + 4])
+        position += 5
+        items = []
+        for _ in range(n_items):
+            if tier_class == 'IntervalTier':
+                items.append((values[position], values[position + 1], values[position + 2]))
+                position += 3
+            else:
+                items.append((values[position], values[position], values[position + 1]))
+                position += 2
+        tiers.append({'class': tier_class, 'name': tier_name, 'intervals': items})
+    return tiers
+
+
+def gate_boundaries(intervals):
+    """
+    Compute the start and end time of every gate from the intervals of the segment tier.
+
+    Parameters:
+    intervals (list): The (start, end, label) tuples of the segment tier.
+
+    Returns:
+    dict: Gate number -> (start, end) in seconds. Gates whose labels are missing are left out.
+    """
+    # Praat numbers intervals from 1, so interval i is intervals[i - 1]
+    n_intervals = len(intervals)
+    start = intervals[1][0]
+    ends = {1: intervals[2][1], 7: intervals[n_intervals - 1][0]}
+
+    for j in range(5, n_intervals):
+        label = intervals[j - 1][2]
+        next_label = intervals[j][2]
+
+        for gate, (segment_label, pause_label) in GATE_END_LABELS.items():
+            if next_label == pause_label:
+                # A pause after the segment belongs to the gate
+                ends[gate] = intervals[j][1]
+            elif label == segment_label:
+                ends[gate] = intervals[j - 1][1]
+
+        if label == 's6':
+            ends[4] = intervals[j - 1][1]
+
+    return {gate: (start, end) for gate, end in sorted(ends.items())}
+
+
+def cut_gates(samples, sample_rate, boundaries, gates=ALL_GATES):
+    """
+    Slice a recording into gates. The gates are views of the recording, no samples are copied.
+
+    As Praat's 'Extract part', a gate contains all samples whose centre lies between the start and end time.
+
+    Parameters:
+    samples (numpy.ndarray): The samples of the recording.
+    sample_rate (int): The sample rate of the recording in Hz.
+    boundaries (dict): Gate number -> (start, end), as returned by gate_boundaries().
+    gates (tuple, optional): The gates to cut. Defaults to all gates.
+
+    Returns:
+    dict: Gate number -> sample array.
+    """
+    cut = {}
+    for gate in gates:
+        if gate not in boundaries:
+            continue
+        start, end = boundaries[gate]
+        first = max(math.ceil(start * sample_rate - 0.5), 0)
+        last = math.floor(end * sample_rate - 0.5) + 1
+        cut[gate] = samples[first:last]
+    return cut
+
+
+def gate_filename(recording_name, gate):
+    """Return the filename of a gate of a recording, e.g. '06_C01_b1_t01_manni_bra_g2.wav'."""
+    return f"{recording_name}_g{gate}.wav"
+
+
+def list_recordings(ungated_path):
+    """Return the names (without extension) of all recordings in a folder that have a TextGrid."""
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(ungated_path)
+                  if f.endswith('.wav') and os.path.exists(os.path.join(ungated_path, os.path.splitext(f)[0] +
+                                                                        '.TextGrid')))
+
+
+def _base_nbytes(samples):
+    """Return the size of the array a view of samples belongs to, i.e. the memory the view keeps alive."""
+    while isinstance(samples.base, np.ndarray):
+        samples = samples.base
+    return samples.nbytes
+
+
+def cut_recording(ungated_path, recording_name, gates, tier):
+    """Read a recording and its TextGrid and return the gates and the sample rate."""
+    samples, sample_rate = read_wav(os.path.join(ungated_path, recording_name + '.wav'))
+    tiers = read_textgrid(os.path.join(ungated_path, recording_name + '.TextGrid'))
+    boundaries = gate_boundaries(tiers[tier - 1]['intervals'])
+    return cut_gates(samples, sample_rate, boundaries, gates), sample_rate
+
+
+def write_gates(ungated_path, gated_path, gates=ALL_GATES, tier=SEGMENT_TIER):
+    """
+    Write the gates of all recordings in a folder as 'NAME_gN.wav' files.
+
+    Parameters:
+    ungated_path (str): The folder containing the recordings and their TextGrids.
+    gated_path (str): The folder to write the gates to. It is created if it doesn't exist.
+    gates (tuple, optional): The gates to write. Defaults to all gates.
+    tier (int, optional): The segment tier of the TextGrids (1-based). Defaults to 3.
+
+    Returns:
+    list: The filenames of the written gates.
+    """
+    os.makedirs(gated_path, exist_ok=True)
+
+    written = []
+    for recording_name in list_recordings(ungated_path):
+        cut, sample_rate = cut_recording(ungated_path, recording_name, gates, tier)
+        for gate, gate_samples in cut.items():
+            write_wav(os.path.join(gated_path, gate_filename(recording_name, gate)), gate_samples, sample_rate)
+            written.append(gate_filename(recording_name, gate))
+        print(f"sound {recording_name} processed")
+    return written
+
+
+class GateGenerator:
+    """
+    A stimulus source generating the gates of the ungated recordings on demand, in memory.
+
+    The decoded recordings are kept, so a recording is decoded and its TextGrid read only once while its gates are
+    loaded. The memory they may occupy is capped; the least recently used recordings are dropped first and decoded
+    again when one of their gates is loaded. The stimulus bank sets the cap to the memory its own buffers leave free
+    (see set_memory_limit()). The generator can be used by several threads.
+
+    Parameters:
+    ungated_path (str): The folder containing the recordings and their TextGrids.
+    gates (tuple, optional): The gates that are presented. Defaults to all gates.
+    tier (int, optional): The segment tier of the TextGrids (1-based). Defaults to 3.
+    memory_limit_mb (float, optional): The maximum memory the decoded recordings may occupy, in megabytes. Defaults to
+        None (no limit).
+    """
+
+    def __init__(self, ungated_path, gates=ALL_GATES, tier=SEGMENT_TIER, memory_limit_mb=None):
+        self.ungated_path = ungated_path
+        self.gates = tuple(gates)
+        self.tier = tier
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024) if memory_limit_mb is not None else None
+        self.memory_used = 0
+        self._recordings = OrderedDict()  # recording name -> (gates, sample rate, bytes), least recently used first
+        self._lock = threading.Lock()
+
+    def set_memory_limit(self, memory_limit):
+        """
+        Set the maximum memory the decoded recordings may occupy and drop the recordings that exceed it.
+
+        Parameters:
+        memory_limit (int): The limit in bytes, or None for no limit. The recording used last is always kept.
+        """
+        with self._lock:
+            self.memory_limit = memory_limit
+            self._evict()
+
+    def _evict(self):
+        """Drop the least recently used recordings until the memory cap is respected."""
+        while self.memory_limit is not None and self.memory_used > self.memory_limit and len(self._recordings) > 1:
+            _, (_, _, nbytes) = self._recordings.popitem(last=False)
+            self.memory_used -= nbytes
+
+    def list_files(self):
+        """Return the filenames of all gates of all recordings, as they would be named in the gated folders."""
+        return [gate_filename(recording_name, gate)
+                for recording_name in list_recordings(self.ungated_path)
+                for gate in self.gates]
+
+    def load(self, stimulus_file):
+        """
+        Return the samples of a gate, e.g. '06_C01_b1_t01_manni_bra_g2.wav'.
+
+        Parameters:
+        stimulus_file (str): The filename of the gate.
+
+        Returns:
+        numpy.ndarray: The samples of the gate, a copy that doesn't keep the recording in memory.
+        int: The sample rate in Hz.
+        """
+        recording_name, gate = stimulus_file[:-len('_gN.wav')], int(stimulus_file[-5])
+        with self._lock:
+            recording = self._recordings.get(recording_name)
+            if recording is None:
+                cut, sample_rate = cut_recording(self.ungated_path, recording_name, ALL_GATES, self.tier)
+                recording = cut, sample_rate, _base_nbytes(cut[ALL_GATES[-1]])
+                self._recordings[recording_name] = recording
+                self.memory_used += recording[2]
+            self._recordings.move_to_end(recording_name)
+            self._evict()
+            cut, sample_rate, _ = recording
+            return cut[gate].copy(), sample_rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cut the ungated recordings into gates.')
+    parser.add_argument('ungated_path', help='folder containing the recordings and their TextGrids')
+    parser.add_argument('gated_path', help='folder to write the gates to')
+    parser.add_argument('--gates', type=int, nargs='+', default=list(ALL_GATES), help='gates to write')
+    parser.add_argument('--tier', type=int, default=SEGMENT_TIER, help='segment tier of the TextGrids (1-based)')
+    args = parser.parse_args()
+
+    print(f"{len(write_gates(args.ungated_path, args.gated_path, args.gates, args.tier))} gates written")
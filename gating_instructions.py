@@ -17,6 +17,14 @@ test: A string displayed after practice trials. It indicates the beginning of
 
 end: A string displayed at the end of the experiment, signalling its completion.
 
+resume: A string displayed when an interrupted session is continued.
+
+block_break: A template displayed after every block of the test phase; {block} is
+             the block that has ended and {remaining} the number of blocks left.
+
+correct_feedback, incorrect_feedback: The feedback displayed after every practice
+                                      trial.
+
 Usage:
 ----------
 These strings are typically displayed in a psychopy.visual.Window object using
@@ -53,7 +61,18 @@ Sie können nach jedem Block eine Pause machen, wenn Sie das wünschen. \n
 Drücken Sie die Eingabetaste (Enter), um mit dem Experiment zu starten.
 """
 
+resume = """
+Das Experiment wird an der Stelle fortgesetzt, an der es unterbrochen wurde. \n
+Drücken Sie die Eingabetaste (Enter), um weiterzumachen.
+"""
+
 end = """
 Geschafft!\n
 Drücken Sie die Eingabetaste (Enter), um das Experiment zu beenden.
 """
+
+block_break = "Block {block} geschafft - noch {remaining} Block(s) übrig. \n Sie können eine Pause machen, wenn Sie dies wünschen. Drücken Sie die Eingabetaste (Enter), um weiterzumachen."
+
+# Feedback
+correct_feedback = "Richtig!"
+incorrect_feedback = "Falsch!"
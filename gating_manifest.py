@@ -0,0 +1,304 @@
+"""
+gating_manifest.py
+
+This module contains the stimulus manifest: the typed metadata of all stimuli of a stimulus directory, built once and
+persisted to disk.
+
+The metadata used to be parsed from fixed offsets of the filenames every time a stimulus was randomized or presented,
+and the duration was taken from the live sound object. The manifest parses every filename once, validates it against
+the expected 'NN_C01_b1_tXX_name_cond_gN.wav' pattern and reads the WAV header, so durations are known without
+decoding any audio.
+
+The manifest of a WAV directory is saved next to the directory, like its packed container ('stimuli/gated/test' ->
+'stimuli/gated/test.manifest.json'). It is not saved inside the directory, because that would change the modification
+time of the directory, by which an outdated container is recognized (see open_stimulus_source()). When it is loaded
+again, only files whose modification time or size changed are re-read; records of removed files are dropped.
+Manifests of the other stimulus sources are built by decoding every stimulus, so they are saved too: the manifest of a
+packed container next to the container ('stimuli/gated/test.gpak.manifest.json'), the manifest of generated gates next
+to the ungated folder ('stimuli/ungated/test.manifest.json'). They are stored with the modification times and sizes of
+the files they were built from (the container, or the recordings and TextGrids) and built again only if one of these
+changed.
+
+Records behave like the dicts returned by get_stimulus_data(), so they can be used wherever those were used; the gate
+is an int instead of a string.
+
+Functions:
+    - parse_stimulus_filename: Parses and validates the metadata of a stimulus filename.
+    - manifest_path_for: Returns the path of the manifest of a stimulus directory.
+    - source_manifest_path: Returns the path of the manifest of a packed container or of generated gates.
+    - load_manifest: Loads the manifest of a stimulus directory, updating it incrementally.
+
+Classes:
+    - StimulusRecord: The metadata of one stimulus.
+    - StimulusManifest: The records of all stimuli of a directory.
+"""
+
+import os
+import re
+import json
+import wave
+import hashlib
+from gating_stimulus_bank import WavDirectory
+from gating_stimulus_pack import StimulusContainer
+from gating_gates import GateGenerator, list_recordings
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+
+_STIMULUS_FILENAME = re.compile(r'^(?P<item>(?P<speaker>\d{2})_C\d{2}_b\d_t\d{2}_(?P<name_stim>.{5})_'
+                                r'(?P<condition>bra|nob))_g(?P<gate>[1-7])\.wav$')
+
+
+def manifest_path_for(stimuli_path):
+    """
+    Return the path of the manifest of a stimulus directory ('stimuli/gated/test/' ->
+    'stimuli/gated/test.manifest.json').
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus directory.
+
+    Returns:
+    str: The path of the manifest file.
+    """
+    return os.path.normpath(stimuli_path) + MANIFEST_SUFFIX
+
+
+def source_manifest_path(source):
+    """
+    Return the path of the manifest of a stimulus source that is not a WAV directory ('stimuli/gated/test.gpak' ->
+    'stimuli/gated/test.gpak.manifest.json', generated from 'stimuli/ungated/test/' ->
+    'stimuli/ungated/test.manifest.json').
+
+    Parameters:
+    source (StimulusContainer or GateGenerator): The stimulus source.
+
+    Returns:
+    str: The path of the manifest file, or None for other sources.
+    """
+    if isinstance(source, StimulusContainer):
+        return source.container_path + MANIFEST_SUFFIX
+    if isinstance(source, GateGenerator):
+        return manifest_path_for(source.ungated_path)
+    return None
+
+
+def _source_key(source):
+    """
+    Return the modification times and sizes of the files a stimulus source reads, and for generated gates the gates and
+    the segment tier, as a JSON compatible list. A saved manifest is valid as long as the key of its source is the same.
+    """
+    if isinstance(source, StimulusContainer):
+        paths = [source.container_path]
+        key = []
+    else:
+        paths = [os.path.join(source.ungated_path, recording_name + extension)
+                 for recording_name in list_recordings(source.ungated_path) for extension in ('.wav', '.TextGrid')]
+        key = [list(source.gates), source.tier]
+    for path in paths:
+        stat = os.stat(path)
+        key.append([os.path.basename(path), stat.st_mtime_ns, stat.st_size])
+    return key
+
+
+def parse_stimulus_filename(stimulus_file):
+    """
+    Parse the metadata of a stimulus filename such as '06_C01_b1_t01_manni_bra_g2.wav'.
+
+    Parameters:
+    stimulus_file (str): Name of the stimulus file.
+
+    Returns:
+    dict: The keys 'item' (the recording, e.g. '06_C01_b1_t01_manni_bra'), 'speaker', 'name_stim', 'condition' and
+    'gate' (int).
+
+    Raises:
+    ValueError: If the filename doesn't follow the naming scheme.
+    """
+    match = _STIMULUS_FILENAME.match(stimulus_file)
+    if match is None:
+        raise ValueError(f"'{stimulus_file}' doesn't follow the 'NN_C01_b1_tXX_name_cond_gN.wav' naming scheme")
+    metadata = match.groupdict()
+    metadata['gate'] = int(metadata['gate'])
+    return metadata
+
+
+class StimulusRecord:
+    """
+    The metadata of one stimulus. Records can be indexed like the dicts of get_stimulus_data().
+    """
+
+    __slots__ = ('filename', 'speaker', 'gate', 'item', 'name_stim', 'condition', 'duration', 'sample_rate', 'frames',
+                 'content_hash', 'mtime_ns', 'size')
+
+    def __init__(self, filename, speaker, gate, item, name_stim, condition, duration, sample_rate, frames,
+                 content_hash, mtime_ns=0, size=0):
+        self.filename = filename
+        self.speaker = speaker
+        self.gate = gate
+        self.item = item
+        self.name_stim = name_stim
+        self.condition = condition
+        self.duration = duration
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self.content_hash = content_hash
+        self.mtime_ns = mtime_ns
+        self.size = size
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"StimulusRecord({self.filename!r}, gate={self.gate}, duration={self.duration:.3f})"
+
+    def to_json(self):
+        """Return the record as a list of its fields, in the order of __slots__."""
+        return [getattr(self, field) for field in self.__slots__]
+
+
+def _record(stimulus_file, frames, sample_rate, content_hash, mtime_ns=0, size=0):
+    """Create a validated record from a filename and the audio properties of the file."""
+    metadata = parse_stimulus_filename(stimulus_file)
+    if frames <= 0 or sample_rate <= 0:
+        raise ValueError(f"'{stimulus_file}' contains no audio")
+    return StimulusRecord(stimulus_file, metadata['speaker'], metadata['gate'], metadata['item'],
+                          metadata['name_stim'], metadata['condition'], frames / sample_rate, sample_rate, frames,
+                          content_hash, mtime_ns, size)
+
+
+def _read_wav_file_record(stimuli_path, stimulus_file, stat):
+    """Read the header and hash the content of a WAV file and create its record."""
+    filepath = os.path.join(stimuli_path, stimulus_file)
+    with wave.open(filepath, 'rb') as wav_file:
+        frames, sample_rate = wav_file.getnframes(), wav_file.getframerate()
+    with open(filepath, 'rb') as stimulus:
+        content_hash = hashlib.sha256(stimulus.read()).hexdigest()
+    return _record(stimulus_file, frames, sample_rate, content_hash, stat.st_mtime_ns, stat.st_size)
+
+
+class StimulusManifest:
+    """
+    The records of all stimuli of a stimulus directory, by filename.
+
+    Parameters:
+    records (iterable of StimulusRecord): The records.
+    source_key (list, optional): The modification times and sizes of the files of the stimulus source the manifest was
+        built from, for sources that are not WAV directories. Defaults to None.
+    """
+
+    def __init__(self, records=(), source_key=None):
+        self.records = {record.filename: record for record in records}
+        self.source_key = source_key
+
+    def __getitem__(self, stimulus_file):
+        return self.records[stimulus_file]
+
+    def __contains__(self, stimulus_file):
+        return stimulus_file in self.records
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
+
+    def filenames(self):
+        """Return the filenames of all stimuli."""
+        return list(self.records)
+
+    def save(self, filepath):
+        """
+        Save the manifest as JSON, atomically.
+
+        Parameters:
+        filepath (str): The path of the manifest file.
+        """
+        with open(filepath + '.tmp', 'w') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'fields': list(StimulusRecord.__slots__),
+                       'source': self.source_key,
+                       'records': [record.to_json() for record in self.records.values()]}, manifest_file)
+        os.replace(filepath + '.tmp', filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load a manifest saved by save().
+
+        Parameters:
+        filepath (str): The path of the manifest file.
+
+        Returns:
+        StimulusManifest: The manifest, empty if the file doesn't exist or has another version.
+        """
+        try:
+            with open(filepath) as manifest_file:
+                content = json.load(manifest_file)
+        except (OSError, ValueError):
+            return cls()
+        if content.get('version') != MANIFEST_VERSION or content.get('fields') != list(StimulusRecord.__slots__):
+            return cls()
+        return cls((StimulusRecord(*fields) for fields in content['records']), content.get('source'))
+
+
+def load_manifest(stimuli_path, source=None):
+    """
+    Load the manifest of a stimulus directory and bring it up to date.
+
+    For a WAV directory the saved manifest is reused: only new files and files whose modification time or size
+    changed are read again, and the manifest is saved if anything changed. For packed containers and generated gates
+    the saved manifest of the source is reused if none of the files it was built from changed; otherwise it is built
+    by decoding every stimulus and saved.
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus directory.
+    source (optional): The stimulus source of the directory. Defaults to the loose WAV files of the directory.
+
+    Returns:
+    StimulusManifest: The manifest.
+
+    Raises:
+    ValueError: If a stimulus filename doesn't follow the naming scheme or a file contains no audio.
+    """
+    if source is not None and not isinstance(source, WavDirectory):
+        manifest_path = source_manifest_path(source)
+        source_key = _source_key(source) if manifest_path is not None else None
+        if manifest_path is not None:
+            saved = StimulusManifest.load(manifest_path)
+            if saved.source_key == source_key and len(saved):
+                return saved
+
+        records = []
+        for stimulus_file in source.list_files():
+            samples, sample_rate = source.load(stimulus_file)
+            records.append(_record(stimulus_file, len(samples), sample_rate,
+                                   hashlib.sha256(samples.tobytes()).hexdigest()))
+        manifest = StimulusManifest(records, source_key)
+        if manifest_path is not None:
+            _save(manifest, manifest_path)
+        return manifest
+
+    manifest_path = manifest_path_for(stimuli_path)
+    saved = StimulusManifest.load(manifest_path)
+
+    records = []
+    changed = False
+    for stimulus_file in sorted(f for f in os.listdir(stimuli_path) if f.endswith('.wav')):
+        stat = os.stat(os.path.join(stimuli_path, stimulus_file))
+        record = saved.records.get(stimulus_file)
+        if record is None or record.mtime_ns != stat.st_mtime_ns or record.size != stat.st_size:
+            record = _read_wav_file_record(stimuli_path, stimulus_file, stat)
+            changed = True
+        records.append(record)
+
+    manifest = StimulusManifest(records)
+    if changed or len(manifest) != len(saved):
+        _save(manifest, manifest_path)
+    return manifest
+
+
+def _save(manifest, manifest_path):
+    """Save a manifest, warning instead of failing if the folder is read-only."""
+    try:
+        manifest.save(manifest_path)
+    except OSError as error:
+        print(f"Warning: the stimulus manifest could not be saved to {manifest_path}: {error}")
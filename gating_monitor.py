@@ -0,0 +1,206 @@
+"""
+gating_monitor.py
+
+This module contains the live monitor of the gating experiment.
+
+While a session runs, the experimenter used to see nothing of the results until the CSV file was opened afterwards.
+run_trial_phase() now publishes every trial as one small UDP datagram to the monitor port on this computer
+(monitor_host and monitor_port in gating_configuration.py): the subject, the phase, the trial, the block, the gate,
+the accuracy, the reaction time and the timing error of the trial. The timing error is the largest error of the flips
+of the trial in scheduled mode (see gating_timeline.py), otherwise the time the trial took beyond its nominal duration
+(fixation, sound, 500 ms, reaction time and 1 s pause).
+
+Publishing packs the trial into a fixed 45-byte struct and hands it to a non-blocking socket, a few microseconds per
+trial. Nothing is sent back: if no viewer is running, or the viewer doesn't keep up, the datagram is dropped and the
+experiment doesn't notice.
+
+The viewer runs in a separate terminal, on the same computer or on another one if monitor_host is set to its address.
+For every trial it prints a line with the trial and the running accuracy per gate, and it reports a stall if no trial
+arrived for a while:
+
+Usage:
+    python gating_monitor.py
+    python gating_monitor.py --port 5556 --stall 20
+
+Functions:
+    - pack_trial: Packs a trial into a datagram.
+    - unpack_trial: Unpacks a datagram.
+    - run_viewer: Receives the trials and prints the running accuracy per gate.
+
+Classes:
+    - MonitorPublisher: Publishes the trials of a phase to the viewer.
+"""
+
+import math
+import time
+import socket
+import struct
+import argparse
+
+MAGIC = b'GTM1'
+PHASES = ('practice', 'test')
+# magic, subject, phase, trial, block, gate, accuracy, reaction time (s), timing error (ms), time.time()
+TRIAL_STRUCT = struct.Struct('<4s16sBIHBBffd')
+TRIAL_FIELDS = ('subject', 'phase', 'trial', 'block', 'gate', 'accuracy', 'reaction_time', 'timing_error_ms', 'time')
+
+
+def pack_trial(subject, phase, trial, block, gate, accuracy, reaction_time, timing_error_ms, timestamp=None):
+    """
+    Pack a trial into a datagram.
+
+    Parameters:
+    subject (str): The subject ID (at most 16 bytes are sent).
+    phase (str): The phase ('practice', 'test').
+    trial (int): The trial number.
+    block (int): The block number.
+    gate (int): The gate of the stimulus.
+    accuracy (int): 1 if the response was correct, else 0.
+    reaction_time (float): The reaction time in seconds, NaN if the trial timed out.
+    timing_error_ms (float): The timing error of the trial in milliseconds, NaN if unknown.
+    timestamp (float, optional): The time of the trial as a time.time() value. Defaults to now.
+
+    Returns:
+    bytes: The datagram.
+    """
+    return TRIAL_STRUCT.pack(MAGIC, subject.encode('utf-8')[:16], PHASES.index(phase), trial, block, int(gate),
+                             accuracy, reaction_time, timing_error_ms, time.time() if timestamp is None else timestamp)
+
+
+def unpack_trial(datagram):
+    """
+    Unpack a datagram.
+
+    Parameters:
+    datagram (bytes): The datagram, as returned by pack_trial().
+
+    Returns:
+    dict: The trial (see TRIAL_FIELDS).
+
+    Raises:
+    ValueError: If the datagram is not a trial of the gating experiment.
+    """
+    if len(datagram) != TRIAL_STRUCT.size or not datagram.startswith(MAGIC):
+        raise ValueError("Not a trial of the gating experiment")
+    values = TRIAL_STRUCT.unpack(datagram)[1:]
+    trial = dict(zip(TRIAL_FIELDS, values))
+    trial['subject'] = trial['subject'].rstrip(b'\0').decode('utf-8', 'replace')
+    trial['phase'] = PHASES[trial['phase']] if trial['phase'] < len(PHASES) else '?'
+    return trial
+
+
+class MonitorPublisher:
+    """
+    Publishes the trials of a phase to the viewer. Never blocks: a datagram that can't be sent is dropped.
+
+    Parameters:
+    address (tuple): The (host, port) of the viewer.
+    subject (str): The subject ID.
+    phase (str): The phase ('practice', 'test').
+    """
+
+    def __init__(self, address, subject, phase):
+        self.address = address
+        self.subject = subject
+        self.phase = phase
+        self.published = 0
+        self.dropped = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def publish(self, trial, block, gate, accuracy, reaction_time, timing_error_ms):
+        """
+        Publish a trial.
+
+        Parameters:
+        trial (int): The trial number.
+        block (int): The block number.
+        gate (int): The gate of the stimulus.
+        accuracy (int): 1 if the response was correct, else 0.
+        reaction_time (float): The reaction time in seconds, NaN if the trial timed out.
+        timing_error_ms (float): The timing error of the trial in milliseconds, NaN if unknown.
+        """
+        try:
+            self._socket.sendto(pack_trial(self.subject, self.phase, trial, block, gate, accuracy, reaction_time,
+                                           timing_error_ms), self.address)
+            self.published += 1
+        except OSError:
+            # No route, full socket buffer, ...: the monitor must never hold up the experiment
+            self.dropped += 1
+
+    def close(self):
+        """Close the socket."""
+        self._socket.close()
+
+    def metrics(self):
+        """
+        Return the metrics of the publisher.
+
+        Returns:
+        dict: The number of published and dropped trials.
+        """
+        return {'published': self.published, 'dropped': self.dropped}
+
+
+def _format_accuracy(by_gate):
+    return '  '.join(f"g{gate} {correct / n:.2f} ({n})" for gate, (correct, n) in sorted(by_gate.items()))
+
+
+def run_viewer(port=5556, stall_timeout=20.0, host='0.0.0.0'):
+    """
+    Receive the trials and print the running accuracy per gate until interrupted.
+
+    The accuracy is kept per subject and phase; a new session is recognized by its subject or phase.
+
+    Parameters:
+    port (int, optional): The port to listen on. Defaults to 5556.
+    stall_timeout (float, optional): The time in seconds without a trial after which a stall is reported. Defaults
+        to 20.
+    host (str, optional): The address to listen on. Defaults to all addresses.
+    """
+    viewer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    viewer_socket.bind((host, port))
+    viewer_socket.settimeout(1.0)
+    print(f"Waiting for trials on port {port} (Ctrl+C to stop)")
+
+    sessions = {}  # (subject, phase) -> gate -> [correct, n]
+    last_trial = None  # time.monotonic() of the last trial
+    stalled = False
+    try:
+        while True:
+            try:
+                datagram, _ = viewer_socket.recvfrom(TRIAL_STRUCT.size + 1)
+            except socket.timeout:
+                if last_trial is not None and not stalled and time.monotonic() - last_trial > stall_timeout:
+                    print(f"STALL: no trial for {stall_timeout:.0f} s")
+                    stalled = True
+                continue
+            try:
+                trial = unpack_trial(datagram)
+            except ValueError:
+                continue
+            if stalled:
+                print(f"Resumed after {time.monotonic() - last_trial:.0f} s")
+                stalled = False
+            last_trial = time.monotonic()
+
+            by_gate = sessions.setdefault((trial['subject'], trial['phase']), {})
+            counts = by_gate.setdefault(trial['gate'], [0, 0])
+            counts[0] += trial['accuracy']
+            counts[1] += 1
+            reaction_time = 'timeout' if math.isnan(trial['reaction_time']) else f"{trial['reaction_time']:.3f} s"
+            timing_error = '-' if math.isnan(trial['timing_error_ms']) else f"{trial['timing_error_ms']:.1f} ms"
+            print(f"{trial['subject']} {trial['phase']} trial {trial['trial']:>3} block {trial['block']} "
+                  f"gate {trial['gate']} {'correct' if trial['accuracy'] else 'wrong  '} rt {reaction_time:>8} "
+                  f"timing {timing_error:>8} | {_format_accuracy(by_gate)}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        viewer_socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the trials of a running gating experiment.')
+    parser.add_argument('--port', type=int, default=5556, help='port to listen on (monitor_port)')
+    parser.add_argument('--stall', type=float, default=20.0, help='seconds without a trial until a stall is reported')
+    args = parser.parse_args()
+    run_viewer(args.port, args.stall)
@@ -1,18 +1,29 @@
 import os
+from gating_stimulus_pack import container_path_for
 
 
-def check_config_paths(test_stimuli_path, practice_stimuli_path, results_path, pics_path, random_path):
+def check_config_paths(test_stimuli_path, practice_stimuli_path, results_path, pics_path, random_path,
+                       ungated_test_path=None, ungated_practice_path=None):
     """
         Function checks the existence of specific directories and raises
         exceptions with appropriate error messages if any of the directories are not found.
+        A packed stimulus container can stand in for a stimulus directory.
+        If the gates are generated, the ungated folders are checked instead of the stimulus directories.
     """
-    # Check if the input directory for test stimuli exists
-    if not os.path.exists(test_stimuli_path):
+    if ungated_test_path is not None:
+        # Check if the ungated recordings exist, the gated folders are not needed
+        for ungated_path, name in [(ungated_test_path, 'ungated_test_path'),
+                                   (ungated_practice_path, 'ungated_practice_path')]:
+            if not os.path.exists(ungated_path):
+                raise Exception("No ungated recordings detected. Please make sure that "
+                                f"'{name}' is correctly set in the configurations")
+    # Check if the input directory (or its packed container) for test stimuli exists
+    elif not os.path.exists(test_stimuli_path) and not os.path.exists(container_path_for(test_stimuli_path)):
         # Raise exception if not
         raise Exception("No input folder detected. Please make sure that "
                         "'test_stimuli_path' is correctly set in the configurations")
-    # Check if the input directory for test stimuli exists
-    if not os.path.exists(practice_stimuli_path):
+    # Check if the input directory (or its packed container) for practice stimuli exists
+    elif not os.path.exists(practice_stimuli_path) and not os.path.exists(container_path_for(practice_stimuli_path)):
         # Raise exception if not
         raise Exception("No input folder detected. Please make sure that "
                         "'practice_stimuli_path' is correctly set in the configurations")
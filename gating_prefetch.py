@@ -0,0 +1,200 @@
+"""
+gating_prefetch.py
+
+This module contains the stimulus prefetcher of the gating experiment.
+
+A stimulus bank that can't hold a whole phase (or one that is not preloaded, see preload_stimuli in
+gating_configuration.py) loads the remaining stimuli from disk between two trials. The prefetcher knows the randomized
+order of the phase and decodes the next stimuli on a worker thread ahead of the trial loop, so no trial waits for the
+disk:
+
+    - Only a window of the next k stimuli (prefetch_window in gating_configuration.py) is decoded ahead; a stimulus is
+      handed over to the trial loop and dropped by the prefetcher when its trial starts, so the memory stays flat.
+      Stimuli that are in the bank already are not decoded again.
+    - If the worker fails to decode a stimulus, it logs a warning and goes on with the next one; the trial loop then
+      decodes that stimulus itself, so an error is raised on the main thread instead of freezing the trial.
+    - The worker only decodes while the trial loop is idle: during instruction screens and block breaks and in the
+      pause after a response (see idle()), so the decoding never competes with the timing of a trial.
+
+The prefetcher has the interface of the stimulus bank used by the trial loop (get(), sample_rate and
+save_load_times()). It counts the stimuli that were ready (hits), those whose decoding had to be waited for (waits) and
+those that had to be loaded in the trial loop (misses); the counters are written to the session log at the end of a
+phase.
+
+Classes:
+    - StimulusPrefetcher: Decodes the upcoming stimuli of a phase on a worker thread.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from gating_audio import resample
+
+
+class StimulusPrefetcher:
+    """
+    Decodes the upcoming stimuli of a phase on a worker thread during the idle periods of the trial loop.
+
+    Parameters:
+    bank (StimulusBank): The stimulus bank of the phase. Stimuli it holds are taken from it.
+    window (int, optional): The number of upcoming stimuli decoded ahead. Defaults to 8.
+    """
+
+    def __init__(self, bank, window=8):
+        self.bank = bank
+        self.window = window
+        self.sample_rate = bank.sample_rate
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+        self.load_times = {}  # filename -> seconds needed to decode the file
+        self._order = []
+        self._position = 0
+        self._buffers = {}
+        self._loading = None
+        self._failed = {}  # filename -> the exception the worker got decoding it
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._idle = threading.Event()
+        self._thread = None
+
+    def start(self, stimuli_files):
+        """
+        Start prefetching a phase. Calling it again with a new order (e.g. after resuming) restarts at its beginning.
+
+        Parameters:
+        stimuli_files (list): The randomized list of stimulus filenames of the phase.
+        """
+        with self._condition:
+            if list(stimuli_files) == self._order:
+                return
+            self._order = list(stimuli_files)
+            self._position = 0
+            upcoming = set(self._order[:self.window])
+            self._buffers = {f: samples for f, samples in self._buffers.items() if f in upcoming}
+            self._condition.notify_all()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='StimulusPrefetcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the worker thread and drop the decoded stimuli."""
+        with self._condition:
+            self._stopped = True
+            self._buffers = {}
+            self._condition.notify_all()
+        self._idle.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def idle(self):
+        """A context in which the trial loop is idle and the worker may decode stimuli."""
+        self._idle.set()
+        try:
+            yield
+        finally:
+            self._idle.clear()
+
+    def _next_file(self):
+        """Return the first stimulus of the window that is neither decoded nor in the bank, or None."""
+        for stimulus_file in self._order[self._position:self._position + self.window]:
+            if stimulus_file not in self._buffers and stimulus_file not in self.bank and \
+                    stimulus_file not in self._failed:
+                return stimulus_file
+        return None
+
+    def _decode(self, stimulus_file):
+        """Decode a stimulus at the bank's sample rate and record the time it took."""
+        load_start = time.perf_counter()
+        samples, file_rate = self.bank.source.load(stimulus_file)
+        samples = resample(samples, file_rate, self.sample_rate)
+        self.load_times[stimulus_file] = time.perf_counter() - load_start
+        return samples
+
+    def _run(self):
+        """The worker thread: decode the stimuli of the window while the trial loop is idle."""
+        while True:
+            self._idle.wait()
+            with self._condition:
+                if self._stopped:
+                    return
+                stimulus_file = self._next_file()
+                if stimulus_file is None:
+                    # Wait until a trial starts or the order changes
+                    self._condition.wait()
+                    continue
+                self._loading = stimulus_file
+
+            samples = None
+            try:
+                samples = self._decode(stimulus_file)
+            except Exception as error:
+                # The trial loop decodes the stimulus itself, and gets the error there if it happens again
+                print(f"Warning: prefetching {stimulus_file} failed: {error}")
+                self._failed[stimulus_file] = error
+            finally:
+                with self._condition:
+                    self._loading = None
+                    if samples is not None and \
+                            stimulus_file in self._order[self._position:self._position + self.window]:
+                        self._buffers[stimulus_file] = samples
+                    self._condition.notify_all()
+
+    def get(self, stimulus_file):
+        """
+        Return the decoded samples of a stimulus and move the window on to the following stimuli.
+
+        Parameters:
+        stimulus_file (str): The filename of the stimulus.
+
+        Returns:
+        numpy.ndarray: The float32 samples at the bank's sample rate.
+        """
+        with self._condition:
+            samples = self._buffers.pop(stimulus_file, None)
+            if samples is None and self._loading == stimulus_file:
+                # The worker is decoding this stimulus right now
+                self.waits += 1
+                # Never wait for a worker that has died
+                while self._loading == stimulus_file and self._thread is not None and self._thread.is_alive():
+                    self._condition.wait(0.1)
+                samples = self._buffers.pop(stimulus_file, None)
+            elif samples is not None or stimulus_file in self.bank:
+                self.hits += 1
+
+            # Move the window past this stimulus; stimuli that were skipped (see gating_adaptive.py) are dropped
+            if stimulus_file in self._order[self._position:]:
+                self._position = self._order.index(stimulus_file, self._position) + 1
+                upcoming = set(self._order[self._position:self._position + self.window])
+                self._buffers = {f: buffer for f, buffer in self._buffers.items() if f in upcoming}
+            self._condition.notify_all()
+
+        if samples is not None:
+            return samples
+        if stimulus_file in self.bank:
+            return self.bank.get(stimulus_file)
+        self.misses += 1
+        return self._decode(stimulus_file)
+
+    def metrics(self):
+        """
+        Return the prefetch counters.
+
+        Returns:
+        dict: The number of hits, waits and misses, the number of stimuli decoded by the prefetcher, the number of
+        stimuli it failed to decode and the window.
+        """
+        return {'hits': self.hits, 'waits': self.waits, 'misses': self.misses, 'decoded': len(self.load_times),
+                'failed': len(self._failed), 'window': self.window}
+
+    def save_load_times(self, filepath):
+        """
+        Write the per-stimulus load times of the bank and the prefetcher to a CSV file, slowest stimulus first.
+
+        Parameters:
+        filepath (str): The path of the CSV file to write.
+        """
+        self.bank.load_times.update(self.load_times)
+        self.bank.save_load_times(filepath)
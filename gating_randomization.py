@@ -13,46 +13,64 @@ First, make sure that no more than four stimuli with the same condition appear c
 Then, ensure that no more than three stimuli with the same gate number appear consecutively.
 Additionally, add a condition to ensure that gate 5, 6, and 7 stimuli do not appear adjacent to each other
 if they are from the same speaker with the same name and condition.
+
+The constraints are enforced by a sequencing engine (constraint_randomization) that tracks the run lengths at the end
+of the sequence incrementally and backtracks out of dead ends, restarting with a new shuffle if needed. Stimuli are
+grouped into buckets of equal condition, gate and name, so each step costs time proportional to the number of buckets,
+not to the number of stimuli. If the constraints cannot be satisfied, a ValueError is raised instead of silently
+appending unconstrained stimuli.
 """
 
 import os
 import random
 from collections import defaultdict
 import csv
+from gating_stimulus_bank import open_stimulus_source
+from gating_session_log import log_session_event
 
 
-def load_stimuli(stimuli_path):
+def load_stimuli(stimuli_path, source=None):
     """
-    Loads stimuli files from a given directory.
+    Loads stimuli files from a given directory, or from its packed container if there is one.
 
     Parameters:
     stimuli_path (str): Path to directory containing the stimuli files.
+    source (optional): The stimulus source to list the stimuli of instead, e.g. a GateGenerator.
 
     Returns:
     list: A list of stimuli filenames.
     """
-    # Use a list comprehension to get all '.wav' files in the directory
-    return [f for f in os.listdir(stimuli_path) if f.endswith('.wav')]
+    if source is None:
+        source = open_stimulus_source(stimuli_path)
+    return source.list_files()
 
 
-def randomize_stimuli(stimuli_files, practice_files=None):
+def randomize_stimuli(stimuli_files, practice_files=None, rng=None, stats=None, manifest=None):
     """
     Randomize a list of stimuli files given certain constraints.
 
     Args:
     stimuli_files (list of str): List of stimuli file names.
+    rng (random.Random, optional): The random number generator to use, e.g. a seeded one. Defaults to the global one.
+    stats (dict, optional): If given, the constraint solver statistics are added to it.
+    manifest (StimulusManifest, optional): The manifest to take the stimulus data from instead of the file names.
 
     Returns:
     list of str: Randomized list of stimuli files.
     """
+    rng = rng if rng is not None else random
+
     # If practice_files is provided, just shuffle them
     if practice_files is not None:
-        random.shuffle(stimuli_files)
+        rng.shuffle(stimuli_files)
         randomized_stimuli = stimuli_files
 
     else:
         # Extract stimulus data for each file
-        stimulus_data = [get_stimulus_data(file) for file in stimuli_files]
+        if manifest is not None:
+            stimulus_data = [manifest[file] for file in stimuli_files]
+        else:
+            stimulus_data = [get_stimulus_data(file) for file in stimuli_files]
 
         # Group by speaker
         speakers = defaultdict(list)
@@ -61,7 +79,7 @@ def randomize_stimuli(stimuli_files, practice_files=None):
 
         # Randomize order of speakers
         speaker_order = list(speakers.keys())
-        random.shuffle(speaker_order)
+        rng.shuffle(speaker_order)
 
         # Initialize list to store the final order of stimuli
         randomized_stimuli_data = []
@@ -69,14 +87,16 @@ def randomize_stimuli(stimuli_files, practice_files=None):
         # Iterate over speakers in randomized order
         for speaker in speaker_order:
             # Separate out gate 7 stimuli
-            gate7_stimuli = [data for data in speakers[speaker] if data['gate'] == '7']
-            other_stimuli = [data for data in speakers[speaker] if data['gate'] != '7']
+            gate7_stimuli = [data for data in speakers[speaker] if int(data['gate']) == 7]
+            other_stimuli = [data for data in speakers[speaker] if int(data['gate']) != 7]
 
             # Randomly order other stimuli with constraints
-            other_stimuli_ordered = constraint_randomization(other_stimuli)
+            other_stimuli_ordered = constraint_randomization(other_stimuli, rng=rng, stats=stats)
 
-            # Randomly order gate 7 stimuli with constraints
-            gate7_stimuli_ordered = constraint_randomization(gate7_stimuli)
+            # Randomly order gate 7 stimuli with constraints, continuing the runs of the other stimuli.
+            # The gate 7 stimuli are all of the same gate, so the gate run limit doesn't apply to them.
+            gate7_stimuli_ordered = constraint_randomization(gate7_stimuli, preceding=other_stimuli_ordered,
+                                                             max_gate_run=None, rng=rng, stats=stats)
 
             # Append stimuli to final list
             randomized_stimuli_data.extend(other_stimuli_ordered + gate7_stimuli_ordered)
@@ -87,55 +107,245 @@ def randomize_stimuli(stimuli_files, practice_files=None):
     return randomized_stimuli
 
 
-def constraint_randomization(stimuli_files):
+def randomize_phase(stimuli_files, phase, rng=None, stats=None, manifest=None):
+    """
+    Randomize the stimuli of a phase: the practice stimuli are just shuffled, the test stimuli are randomized in
+    speaker blocks with constraints. The practice set is too small (one speaker and name) for the constraints.
+
+    Args:
+    stimuli_files (list of str): List of stimuli file names.
+    phase (str): The phase ('practice', 'test').
+    rng (random.Random, optional): The random number generator to use. Defaults to the global one.
+    stats (dict, optional): If given, the constraint solver statistics are added to it.
+    manifest (StimulusManifest, optional): The manifest to take the stimulus data from.
+
+    Returns:
+    list of str: Randomized list of stimuli files.
+    """
+    if phase == 'practice':
+        return randomize_stimuli(stimuli_files, practice_files=stimuli_files, rng=rng)
+    return randomize_stimuli(stimuli_files, rng=rng, stats=stats, manifest=manifest)
+
+
+# Default sequencing constraints, see constraint_randomization()
+MAX_CONDITION_RUN = 4
+MAX_GATE_RUN = 3
+MAX_NAME_RUN = 1
+SEPARATED_GATES = (5, 6, 7)
+
+# The run-length state of an empty sequence, see _advance()
+INITIAL_STATE = (None, 0, None, 0, None, 0, None)
+
+# The number of seeds tried at session start before the stimuli are shuffled without constraints
+RANDOMIZATION_SEEDS = 3
+
+
+def _item(stimulus):
+    """Return the item a stimulus belongs to: its speaker, name and condition."""
+    return stimulus['speaker'], stimulus['name_stim'], stimulus['condition']
+
+
+def _advance(state, stimulus):
+    """
+    Return the run-length state after appending a stimulus to the sequence.
+
+    The state is a tuple (condition, condition run, gate, gate run, name, name run, item) describing the end of the
+    sequence. It is updated in constant time, independently of the length of the sequence.
+    """
+    condition, condition_run, gate, gate_run, name, name_run, _ = state
+    new_gate = int(stimulus['gate'])
+    return (stimulus['condition'], condition_run + 1 if stimulus['condition'] == condition else 1,
+            new_gate, gate_run + 1 if new_gate == gate else 1,
+            stimulus['name_stim'], name_run + 1 if stimulus['name_stim'] == name else 1,
+            _item(stimulus))
+
+
+def _allowed(state, condition, gate, name, limits):
+    """Check the run-length constraints for appending a stimulus with the given condition, gate and name."""
+    max_condition_run, max_gate_run, max_name_run, _ = limits
+    last_condition, condition_run, last_gate, gate_run, last_name, name_run, _ = state
+    return not ((max_condition_run and condition == last_condition and condition_run >= max_condition_run) or
+                (max_gate_run and gate == last_gate and gate_run >= max_gate_run) or
+                (max_name_run and name == last_name and name_run >= max_name_run))
+
+
+def _pick(bucket, state, gate, limits):
     """
-    Apply constraint randomization: Not more than 3 of the same condition,
-    name_stim or gate should be played.
+    Return the index of a stimulus in a bucket that may follow the current end of the sequence, or None.
+
+    Gates in the separated set must not directly follow a separated gate of the same item.
+    """
+    last_gate, last_item = state[2], state[6]
+    separated_gates = limits[3]
+    if gate not in separated_gates or last_gate not in separated_gates:
+        return len(bucket) - 1
+    for index in range(len(bucket) - 1, -1, -1):
+        if _item(bucket[index]) != last_item:
+            return index
+    return None
+
+
+def _ordered_options(buckets, state, limits, rng):
+    """
+    Return the keys of all non-empty buckets that satisfy the run-length constraints, in random order.
+
+    Buckets holding more stimuli are more likely to come first (weighted random permutation), which keeps the remaining
+    stimuli balanced and avoids dead ends at the end of the sequence.
+    """
+    weighted = [(rng.random() ** (1.0 / len(bucket)), key) for key, bucket in buckets.items()
+                if bucket and _allowed(state, key[0], key[1], key[2], limits)]
+    weighted.sort(reverse=True)
+    return [key for _, key in weighted]
+
+
+def _sequence(stimuli, initial_state, limits, rng, max_backtracks, stats):
+    """
+    Order the stimuli by depth-first search with backtracking.
+
+    The stimuli are grouped into buckets of equal condition, gate and name, so every step only looks at the (few)
+    buckets instead of all remaining stimuli. Returns None if the backtracking budget is exhausted.
+    """
+    buckets = defaultdict(list)
+    for stimulus in stimuli:
+        buckets[(stimulus['condition'], int(stimulus['gate']), stimulus['name_stim'])].append(stimulus)
+    for bucket in buckets.values():
+        rng.shuffle(bucket)
+
+    sequence = []
+    frames = []  # per placed stimulus: (options, next option index, state before, bucket key)
+    state = initial_state
+    options, option_index = _ordered_options(buckets, state, limits, rng), 0
+    backtracks = 0
+
+    while len(sequence) < len(stimuli):
+        placed = False
+        while option_index < len(options):
+            key = options[option_index]
+            option_index += 1
+            bucket = buckets[key]
+            index = _pick(bucket, state, key[1], limits)
+            if index is None:
+                continue
+            bucket[index], bucket[-1] = bucket[-1], bucket[index]
+            stimulus = bucket.pop()
+            frames.append((options, option_index, state, key))
+            sequence.append(stimulus)
+            state = _advance(state, stimulus)
+            options, option_index = _ordered_options(buckets, state, limits, rng), 0
+            placed = True
+            break
+
+        if not placed:
+            # Dead end: undo the last placement and try its next option
+            backtracks += 1
+            if not frames or backtracks > max_backtracks:
+                stats['backtracks'] = stats.get('backtracks', 0) + backtracks
+                return None
+            options, option_index, state, key = frames.pop()
+            buckets[key].append(sequence.pop())
+
+    stats['backtracks'] = stats.get('backtracks', 0) + backtracks
+    return sequence
+
+
+def constraint_randomization(stimuli_files, preceding=None, max_condition_run=MAX_CONDITION_RUN,
+                             max_gate_run=MAX_GATE_RUN, max_name_run=MAX_NAME_RUN, separated_gates=SEPARATED_GATES,
+                             max_attempts=50, rng=None, stats=None):
+    """
+    Apply constraint randomization: the stimuli are shuffled such that
+    - not more than max_condition_run stimuli of the same condition follow each other,
+    - not more than max_gate_run stimuli of the same gate follow each other,
+    - not more than max_name_run stimuli of the same name_stim follow each other,
+    - no two stimuli of the same item (speaker, name and condition) with gates in separated_gates are adjacent.
+
+    The run lengths are tracked incrementally and dead ends are resolved by backtracking, so the constraints are
+    guaranteed. If the backtracking budget of an attempt is exhausted, the search restarts with a new shuffle.
 
     Args:
     stimuli (list of dict): List of stimuli data.
+    preceding (list of dict, optional): The stimuli already placed before these, so runs continue across the border.
+    max_condition_run, max_gate_run, max_name_run (int, optional): Maximum run lengths. None or 0 disables a limit.
+    separated_gates (tuple, optional): Gates of the same item that must not be adjacent. Defaults to (5, 6, 7).
+    max_attempts (int, optional): Number of randomized restarts before giving up. Defaults to 50.
+    rng (random.Random, optional): The random number generator to use. Defaults to the global one.
+    stats (dict, optional): If given, the number of 'attempts' and 'backtracks' needed are added to it.
 
     Returns:
     list of dict: Randomized list of stimuli data.
+
+    Raises:
+    ValueError: If no order satisfying the constraints was found.
     """
-    stimuli_copy = stimuli_files.copy()
-    random.shuffle(stimuli_copy)
-
-    randomized_stimuli = []
-    while stimuli_copy:
-        valid_stimulus_found = False
-        for stimulus in stimuli_copy:
-            if (
-                sum(stim['condition'] == stimulus['condition'] for stim in randomized_stimuli) < 4 and
-                sum(stim['name_stim'] == stimulus['name_stim'] for stim in randomized_stimuli) < 2 and
-                sum(stim['gate'] == stimulus['gate'] for stim in randomized_stimuli) < 4
-            ):
-                randomized_stimuli.append(stimulus)
-                stimuli_copy.remove(stimulus)
-                valid_stimulus_found = True
-                break
-        if not valid_stimulus_found:
-            print(
-                "Warning: Constraints cannot be satisfied for remaining stimuli. Adding remaining stimuli in random order.")
-            randomized_stimuli.extend(stimuli_copy)
-            break
-    return randomized_stimuli
+    rng = rng if rng is not None else random
+    stats = stats if stats is not None else {}
+    limits = (max_condition_run, max_gate_run, max_name_run, tuple(separated_gates))
+
+    initial_state = INITIAL_STATE
+    for stimulus in preceding or []:
+        initial_state = _advance(initial_state, stimulus)
+
+    for attempt in range(1, max_attempts + 1):
+        stats['attempts'] = stats.get('attempts', 0) + 1
+        sequence = _sequence(stimuli_files, initial_state, limits, rng, 20 * len(stimuli_files) + 100, stats)
+        if sequence is not None:
+            return sequence
 
+    raise ValueError(f"Constraints cannot be satisfied for {len(stimuli_files)} stimuli "
+                     f"after {max_attempts} attempts.")
 
-def save_randomized_stimuli(randomized_stimuli, participant_info):
+
+
+def may_follow(state, stimulus):
+    """
+    Check whether a stimulus may follow a sequence of the same speaker block under the sequencing constraints of the
+    test phase. Used to check a sequence that is shortened while it is presented (see gating_adaptive.py).
+
+    Args:
+    state (tuple): The run-length state at the end of the sequence, built with advance_state() from INITIAL_STATE.
+    stimulus (dict): The stimulus data.
+
+    Returns:
+    bool: True if the constraints hold. The gate run limit doesn't apply to gate 7, like in randomize_stimuli().
+    """
+    gate = int(stimulus['gate'])
+    limits = (MAX_CONDITION_RUN, MAX_GATE_RUN if gate != 7 else None, MAX_NAME_RUN, SEPARATED_GATES)
+    return (_allowed(state, stimulus['condition'], gate, stimulus['name_stim'], limits)
+            and _pick([stimulus], state, gate, limits) is not None)
+
+
+def advance_state(state, stimulus):
+    """
+    Return the run-length state after a stimulus was presented, for may_follow().
+
+    Args:
+    state (tuple): The run-length state before the stimulus, INITIAL_STATE at the start of a speaker block.
+    stimulus (dict): The stimulus data.
+
+    Returns:
+    tuple: The new state.
+    """
+    return _advance(state, stimulus)
+
+
+def save_randomized_stimuli(randomized_stimuli, participant_info, phase=None, seed=None):
     """
     Save randomized stimuli as a csv file for a participant.
 
     Args:
     randomized_stimuli (list of str): List of randomized stimuli file names.
     participant_info (dict): Participant information from get_participant_info().
+    phase (str, optional): The phase the list belongs to ('practice', 'test'). It is added to the file name, so the
+        lists of both phases are kept.
+    seed (int, optional): The seed the list was randomized with. It is added to the file name.
     """
     # Create a directory for this participant if it doesn't exist
     directory = os.path.join('randomization_lists', participant_info['subject'])
     os.makedirs(directory, exist_ok=True)
 
     # Define file path
-    filename = f"{participant_info['subject']}_{participant_info['cur_date'].replace(':', '-').replace(' ', '_')}_randomized_gating_stimuli.csv"
+    seed_part = f"_seed{seed}" if seed is not None else ""
+    phase_part = f"_{phase}" if phase else ""
+    filename = f"{participant_info['subject']}_{participant_info['cur_date'].replace(':', '-').replace(' ', '_')}{seed_part}{phase_part}_randomized_gating_stimuli.csv"
     filepath = os.path.join(directory, filename)
 
     # Write csv file
@@ -147,22 +357,132 @@ def save_randomized_stimuli(randomized_stimuli, participant_info):
     print(f"Saved randomized stimuli to {filepath}")
 
 
-def load_and_randomize(stimuli_path, participant_info):
+def load_saved_randomization(subject, phase):
+    """
+    Load the latest randomization list saved by save_randomized_stimuli() for a subject and phase, e.g. to resume an
+    interrupted session.
+
+    Args:
+    subject (str): The subject ID.
+    phase (str): The phase ('practice', 'test').
+
+    Returns:
+    list of str: The list of stimuli file names, or None if no list was saved.
+    """
+    directory = os.path.join('randomization_lists', subject)
+    suffix = f"_{phase}_randomized_gating_stimuli.csv"
+    if not os.path.isdir(directory):
+        return None
+
+    saved_lists = [os.path.join(directory, f) for f in os.listdir(directory)
+                   if f.startswith(f"{subject}_") and f.endswith(suffix)]
+    if not saved_lists:
+        return None
+    with open(max(saved_lists, key=os.path.getmtime), newline='') as csvfile:
+        return [row[0] for row in list(csv.reader(csvfile))[1:]]
+
+
+def pregenerated_list_path(subject, phase, seed):
+    """
+    Return the path of a pre-generated randomization list (see gating_cohort.py).
+
+    Args:
+    subject (str): The subject ID.
+    phase (str): The phase ('practice', 'test').
+    seed (int): The seed the list was generated with.
+
+    Returns:
+    str: The path of the list.
+    """
+    return os.path.join('randomization_lists', subject, f"{subject}_{phase}_seed{seed}_pregenerated_gating_stimuli.csv")
+
+
+def load_pregenerated(subject, phase):
+    """
+    Look up the pre-generated randomization list of a subject and phase.
+
+    Args:
+    subject (str): The subject ID.
+    phase (str): The phase ('practice', 'test').
+
+    Returns:
+    tuple: The list of stimuli file names and its seed, or None if there is no pre-generated list.
+    """
+    directory = os.path.join('randomization_lists', subject)
+    prefix, suffix = f"{subject}_{phase}_seed", "_pregenerated_gating_stimuli.csv"
+    if not os.path.isdir(directory):
+        return None
+
+    for filename in os.listdir(directory):
+        if filename.startswith(prefix) and filename.endswith(suffix):
+            with open(os.path.join(directory, filename), newline='') as csvfile:
+                rows = list(csv.reader(csvfile))
+            return [row[0] for row in rows[1:]], int(filename[len(prefix):-len(suffix)])
+    return None
+
+
+def load_and_randomize(stimuli_path, participant_info, source=None, phase=None, manifest=None):
     """
     Load stimuli files from a directory, randomize them,
     get participant info and save the randomized stimuli.
 
+    If a list was pre-generated for the participant and phase (see gating_cohort.py), it is used instead of
+    randomizing, as long as it matches the available stimuli. Otherwise the stimuli are randomized with a new seed.
+    The seed is stored in participant_info['randomization_seed'], added to the name of the saved list and written to
+    the session log, so the list can be reproduced with randomize_phase(stimuli_files, phase,
+    rng=random.Random(seed)).
+
+    If the sequencing constraints cannot be satisfied, the randomization is retried with new seeds (RANDOMIZATION_SEEDS
+    in total), each failure being logged. If no seed works, the stimuli are shuffled without constraints with the last
+    seed, with a warning, so the session still starts; the session log then records 'constrained': false.
+
     Args:
     stimuli_path (str): Path to directory containing the stimuli files.
+    source (optional): The stimulus source to load the stimuli from instead, e.g. a GateGenerator.
+    phase (str, optional): The phase ('practice', 'test'), needed to find pre-generated lists.
+    manifest (StimulusManifest, optional): The manifest of the stimuli. If given, the stimuli are taken from it.
     """
     # Load stimuli files
-    stimuli_files = load_stimuli(stimuli_path)
-
-    # Randomize stimuli
-    randomized_stimuli = randomize_stimuli(stimuli_files)
+    if manifest is not None:
+        stimuli_files = manifest.filenames()
+    else:
+        stimuli_files = load_stimuli(stimuli_path, source)
+
+    # Use the pre-generated list if there is one
+    constrained = True
+    pregenerated = load_pregenerated(participant_info['subject'], phase) if phase else None
+    use_pregenerated = pregenerated is not None and sorted(pregenerated[0]) == sorted(stimuli_files)
+    if use_pregenerated:
+        randomized_stimuli, seed = pregenerated
+        print(f"Using pre-generated {phase} list of {participant_info['subject']} (seed {seed})")
+    else:
+        if pregenerated is not None:
+            print(f"Warning: the pre-generated {phase} list of {participant_info['subject']} doesn't match the "
+                  f"stimuli in {stimuli_path}. Randomizing instead.")
+        # Randomize stimuli with a seed of their own, so the list can be reproduced
+        randomized_stimuli = None
+        for _ in range(RANDOMIZATION_SEEDS):
+            seed = random.randrange(2 ** 32)
+            try:
+                randomized_stimuli = randomize_phase(stimuli_files, phase, rng=random.Random(seed),
+                                                     manifest=manifest)
+                break
+            except ValueError as error:
+                print(f"Warning: randomizing the {phase} stimuli with seed {seed} failed: {error}")
+                log_session_event(participant_info, 'randomization_failed', phase=phase, seed=seed,
+                                  error=str(error))
+        if randomized_stimuli is None:
+            print(f"Warning: the sequencing constraints cannot be satisfied for the {phase} stimuli. Shuffling them "
+                  f"without constraints (seed {seed}).")
+            randomized_stimuli = list(stimuli_files)
+            random.Random(seed).shuffle(randomized_stimuli)
+            constrained = False
+    participant_info['randomization_seed'] = seed
 
     # Save randomized stimuli
-    save_randomized_stimuli(randomized_stimuli, participant_info)
+    save_randomized_stimuli(randomized_stimuli, participant_info, phase, seed)
+    log_session_event(participant_info, 'randomization', phase=phase, seed=seed, pregenerated=use_pregenerated,
+                      constrained=constrained, stimuli=len(randomized_stimuli))
 
     return randomized_stimuli
 
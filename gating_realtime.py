@@ -0,0 +1,229 @@
+"""
+gating_realtime.py
+
+This module contains the real-time mode of the gating experiment.
+
+A pause of Python's garbage collector, or another process scheduled on the core of the presentation thread, during a
+trial shows up directly as dropped frames and noise in the reaction times. In real-time mode (python
+gating_experiment.py --realtime), every phase runs as follows:
+
+    - before the first trial, all objects are collected and moved to the permanent generation (gc.freeze()), and the
+      automatic garbage collection is disabled; the garbage of a block is collected in the block break after it;
+    - the priority of the process is raised with PsychoPy's core.rush() (on Linux this needs the CAP_SYS_NICE
+      capability or root, otherwise a warning is printed);
+    - the presentation thread is pinned to one core (--cpu, by default the last one available) and all other threads
+      of the process (results writer, prefetcher, response collector, collector sink and the threads of the audio
+      library) to the other cores. Pinning is only supported on Linux.
+
+Everything is restored at the end of the phase.
+
+The pauses of the garbage collector are recorded in every phase, with or without real-time mode, so the effect can be
+compared: the number of automatic collections during each block, their total and maximum duration, and the duration of
+the collection in the block break. The report is printed and written to "session_log.jsonl" at the end of the phase.
+
+Functions:
+    - print_gc_report: Prints the pauses of the garbage collector per block.
+
+Classes:
+    - GCMonitor: Records the pauses of the garbage collector per block.
+    - RealtimeMode: Controls the garbage collector, the priority and the CPU affinity during a phase.
+"""
+
+import gc
+import os
+import time
+import threading
+from gating_backend import core
+
+
+class GCMonitor:
+    """
+    Records the pauses of the garbage collector per block.
+    """
+
+    def __init__(self):
+        self.blocks = []  # one report per block
+        self._pauses = []  # durations of the collections of the current block, in seconds
+        self._started = None
+
+    def start(self):
+        """Start recording the pauses of the garbage collector."""
+        self._pauses = []
+        gc.callbacks.append(self._callback)
+
+    def stop(self):
+        """Stop recording the pauses of the garbage collector."""
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._started = time.perf_counter()
+        elif self._started is not None:
+            self._pauses.append(time.perf_counter() - self._started)
+            self._started = None
+
+    def end_block(self, block, break_collection=None):
+        """
+        Close the report of a block.
+
+        Parameters:
+        block (int): The number of the block.
+        break_collection (float, optional): The duration of the collection in the block break, in seconds.
+
+        Returns:
+        dict: The number of automatic collections during the block, their total and maximum duration and the duration
+        of the collection in the block break, in milliseconds.
+        """
+        pauses = self._pauses
+        self._pauses = []
+        report = {'block': block,
+                  'collections': len(pauses),
+                  'pause_total_ms': sum(pauses) * 1000,
+                  'pause_max_ms': max(pauses, default=0) * 1000,
+                  'break_collection_ms': break_collection * 1000 if break_collection is not None else None}
+        self.blocks.append(report)
+        return report
+
+
+class RealtimeMode:
+    """
+    Controls the garbage collector, the priority and the CPU affinity during a phase.
+
+    Parameters:
+    enabled (bool, optional): Whether the real-time mode is enabled. If False, only the pauses of the garbage collector
+        are recorded. Defaults to True.
+    cpu (int, optional): The core the presentation thread is pinned to. Defaults to the last core available.
+    """
+
+    def __init__(self, enabled=True, cpu=None):
+        self.enabled = enabled
+        self.cpu = cpu
+        self.monitor = None
+        self._gc_was_enabled = None  # None while the garbage collector is not controlled
+        self._rushed = False
+        self._affinities = {}  # native thread ID -> CPU affinity before the phase
+
+    def start(self):
+        """
+        Enter the real-time mode at the start of a phase, after the background threads of the phase were started.
+
+        Raises:
+        ValueError: If the CPU is not available. Nothing has been changed then.
+        """
+        cpus = self._pinning_cpus() if self.enabled else None
+        monitor = GCMonitor()
+        if self.enabled:
+            gc.collect()
+            gc.freeze()
+            self._gc_was_enabled = gc.isenabled()
+            gc.disable()
+            self._rushed = True
+            if not core.rush(True):
+                print("Warning: the priority of the process could not be raised.")
+            if cpus is not None:
+                self._pin_threads(*cpus)
+        self.monitor = monitor
+        self.monitor.start()
+
+    def block_break(self, block):
+        """
+        Collect the garbage of a block in the break after it.
+
+        Parameters:
+        block (int): The number of the block that has ended.
+
+        Returns:
+        dict: The report of the block (see GCMonitor.end_block).
+        """
+        self.monitor.stop()
+        duration = None
+        if self.enabled:
+            start = time.perf_counter()
+            gc.collect()
+            duration = time.perf_counter() - start
+        report = self.monitor.end_block(block, duration)
+        self.monitor.start()
+        return report
+
+    def stop(self, block):
+        """
+        Leave the real-time mode at the end of a phase.
+
+        Parameters:
+        block (int): The number of the last block.
+
+        Returns:
+        list of dict: The reports of all blocks of the phase; empty if the real-time mode was not started.
+
+        Only what start() has changed is restored, so stop() can also be called after start() failed.
+        """
+        self._restore_threads()
+        if self._rushed:
+            core.rush(False)
+            self._rushed = False
+        if self._gc_was_enabled is not None:
+            gc.unfreeze()
+            if self._gc_was_enabled:
+                gc.enable()
+            self._gc_was_enabled = None
+        if self.monitor is None:
+            return []
+        self.monitor.stop()
+        self.monitor.end_block(block)
+        return self.monitor.blocks
+
+    def _pinning_cpus(self):
+        """
+        Return the core of the presentation thread and the cores of the other threads, or None if pinning is not
+        supported.
+
+        Raises:
+        ValueError: If the CPU is not available.
+        """
+        if not hasattr(os, 'sched_setaffinity'):
+            print("Warning: pinning the presentation thread to a core is not supported on this platform.")
+            return None
+        available = sorted(os.sched_getaffinity(0))
+        cpu = self.cpu if self.cpu is not None else available[-1]
+        if cpu not in available:
+            raise ValueError(f"CPU {cpu} is not available; use one of {available}.")
+        return cpu, set(available) - {cpu} or {cpu}
+
+    def _pin_threads(self, cpu, others):
+        """Pin the calling (presentation) thread to one core and all other threads to the other cores."""
+        # All threads of the process, including those of the audio library that Python doesn't know about
+        if os.path.isdir('/proc/self/task'):
+            native_ids = [int(task) for task in os.listdir('/proc/self/task')]
+        else:
+            native_ids = [thread.native_id for thread in threading.enumerate() if thread.native_id is not None]
+        presentation_thread = threading.get_native_id()
+        for native_id in native_ids:
+            try:
+                self._affinities[native_id] = os.sched_getaffinity(native_id)
+                os.sched_setaffinity(native_id, {cpu} if native_id == presentation_thread else others)
+            except OSError:
+                self._affinities.pop(native_id, None)  # the thread has ended
+
+    def _restore_threads(self):
+        """Restore the CPU affinity of the threads that are still running."""
+        for native_id, affinity in self._affinities.items():
+            try:
+                os.sched_setaffinity(native_id, affinity)
+            except OSError:
+                pass  # the thread has ended
+        self._affinities = {}
+
+
+def print_gc_report(blocks):
+    """
+    Print the pauses of the garbage collector per block.
+
+    Parameters:
+    blocks (list of dict): The reports of the blocks, as returned by RealtimeMode.stop().
+    """
+    for report in blocks:
+        break_collection = f"{report['break_collection_ms']:.2f} ms" if report['break_collection_ms'] is not None \
+            else '-'
+        print(f"  block {report['block']}: {report['collections']} collections, {report['pause_total_ms']:.2f} ms "
+              f"total, {report['pause_max_ms']:.2f} ms max; block break collection {break_collection}")
@@ -0,0 +1,207 @@
+"""
+gating_response.py
+
+This module contains the response capture of the gating experiment.
+
+present_trial() used to wait in kb.waitKeys() until the participant pressed a response key, without a time limit, and
+recorded only the first key and its reaction time from the response screen. The response collector polls the keyboard
+on a background thread for the whole phase instead:
+
+    - every press and release of any key is timestamped (key.tDown on the PsychoPy clock, the press plus key.duration
+      for the release) and logged with its time relative to the sound onset of the trial, including presses during the
+      sound; the log is saved next to the results as '<results_file>_keys.csv';
+    - the response is the first press of a response key after the response screen. The presentation loop waits for it
+      at most response_deadline seconds (gating_configuration.py); if the deadline passes, the trial is coded as a
+      timeout (response 'timeout', no reaction time, accuracy 0) and the experiment continues;
+    - the reaction time is measured from the response screen as before, and also from the onset and the offset of the
+      sound (rt_onset, rt_offset).
+
+The keyboard buffer is cleared when the response screen is shown, so a key pressed during the sound is logged but
+doesn't count as the response.
+
+Classes:
+    - Response: The response of a trial.
+    - ResponseCollector: Polls the keyboard on a background thread and collects the responses of a phase.
+"""
+
+import csv
+import math
+import threading
+import collections
+from gating_backend import core
+
+# The response of a trial that timed out
+TIMEOUT_RESPONSE = 'timeout'
+
+# The response of a trial: the key, the reaction times from the response screen and from the onset and offset of the
+# sound in seconds (NaN if unknown), and whether the trial timed out
+Response = collections.namedtuple('Response', ['key', 'rt', 'rt_onset', 'rt_offset', 'timed_out'])
+
+
+class ResponseCollector:
+    """
+    Polls the keyboard on a background thread and collects the responses of a phase.
+
+    Parameters:
+    kb (psychopy.hardware.keyboard.Keyboard): The keyboard to register responses from.
+    keys (tuple of str, optional): The response keys. Defaults to ('left', 'right').
+    deadline (float, optional): The time in seconds the participant has to respond after the response screen. Defaults
+        to None (no deadline).
+    poll_interval (float, optional): The time in seconds between two polls of the keyboard. Defaults to 0.001.
+    """
+
+    FIELDNAMES = ['trial', 'key', 'event', 'time', 'time_from_onset']
+
+    def __init__(self, kb, keys=('left', 'right'), deadline=None, poll_interval=0.001):
+        self.kb = kb
+        self.keys = tuple(keys)
+        self.deadline = deadline
+        self.poll_interval = poll_interval
+        self.timeouts = 0
+        self.events = []  # (trial, key, 'press' or 'release', time, time from the sound onset)
+        self._lock = threading.Lock()
+        self._response_event = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._trial = None
+        self._sound_onset = None
+        self._sound_offset = None
+        self._screen_time = None
+        self._seen = {}  # id of a key press in the keyboard buffer -> (key press, release logged)
+        self._response = None
+        self._error = None
+
+    def start(self):
+        """Start polling the keyboard."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ResponseCollector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling the keyboard."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def begin_trial(self, trial):
+        """
+        Begin a trial: the following key events are logged for it.
+
+        Parameters:
+        trial (int): The trial number.
+        """
+        with self._lock:
+            self._trial = trial
+            self._sound_onset = self._sound_offset = self._screen_time = None
+            self._response = None
+            self._response_event.clear()
+
+    def sound_started(self, onset, duration):
+        """
+        Set the onset of the sound of the trial, the reference of the logged key events.
+
+        Parameters:
+        onset (float): The onset of the sound on the PsychoPy clock.
+        duration (float): The duration of the sound in seconds.
+        """
+        with self._lock:
+            self._sound_onset = onset
+            self._sound_offset = onset + duration
+
+    def response_screen_shown(self):
+        """Clear the keyboard buffer when the response screen has been shown; the next response key press counts."""
+        with self._lock:
+            self.kb.clearEvents()
+            self.kb.clock.reset()
+            self._screen_time = core.getTime()
+            self._seen = {}
+
+    def wait(self):
+        """
+        Wait for the response of the trial, at most until the deadline.
+
+        Returns:
+        Response: The response; a timeout if the deadline passed.
+
+        Raises:
+        RuntimeError: If polling the keyboard failed.
+        """
+        deadline = self._screen_time + self.deadline if self.deadline is not None else None
+        while not self._response_event.is_set():
+            if deadline is not None and core.getTime() >= deadline:
+                # A press may be in the keyboard buffer without having been polled yet
+                self._poll()
+                break
+            self._response_event.wait(self.poll_interval)
+
+        if self._error is not None:
+            raise RuntimeError("Polling the keyboard failed") from self._error
+        with self._lock:
+            response = self._response
+            if response is not None and (deadline is None or response.tDown <= deadline):
+                return self._make_response(response)
+            self._response = None  # a press after the deadline is logged, but not the response of this trial
+            self.timeouts += 1
+            return Response(TIMEOUT_RESPONSE, math.nan, math.nan, math.nan, True)
+
+    def _make_response(self, key):
+        """Return the response of a trial from its key press."""
+        onset = key.tDown - self._sound_onset if self._sound_onset is not None else math.nan
+        offset = key.tDown - self._sound_offset if self._sound_offset is not None else math.nan
+        return Response(key.name, key.rt, onset, offset, False)
+
+    def metrics(self):
+        """
+        Return the metrics of the collector.
+
+        Returns:
+        dict: The number of logged key presses and of trials that timed out.
+        """
+        return {'presses': sum(1 for event in self.events if event[2] == 'press'), 'timeouts': self.timeouts}
+
+    def save(self, filename):
+        """
+        Save the logged key events to a CSV file.
+
+        Parameters:
+        filename (str): The path of the CSV file.
+        """
+        with self._lock:
+            events = list(self.events)
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(self.FIELDNAMES)
+            for trial, key, event, time, time_from_onset in events:
+                writer.writerow([trial, key, event, f"{time:.6f}",
+                                 f"{time_from_onset:.6f}" if time_from_onset is not None else ''])
+
+    def _log(self, key, event, time):
+        onset = time - self._sound_onset if self._sound_onset is not None else None
+        self.events.append((self._trial, key, event, time, onset))
+
+    def _poll(self):
+        """Log the new presses and releases in the keyboard buffer and take the response from them."""
+        with self._lock:
+            for key in self.kb.getKeys(waitRelease=False, clear=False):
+                seen = self._seen.get(id(key))
+                if seen is None:
+                    self._log(key.name, 'press', key.tDown)
+                    self._seen[id(key)] = (key, False)
+                    if self._screen_time is not None and self._response is None and key.name in self.keys:
+                        self._response = key
+                        self._response_event.set()
+                    seen = self._seen[id(key)]
+                if key.duration is not None and not seen[1]:
+                    self._log(key.name, 'release', key.tDown + key.duration)
+                    self._seen[id(key)] = (key, True)
+
+    def _run(self):
+        """The polling thread."""
+        try:
+            while not self._stop.is_set():
+                self._poll()
+                self._stop.wait(self.poll_interval)
+        except Exception as error:
+            self._error = error
+            self._response_event.set()  # wake up wait()
@@ -0,0 +1,219 @@
+"""
+gating_results_writer.py
+
+This module contains the background results writer of the gating experiment.
+
+Writing a trial to the results CSV used to flush and fsync the file on the presentation thread, right before the next
+fixation cross; on network-mounted results folders this stalled the trial loop. The results writer moves all disk
+access to a background thread: the trial loop only puts the result into a queue, which never blocks. A result can also
+be submitted as a function returning it (e.g. TrialLog.record of the trial, see gating_trial_log.py); the row is then
+formatted on the writer thread as well.
+
+The writer thread commits every batch of results to a small append-only write-ahead journal next to the CSV file
+('<output_file>.journal', one JSON object per line) and fsyncs it. Only then are the rows written to the CSV file with
+append_result_to_csv(), which flushes and fsyncs as before. If the experiment crashes while a row is being written to
+the CSV file, recover_journal() restores the missing rows from the journal the next time the file is opened. The
+journal is emptied whenever its results are safely in the CSV file and it has grown beyond a few entries, and removed
+when the writer is closed.
+
+If a sink is given (see CollectorSink in gating_collector.py), every result is handed to it once it is in the CSV file.
+
+A result is durable once the writer thread has fsynced the journal, typically a few milliseconds after the trial. The
+queue depth and the latency from submitting a result until it is durable in the CSV file are recorded.
+
+Functions:
+    - recover_journal: Restores rows from the journal that are missing in the CSV file.
+
+Classes:
+    - ResultsWriter: Writes results to a CSV file on a background thread.
+"""
+
+import os
+import csv
+import json
+import time
+import queue
+import threading
+from gating_configuration import append_result_to_csv
+
+# The journal is emptied when it holds more entries than this and all of them are in the CSV file
+JOURNAL_COMPACT_SIZE = 64
+
+_CLOSE = object()
+
+
+def _journal_path(output_filename):
+    """Return the path of the journal belonging to a results CSV file."""
+    return output_filename + '.journal'
+
+
+def recover_journal(output_filename, fieldnames, key='trial'):
+    """
+    Restore the results from the journal that are missing in the CSV file, e.g. after a crash.
+
+    An incomplete last row of the CSV file is removed first. Results are matched by their key field.
+
+    Parameters:
+    output_filename (str): The path of the results CSV file.
+    fieldnames (list): The columns of the CSV file.
+    key (str, optional): The field identifying a result. Defaults to 'trial'.
+
+    Returns:
+    int: The number of restored results.
+    """
+    journal_path = _journal_path(output_filename)
+    if not os.path.exists(journal_path):
+        return 0
+
+    # Read the complete journal entries; a torn last line was never committed
+    journal = []
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            try:
+                journal.append(json.loads(line))
+            except ValueError:
+                break
+
+    written_keys = set()
+    file_exists = os.path.exists(output_filename) and os.path.getsize(output_filename) > 0
+    if file_exists:
+        with open(output_filename, 'rb+') as output_file:
+            content = output_file.read()
+            if not content.endswith(b'\n'):
+                # Remove the incomplete last row
+                output_file.truncate(content.rfind(b'\n') + 1)
+        with open(output_filename, newline='') as output_file:
+            written_keys = {row[key] for row in csv.DictReader(output_file)}
+        file_exists = os.path.getsize(output_filename) > 0
+
+    missing = [result for result in journal if str(result[key]) not in written_keys]
+    with open(output_filename, 'a', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+        for result in missing:
+            append_result_to_csv(writer, result, file_exists, output_file)
+            file_exists = True
+
+    os.remove(journal_path)
+    return len(missing)
+
+
+class ResultsWriter:
+    """
+    Writes results to a CSV file on a background thread, with a write-ahead journal for crash safety.
+
+    Parameters:
+    output_filename (str): The path of the results CSV file. Results are appended if it exists.
+    fieldnames (list): The columns of the CSV file.
+    sink (CollectorSink, optional): Receives every result after it was written to the CSV file. Defaults to None.
+    """
+
+    def __init__(self, output_filename, fieldnames, sink=None):
+        self.output_filename = output_filename
+        self.fieldnames = fieldnames
+        self.sink = sink
+        self.submitted = 0
+        self.written = 0
+        self.max_queue_depth = 0
+        self.latencies = []  # seconds from submit() until the result was fsynced in the CSV file
+        self._queue = queue.Queue()
+        self._error = None
+
+        recover_journal(output_filename, fieldnames)
+        self._thread = threading.Thread(target=self._run, name='ResultsWriter', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        """The number of results waiting to be written."""
+        return self._queue.qsize()
+
+    def submit(self, result):
+        """
+        Queue a result for writing. Never blocks.
+
+        Parameters:
+        result (dict or callable): A dictionary containing the data for a single trial, or a function returning it
+            (e.g. TrialLog.record of the trial), which is called on the writer thread.
+        """
+        if self._error is not None:
+            raise RuntimeError(f"Writing the results to {self.output_filename} failed") from self._error
+        self._queue.put((time.perf_counter(), result))
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def close(self):
+        """Write all queued results, remove the journal and stop the writer thread."""
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError(f"Writing the results to {self.output_filename} failed") from self._error
+
+    def metrics(self):
+        """
+        Return the metrics of the writer.
+
+        Returns:
+        dict: The number of written results, the maximum queue depth and the median, 95th percentile and maximum
+        write latency in milliseconds.
+        """
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'written': 0, 'max_queue_depth': self.max_queue_depth}
+        return {'written': self.written,
+                'max_queue_depth': self.max_queue_depth,
+                'latency_median_ms': latencies[len(latencies) // 2] * 1000,
+                'latency_p95_ms': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000,
+                'latency_max_ms': latencies[-1] * 1000}
+
+    def _run(self):
+        """The writer thread: commit batches of results to the journal, then write them to the CSV file."""
+        journal_path = _journal_path(self.output_filename)
+        file_exists = os.path.exists(self.output_filename) and os.path.getsize(self.output_filename) > 0
+        journal_entries = 0
+        closing = False
+
+        try:
+            with open(self.output_filename, 'a', newline='') as output_file, open(journal_path, 'a') as journal:
+                writer = csv.DictWriter(output_file, fieldnames=self.fieldnames)
+
+                while not closing:
+                    # Take everything that is queued as one batch
+                    batch = [self._queue.get()]
+                    while True:
+                        try:
+                            batch.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    if batch[-1] is _CLOSE:
+                        closing = True
+                        batch.pop()
+                    if not batch:
+                        continue
+                    batch = [(submitted, result() if callable(result) else result) for submitted, result in batch]
+
+                    # Commit the batch to the journal
+                    for _, result in batch:
+                        journal.write(json.dumps(result) + '\n')
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                    journal_entries += len(batch)
+
+                    # Write the batch to the CSV file
+                    for submitted, result in batch:
+                        append_result_to_csv(writer, result, file_exists, output_file)
+                        file_exists = True
+                        self.latencies.append(time.perf_counter() - submitted)
+                        self.written += 1
+                    if self.sink is not None:
+                        for _, result in batch:
+                            self.sink.submit(result, self.output_filename)
+
+                    # All journal entries are in the CSV file now, so the journal can be emptied
+                    if journal_entries > JOURNAL_COMPACT_SIZE:
+                        journal.truncate(0)
+                        journal.seek(0)
+                        journal_entries = 0
+
+            os.remove(journal_path)
+        except Exception as error:
+            self._error = error
@@ -0,0 +1,124 @@
+"""
+gating_resume.py
+
+This module finds the point where an interrupted phase of the experiment has to be continued.
+
+If the experiment crashes or the machine reboots during a phase, the results CSV of that phase holds every completed
+trial (see gating_results_writer.py for how the rows are kept consistent) and the randomization list of the session
+was saved by save_randomized_stimuli(). In resume mode the phase continues with the next trial in the same CSV file,
+with the trial and block counters restored.
+
+The resume point is read from the last row of the CSV file, found by seeking backwards from the end of the file, so
+resuming costs the same for a short and a long results file.
+
+Functions:
+    - find_results_file: Returns the latest results file of a subject and phase.
+    - read_last_result: Reads the last row of a results file.
+    - find_resume_point: Returns where an interrupted phase has to be continued.
+"""
+
+import os
+import re
+import csv
+import locale
+from gating_results_writer import recover_journal
+
+
+def find_results_file(participant_info, phase):
+    """
+    Return the latest results file of a subject and phase.
+
+    Parameters:
+    participant_info (dict): The participant's information (name, date, experiment, etc.).
+    phase (str): The phase ('practice', 'test').
+
+    Returns:
+    str: The path of the file, or None if there is none.
+    """
+    directory = os.path.join('results', participant_info['subject'])
+    if not os.path.isdir(directory):
+        return None
+
+    pattern = re.compile(rf"^{re.escape(phase)}_{re.escape(participant_info['experiment'])}_"
+                         rf"{re.escape(participant_info['subject'])}_\d{{8}}_\d{{6}}\.csv$")
+    # The timestamp in the name sorts chronologically
+    results_files = sorted(f for f in os.listdir(directory) if pattern.match(f))
+    return os.path.join(directory, results_files[-1]) if results_files else None
+
+
+def read_last_result(output_filename):
+    """
+    Read the last row of a results file without reading the rows before it.
+
+    Parameters:
+    output_filename (str): The path of the results CSV file.
+
+    Returns:
+    dict: The last row, or None if the file holds no results.
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(output_filename, 'rb') as output_file:
+        header = output_file.readline()
+        size = output_file.seek(0, os.SEEK_END)
+
+        # Read blocks of growing size from the end until they contain a complete row
+        block_size = 4096
+        while True:
+            start = max(size - block_size, len(header))
+            output_file.seek(start)
+            lines = output_file.read(size - start).rstrip(b'\r\n').splitlines()
+            if len(lines) >= 2 or start == len(header):
+                break
+            block_size *= 2
+
+    if not header or not lines or not lines[-1]:
+        return None
+    return next(csv.DictReader([header.decode(encoding), lines[-1].decode(encoding)]))
+
+
+def _parse_duration(duration_str):
+    """Convert a 'HH:MM:SS' duration into seconds."""
+    hours, minutes, seconds = (int(part) for part in duration_str.split(':'))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def find_resume_point(participant_info, phase, stimuli_files, fieldnames):
+    """
+    Find where an interrupted phase has to be continued.
+
+    Results that were committed to the journal but not yet written to the CSV file are restored first.
+
+    Parameters:
+    participant_info (dict): The participant's information (name, date, experiment, etc.).
+    phase (str): The phase ('practice', 'test').
+    stimuli_files (list): The randomized list of stimulus filenames of the phase, as saved for the session.
+    fieldnames (list): The columns of the results CSV files.
+
+    Returns:
+    dict: The keys 'output_filename', 'completed' (number of completed trials), 'block', 'speaker', 'elapsed'
+    (seconds the phase had been running) and 'bracket_pic_position', or None if the phase was not started.
+
+    Raises:
+    ValueError: If the results don't match the randomization list.
+    """
+    output_filename = find_results_file(participant_info, phase)
+    if output_filename is None:
+        return None
+
+    recover_journal(output_filename, fieldnames)
+    last_result = read_last_result(output_filename)
+    if last_result is None:
+        return {'output_filename': output_filename, 'completed': 0, 'block': 1, 'speaker': None, 'elapsed': 0,
+                'bracket_pic_position': None}
+
+    completed = int(last_result['trial'])
+    if completed > len(stimuli_files) or stimuli_files[completed - 1] != last_result['stimulus']:
+        raise ValueError(f"The results in {output_filename} don't match the saved randomization list of "
+                         f"{participant_info['subject']} - the {phase} phase cannot be resumed")
+
+    return {'output_filename': output_filename,
+            'completed': completed,
+            'block': int(last_result['block']),
+            'speaker': last_result['speaker'],
+            'elapsed': _parse_duration(last_result['duration']),
+            'bracket_pic_position': last_result['bracket_pic_position']}
@@ -0,0 +1,128 @@
+"""
+gating_screens.py
+
+This module contains the screen cache of the gating experiment.
+
+show_message() used to create a new text stimulus for every message it showed, including the feedback after every
+practice trial and the message at every block break. Creating a text stimulus lays out the text and uploads it as a
+texture, which takes much longer than drawing it. The screen cache creates the text stimuli of all known screens once,
+after the window has been opened:
+
+    - the instructions of gating_instructions.py (begin, test, resume, end);
+    - the feedback of the practice trials (correct_feedback, incorrect_feedback);
+    - the block-break message of every block but the last.
+
+Showing a known screen then costs a draw and a flip. Other messages are created on first use and kept as well.
+
+The text stimuli belong to the window they were created for. The cache is invalidated when it is used with another
+window; call invalidate() after changing the window in place (e.g. its size or units).
+
+Functions:
+    - block_break_message: Returns the message shown after a block.
+    - known_screens: Returns the text and text height of all known screens.
+
+Classes:
+    - ScreenCache: Creates and keeps the text stimuli of the screens of a window.
+
+Objects:
+    - screen_cache: The screen cache used by show_message().
+"""
+
+from gating_backend import visual
+from gating_instructions import begin, test, resume, end, correct_feedback, incorrect_feedback, block_break
+
+N_BLOCKS = 4
+MESSAGE_HEIGHT = 0.1
+FEEDBACK_HEIGHT = 0.3
+
+
+def block_break_message(block):
+    """
+    Return the message shown after a block of the test phase.
+
+    Parameters:
+    block (int): The number of the block that has ended (1-based).
+
+    Returns:
+    str: The message.
+    """
+    return block_break.format(block=block, remaining=N_BLOCKS - block)
+
+
+def known_screens():
+    """
+    Return all screens whose text is known before the experiment starts.
+
+    Returns:
+    list of tuple: The (text, text height) of every screen.
+    """
+    screens = [(message, MESSAGE_HEIGHT) for message in (begin, test, resume, end)]
+    screens += [(feedback, FEEDBACK_HEIGHT) for feedback in (correct_feedback, incorrect_feedback)]
+    screens += [(block_break_message(block), MESSAGE_HEIGHT) for block in range(1, N_BLOCKS)]
+    return screens
+
+
+class ScreenCache:
+    """
+    Creates and keeps the text stimuli of the screens of a window.
+    """
+
+    def __init__(self):
+        self.window = None
+        self.hits = 0
+        self.misses = 0
+        self._screens = {}  # (text, text height) -> text stimulus
+
+    def __len__(self):
+        return len(self._screens)
+
+    def invalidate(self):
+        """Drop all text stimuli, e.g. after the window was changed. They are created again on first use."""
+        self._screens = {}
+        self.window = None
+
+    def _bind(self, window):
+        """Use the cache for a window; the stimuli of another window are dropped."""
+        if window is not self.window:
+            self.invalidate()
+            self.window = window
+
+    def _create(self, text, text_height):
+        return visual.TextStim(self.window, text=text, wrapWidth=2, height=text_height, color="black")
+
+    def build(self, window, screens=None):
+        """
+        Create the text stimuli of the screens of a window ahead of time.
+
+        Parameters:
+        window (psychopy.visual.Window): The window the screens are shown in.
+        screens (list of tuple, optional): The (text, text height) of the screens. Defaults to known_screens().
+        """
+        self._bind(window)
+        for text, text_height in screens if screens is not None else known_screens():
+            if (text, text_height) not in self._screens:
+                self._screens[(text, text_height)] = self._create(text, text_height)
+
+    def get(self, window, text, text_height=MESSAGE_HEIGHT):
+        """
+        Return the text stimulus of a screen, creating it if it isn't cached.
+
+        Parameters:
+        window (psychopy.visual.Window): The window the screen is shown in.
+        text (str): The text of the screen.
+        text_height (float, optional): The height of the text. Defaults to 0.1.
+
+        Returns:
+        psychopy.visual.TextStim: The text stimulus.
+        """
+        self._bind(window)
+        text_stim = self._screens.get((text, text_height))
+        if text_stim is not None:
+            self.hits += 1
+            return text_stim
+        self.misses += 1
+        text_stim = self._screens[(text, text_height)] = self._create(text, text_height)
+        return text_stim
+
+
+screen_cache = ScreenCache()
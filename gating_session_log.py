@@ -0,0 +1,35 @@
+"""
+gating_session_log.py
+
+This module contains the session log of the gating experiment.
+
+Diagnostics of a session that don't belong into the results (startup time, stimulus prefetching, ...) are appended to
+'results/<subject>/session_log.jsonl', one JSON object per line with the time, the experiment, the event and its
+values. Sessions of the same subject, e.g. a resumed one, are appended to the same log.
+
+Functions:
+    - log_session_event: Appends an event to the session log of a participant.
+"""
+
+import os
+import json
+import datetime
+
+
+def log_session_event(participant_info, event, **values):
+    """
+    Append an event to the session log of a participant.
+
+    Parameters:
+    participant_info (dict): The participant's information (name, date, experiment, etc.).
+    event (str): The name of the event, e.g. 'prefetch'.
+    **values: The values of the event; they must be JSON serializable.
+    """
+    subj_path_results = os.path.join('results', participant_info['subject'])
+    os.makedirs(subj_path_results, exist_ok=True)
+    entry = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+             'experiment': participant_info['experiment'],
+             'event': event,
+             **values}
+    with open(os.path.join(subj_path_results, 'session_log.jsonl'), 'a') as log_file:
+        log_file.write(json.dumps(entry) + '\n')
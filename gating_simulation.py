@@ -0,0 +1,372 @@
+"""
+gating_simulation.py
+
+This module contains the headless simulated backend of the gating experiment (see gating_backend.py).
+
+It provides the parts of the PsychoPy interfaces the experiment uses - window, stimuli, sound, keyboard, dialog,
+monitor and clock - without a screen, an audio device or a keyboard, so a whole session runs on a headless machine in
+a few seconds and writes the same results, randomization lists and logs as a real session:
+
+    - Time is virtual: core.wait() and the response times of the participant advance the clock instantly, and every
+      flip happens on the next frame of a simulated 60 Hz display. As in PsychoPy, window.flip() returns the time on a
+      logging clock that starts when the backend is imported, while core.getTime(), the key presses and the 'ptb'
+      clock of getFutureFlipTime() count from an earlier origin. The start and end times in the results follow the
+      virtual time too (see wall_time() in gating_backend.py): they start at the real time the session was started.
+    - The window remembers the stimuli drawn before each flip, so the participant can see the screen.
+    - The simulated participant answers the pictogram screen from what is on the screen and the stimulus that was
+      played (the sound is named after its stimulus file): a stochastic participant is correct with a probability
+      that depends on the gate, with log-normally distributed response times; a scripted participant gives the
+      responses of a list or a function. Instruction screens are confirmed after a short reading time.
+    - The participant dialog is filled in with the simulated subject ID.
+
+Usage:
+    python gating_experiment.py --simulate --subject SIM001 --seed 1
+
+Functions:
+    - configure: Sets the simulated subject ID and participant.
+
+Classes:
+    - SimulatedParticipant: Responds to the trials of the experiment.
+    - VirtualClock: The virtual time of the simulation.
+
+Interfaces (used through gating_backend.py):
+    - monitors, visual, gui, core, sound, event, keyboard
+"""
+
+import os
+import math
+import random
+import types
+from gating_manifest import parse_stimulus_filename
+
+FRAME_RATE = 60
+# The time of core.getTime() at which the logging clock of window.flip() starts, in seconds
+LOGGING_CLOCK_START = 100.0
+
+# Probability of a correct response by gate of the stochastic participant
+DEFAULT_ACCURACY = {1: 0.5, 2: 0.55, 3: 0.6, 4: 0.7, 5: 0.8, 6: 0.9, 7: 0.95}
+
+
+class VirtualClock:
+    """
+    The virtual time of the simulation, in seconds. Waiting advances the time instantly.
+    """
+
+    def __init__(self):
+        self.now = LOGGING_CLOCK_START
+
+    def advance(self, seconds):
+        """Advance the time by a number of seconds."""
+        if seconds > 0:
+            self.now += seconds
+
+    def next_frame(self, after=None):
+        """Return the time of the first frame after a time (default: now)."""
+        after = self.now if after is None else after
+        return (math.floor(after * FRAME_RATE + 1e-9) + 1) / FRAME_RATE
+
+
+class SimulatedParticipant:
+    """
+    Responds to the trials of the experiment.
+
+    Parameters:
+    accuracy (dict, optional): The probability of a correct response by gate. Defaults to DEFAULT_ACCURACY.
+    rt_median (float, optional): The median response time in seconds. Defaults to 0.8.
+    rt_sigma (float, optional): The standard deviation of the log response time. Defaults to 0.35.
+    instruction_time (float, optional): The time in seconds the participant needs to confirm a message. Defaults to 2.
+    script (list or callable, optional): Scripted responses: a list of keys ('left', 'right') given in turn, or a
+        function called with the stimulus metadata (or None) and the correct key that returns the key. If given, the
+        accuracy is not used.
+    seed (int, optional): The seed of the random number generator.
+    """
+
+    def __init__(self, accuracy=None, rt_median=0.8, rt_sigma=0.35, instruction_time=2.0, script=None, seed=None):
+        self.accuracy = DEFAULT_ACCURACY if accuracy is None else accuracy
+        self.rt_median = rt_median
+        self.rt_sigma = rt_sigma
+        self.instruction_time = instruction_time
+        self.script = iter(script) if isinstance(script, (list, tuple)) else script
+        self.rng = random.Random(seed)
+
+    def respond(self, key_list, screen, last_sound):
+        """
+        Choose the response to a screen.
+
+        Parameters:
+        key_list (list of str): The keys that are accepted.
+        screen (list): The stimuli on the screen.
+        last_sound (Sound): The last sound that was played, or None.
+
+        Returns:
+        str: The key.
+        float: The response time in seconds.
+        """
+        if key_list is None or 'return' in key_list:
+            return 'return', self.instruction_time
+
+        stimulus = None
+        if last_sound is not None:
+            try:
+                stimulus = parse_stimulus_filename(last_sound.name)
+            except ValueError:
+                pass
+        correct_key = self._correct_key(screen, stimulus)
+
+        if callable(self.script):
+            key = self.script(stimulus, correct_key)
+        elif self.script is not None:
+            key = next(self.script)
+        else:
+            p_correct = self.accuracy.get(stimulus['gate'], 0.5) if stimulus is not None else 0.5
+            correct = self.rng.random() < p_correct
+            key = correct_key if correct else ('right' if correct_key == 'left' else 'left')
+        return key, self.rt_median * math.exp(self.rng.gauss(0, self.rt_sigma))
+
+    @staticmethod
+    def _correct_key(screen, stimulus):
+        """Return the side of the pictogram matching the condition of the stimulus."""
+        pictogram = {'bra': 'bracket.png', 'nob': 'no_bracket.png'}.get(stimulus['condition']) if stimulus else None
+        for stim in screen:
+            if pictogram is not None and os.path.basename(str(getattr(stim, 'image', ''))) == pictogram:
+                return 'left' if stim.pos[0] < 0 else 'right'
+        return 'left'
+
+
+class _Session:
+    """The state shared by the simulated interfaces."""
+
+    def __init__(self):
+        self.clock = VirtualClock()
+        self.participant = SimulatedParticipant()
+        self.subject = 'SIM001'
+        self.window = None
+        self.last_sound = None
+
+    def respond(self, key_list):
+        screen = self.window.screen if self.window is not None else []
+        key, response_time = self.participant.respond(key_list, screen, self.last_sound)
+        self.clock.advance(response_time)
+        return key, response_time
+
+
+_session = _Session()
+
+
+def configure(subject=None, participant=None):
+    """
+    Set the simulated subject ID and participant.
+
+    Parameters:
+    subject (str, optional): The subject ID entered in the participant dialog.
+    participant (SimulatedParticipant, optional): The participant responding to the trials.
+    """
+    if subject is not None:
+        _session.subject = subject
+    if participant is not None:
+        _session.participant = participant
+
+
+# core
+
+class Clock:
+    """A clock on the virtual time."""
+
+    def __init__(self):
+        self._start = _session.clock.now
+
+    def getTime(self):
+        return _session.clock.now - self._start
+
+    def reset(self, newT=0.0):
+        self._start = _session.clock.now - newT
+
+
+def _get_time():
+    return _session.clock.now
+
+
+def _wait(secs, hogCPUperiod=0.2):
+    _session.clock.advance(secs)
+
+
+def _quit():
+    raise SystemExit(0)
+
+
+core = types.SimpleNamespace(Clock=Clock, getTime=_get_time, wait=_wait, quit=_quit, monotonicClock=Clock(),
+                             rush=lambda value=True, realtime=False: value)
+
+
+# visual and monitors
+
+class Window:
+    """A window without a screen. Every flip happens on the next frame of the virtual display."""
+
+    def __init__(self, size=(1920, 1080), **kwargs):
+        self.size = size
+        self.monitorFramePeriod = 1.0 / FRAME_RATE
+        self.recordFrameIntervals = False
+        self.nDroppedFrames = 0
+        self.flips = 0
+        self.screen = []
+        self._drawn = []
+        _session.window = self
+
+    def flip(self, clearBuffer=True):
+        _session.clock.now = _session.clock.next_frame()
+        self.screen = self._drawn
+        self._drawn = []
+        self.flips += 1
+        return _session.clock.now - LOGGING_CLOCK_START
+
+    def getFutureFlipTime(self, targetTime=0, clock=None):
+        # The closest frame to the target time, but no earlier than the next frame
+        flip_time = _session.clock.next_frame(max(_session.clock.now + targetTime - self.monitorFramePeriod / 2,
+                                                  _session.clock.now))
+        if clock == 'ptb':
+            return flip_time
+        if clock == 'now':
+            return flip_time - _session.clock.now
+        return flip_time - LOGGING_CLOCK_START
+
+    def close(self):
+        _session.window = None
+
+
+class _Stim:
+    """A visual stimulus that is only remembered by the window it is drawn on."""
+
+    def __init__(self, win, **kwargs):
+        self.win = win
+        self.pos = (0, 0)
+        self.name = ''
+        self.__dict__.update(kwargs)
+
+    def draw(self, win=None):
+        (win or self.win)._drawn.append(self)
+
+
+class TextStim(_Stim):
+    pass
+
+
+class ImageStim(_Stim):
+    pass
+
+
+class ShapeStim(_Stim):
+    pass
+
+
+class Monitor:
+    """A monitor with a fixed resolution."""
+
+    def __init__(self, name='testMonitor', **kwargs):
+        self.name = name
+        self._size = [1920, 1080]
+
+    def getSizePix(self):
+        return self._size
+
+    def setSizePix(self, size):
+        self._size = list(size)
+
+
+visual = types.SimpleNamespace(Window=Window, TextStim=TextStim, ImageStim=ImageStim, ShapeStim=ShapeStim)
+monitors = types.SimpleNamespace(Monitor=Monitor)
+
+
+# sound
+
+class Sound:
+    """A sound that is not played. The simulated participant recognizes it by its name, the stimulus file."""
+
+    def __init__(self, value='C', secs=0.5, sampleRate=44100, name='', **kwargs):
+        self.name = name
+        self.sample_rate = sampleRate
+        self.duration = len(value) / sampleRate if hasattr(value, '__len__') and not isinstance(value, str) else secs
+        self.onset = None
+        self.track = None
+
+    def play(self, when=None, **kwargs):
+        self.onset = when if when is not None else _session.clock.now
+        _session.last_sound = self
+
+    def stop(self):
+        pass
+
+    def getDuration(self):
+        return self.duration
+
+
+sound = types.SimpleNamespace(Sound=Sound)
+
+
+# keyboard, event and gui
+
+class KeyPress:
+    """A simulated key press."""
+
+    def __init__(self, name, rt, tDown):
+        self.name = name
+        self.rt = rt
+        self.tDown = tDown
+        self.duration = None
+
+
+class Keyboard:
+    """
+    A keyboard on which the simulated participant responds.
+
+    Polled with getKeys(), the participant responds once to the screen shown when the keyboard buffer was last
+    cleared: the press is at the response time after the clear, and the key is released KEY_HOLD_DURATION later.
+    """
+
+    KEY_HOLD_DURATION = 0.1
+
+    def __init__(self, **kwargs):
+        self.clock = Clock()
+        self._buffer = []
+        self._pending = False
+
+    def clearEvents(self, eventType=None):
+        self._buffer = []
+        self._pending = True
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, waitRelease=True, clear=True):
+        key, _ = _session.respond(keyList)
+        return [KeyPress(key, self.clock.getTime(), _session.clock.now)]
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        if self._pending:
+            self._pending = False
+            key, _ = _session.respond(['left', 'right'])
+            key_press = KeyPress(key, self.clock.getTime(), _session.clock.now)
+            key_press.duration = self.KEY_HOLD_DURATION
+            self._buffer.append(key_press)
+        keys = [key for key in self._buffer if keyList is None or key.name in keyList]
+        if clear:
+            self._buffer = [key for key in self._buffer if key not in keys]
+        return keys
+
+
+def _wait_keys(maxWait=float('inf'), keyList=None, modifiers=False, timeStamped=False, clearEvents=True):
+    key, _ = _session.respond(keyList)
+    return [(key, _session.clock.now)] if timeStamped else [key]
+
+
+class DlgFromDict:
+    """The participant dialog, filled in with the simulated subject ID."""
+
+    def __init__(self, dictionary, title='', fixed=(), **kwargs):
+        if 'subject' not in fixed:
+            dictionary['subject'] = _session.subject
+        self.data = dictionary
+        self.OK = True
+
+
+keyboard = types.SimpleNamespace(Keyboard=Keyboard, KeyPress=KeyPress)
+event = types.SimpleNamespace(waitKeys=_wait_keys, getKeys=lambda keyList=None, **kwargs: [],
+                              clearEvents=lambda eventType=None: None)
+gui = types.SimpleNamespace(DlgFromDict=DlgFromDict)
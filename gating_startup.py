@@ -0,0 +1,198 @@
+"""
+gating_startup.py
+
+This module contains the startup path of the gating experiment.
+
+The experiment used to prepare everything one step after another: import PsychoPy's sound stack, wait for the
+participant dialog, and only then randomize, load the stimuli and open the window. Most of this doesn't depend on the
+participant, so it is now done in the background while the experimenter is typing into the dialog:
+
+    - for both phases, open the stimulus source, load or update the stimulus manifest, look up the playback-ready
+      copies of the stimuli in the stimulus cache (see gating_validate.py) and decode all stimuli into a stimulus bank
+      (if the whole phase fits into the memory limit - otherwise the bank is filled in presentation order when the
+      phase starts).
+
+PsychoPy's sound stack, which gating_backend.py imports on first use, is imported right after the dialog, on the main
+thread (the audio backend must not be initialized on a worker thread while the GUI runs on the main thread): a short
+silent sound is created so the audio backend is initialized before the first trial (warm_up_audio()). It runs while
+the background threads finish. Only the randomization, which needs the subject ID, the window and the pictograms are
+left after that.
+
+StartupTimer records how long every step took, from the launch of the script to the first instruction screen; the
+report is printed and saved next to the results as 'startup_<experiment>_<subject>_<timestamp>.csv'. Background steps
+are listed with the time they took in their thread; 'waiting for background preparation' is the part of them that
+was not hidden behind the dialog.
+
+Functions:
+    - warm_up_audio: Initializes the audio backend on the calling thread.
+
+Classes:
+    - StartupTimer: Records the duration of the startup steps.
+    - BackgroundPreparation: Prepares the stimuli in background threads.
+"""
+
+import os
+import csv
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from gating_stimulus_bank import StimulusBank, WavDirectory, open_stimulus_source
+from gating_manifest import load_manifest
+from gating_validate import CachedSource
+
+
+class StartupTimer:
+    """
+    Records the duration of the startup steps.
+
+    Parameters:
+    launch_time (float, optional): The time.perf_counter() value at the launch of the script. Defaults to now.
+    """
+
+    def __init__(self, launch_time=None):
+        self.launch_time = launch_time if launch_time is not None else time.perf_counter()
+        self.steps = []  # (step, seconds)
+        self._last = self.launch_time
+
+    def mark(self, step):
+        """
+        Record that a step has finished; its duration is the time since the previous step.
+
+        Parameters:
+        step (str): The name of the step.
+        """
+        now = time.perf_counter()
+        self.steps.append((step, now - self._last))
+        self._last = now
+
+    def add(self, step, seconds):
+        """
+        Record a step that ran in the background.
+
+        Parameters:
+        step (str): The name of the step.
+        seconds (float): Its duration.
+        """
+        self.steps.append((f"background: {step}", seconds))
+
+    def total(self):
+        """Return the time from the launch until the last recorded step, in seconds."""
+        return self._last - self.launch_time
+
+    def report(self, participant_info=None):
+        """
+        Print the startup report and save it next to the results of the participant.
+
+        Parameters:
+        participant_info (dict, optional): The participant's information. If None, the report is only printed.
+        """
+        print("Startup timing:")
+        for step, seconds in self.steps:
+            print(f"  {step:<45}{seconds * 1000:>10.1f} ms")
+        print(f"  {'launch to first instruction screen':<45}{self.total() * 1000:>10.1f} ms")
+
+        if participant_info is None:
+            return
+        subj_path_results = os.path.join('results', participant_info['subject'])
+        os.makedirs(subj_path_results, exist_ok=True)
+        report_filename = os.path.join(subj_path_results,
+                                       f"startup_{participant_info['experiment']}_{participant_info['subject']}_"
+                                       f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        with open(report_filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['step', 'duration_ms'])
+            for step, seconds in self.steps + [('launch to first instruction screen', self.total())]:
+                writer.writerow([step, f"{seconds * 1000:.1f}"])
+
+
+def warm_up_audio(sample_rate, timer=None):
+    """
+    Import the sound stack and initialize the audio backend with a short silent sound. Must be called on the main
+    thread, after the participant dialog is closed.
+
+    Parameters:
+    sample_rate (int): The sample rate of the silent sound.
+    timer (StartupTimer, optional): The timer the warm-up is recorded in.
+    """
+    from gating_backend import sound
+    sound.Sound(np.zeros(int(sample_rate * 0.05), dtype=np.float32), sampleRate=sample_rate)
+    if timer is not None:
+        timer.mark('audio warm-up')
+
+
+def _open_cache(source, manifest, cache_path, sample_rate, peak_level):
+    """Read the loose WAV files of a phase from the stimulus cache, as far as it holds them."""
+    cached_source = CachedSource(source, manifest, cache_path, sample_rate, peak_level)
+    if cached_source.missing and peak_level is not None:
+        raise ValueError(f"{len(cached_source.missing)} stimuli (e.g. {cached_source.missing[0]}) have no cache file "
+                         f"normalized to {peak_level}. Please run 'python gating_validate.py --cache --peak-level "
+                         f"{peak_level}' before the session.")
+    if cached_source.missing:
+        print(f"Warning: {len(cached_source.missing)} stimuli have no cache file and are converted when they are "
+              f"loaded. Please run 'python gating_validate.py --cache' before the session.")
+    return cached_source
+
+
+def _prepare_phase(stimuli_path, ungated_path, gates, sample_rate, memory_limit_mb, cache_path, peak_level, timings,
+                   phase):
+    """Open the stimulus source of a phase, load its manifest and decode its stimuli if they all fit into memory."""
+    start = time.perf_counter()
+    source = open_stimulus_source(stimuli_path, ungated_path, gates)
+    manifest = load_manifest(stimuli_path, source)
+    # Packed containers and generated gates are at the playback sample rate already
+    if cache_path is not None and isinstance(source, WavDirectory):
+        source = _open_cache(source, manifest, cache_path, sample_rate, peak_level)
+    timings[f"{phase} manifest"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bank = StimulusBank(stimuli_path, sample_rate, memory_limit_mb, source=source)
+    decoded_bytes = sum(record.frames * sample_rate / record.sample_rate * 4 for record in manifest)
+    if decoded_bytes <= bank.memory_limit:
+        bank.preload(manifest.filenames())
+    timings[f"{phase} stimulus bank"] = time.perf_counter() - start
+    return source, manifest, bank
+
+
+class BackgroundPreparation:
+    """
+    Prepares the stimuli of all phases in background threads, one per phase.
+
+    Parameters:
+    phase_paths (dict): Phase -> (stimuli path, ungated path or None).
+    gates (tuple of int): The gates generated when an ungated path is given.
+    sample_rate (int): The sample rate of the stimulus banks.
+    memory_limit_mb (float): The memory limit of each stimulus bank.
+    cache_path (str, optional): The stimulus cache folder. Defaults to None (the cache is not used).
+    peak_level (float, optional): The peak level of the normalized cache files. Defaults to None (not normalized).
+    """
+
+    def __init__(self, phase_paths, gates, sample_rate, memory_limit_mb, cache_path=None, peak_level=None):
+        self.timings = {}
+        self._executor = ThreadPoolExecutor(max_workers=len(phase_paths))
+        self._phases = {phase: self._executor.submit(_prepare_phase, stimuli_path, ungated_path, gates, sample_rate,
+                                                     memory_limit_mb, cache_path, peak_level, self.timings, phase)
+                        for phase, (stimuli_path, ungated_path) in phase_paths.items()}
+
+    def result(self, timer=None):
+        """
+        Wait until the preparation is finished.
+
+        Parameters:
+        timer (StartupTimer, optional): The timer the background steps are added to.
+
+        Returns:
+        dict: Phase -> (stimulus source, stimulus manifest, stimulus bank).
+
+        Raises:
+        Exception: Any error raised during the preparation.
+        """
+        try:
+            prepared = {phase: future.result() for phase, future in self._phases.items()}
+        finally:
+            self._executor.shutdown()
+        if timer is not None:
+            timer.mark('waiting for background preparation')
+            for step, seconds in self.timings.items():
+                timer.add(step, seconds)
+        return prepared
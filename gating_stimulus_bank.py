@@ -0,0 +1,207 @@
+"""
+gating_stimulus_bank.py
+
+This module contains the in-memory stimulus bank of the gating experiment.
+
+Instead of opening and decoding every WAV file between two trials, the bank decodes the whole randomized list of a
+phase once before the phase starts and keeps the PCM buffers in memory. The memory used by the bank is capped; when the
+cap is reached, the least recently used buffers are evicted and decoded again on demand. The recordings a
+GateGenerator keeps count against the same cap: they may only occupy the memory the buffers leave free. The bank is
+used by the trial loop and by the prefetcher's worker thread, so its buffers are guarded by a lock.
+
+The time needed to load every stimulus is recorded, so slow files can be identified after a session.
+
+Stimuli are read from a stimulus source. A source has a list_files() method returning the stimulus filenames and a
+load(stimulus_file) method returning the samples and their sample rate. If a packed container exists for a stimulus
+directory (see gating_stimulus_pack.py), it is used instead of the loose WAV files. The gates can also be generated
+from the ungated recordings (see gating_gates.py).
+
+Functions:
+    - open_stimulus_source: Returns the stimulus source for a stimulus directory.
+
+Classes:
+    - WavDirectory: A stimulus source reading the loose WAV files of a directory.
+    - StimulusBank: Preloads, caches and serves the decoded stimuli of one phase.
+"""
+
+import os
+import csv
+import time
+import threading
+from collections import OrderedDict
+from gating_audio import read_wav, resample
+from gating_stimulus_pack import StimulusContainer, container_path_for
+from gating_gates import GateGenerator, ALL_GATES
+
+
+class WavDirectory:
+    """
+    A stimulus source reading the loose WAV files of a directory.
+
+    Parameters:
+    stimuli_path (str): The path to the directory containing the stimulus files.
+    """
+
+    def __init__(self, stimuli_path):
+        self.stimuli_path = stimuli_path
+
+    def list_files(self):
+        """Return the filenames of all WAV files in the directory."""
+        return [f for f in os.listdir(self.stimuli_path) if f.endswith('.wav')]
+
+    def load(self, stimulus_file):
+        """Decode a stimulus file and return its samples and sample rate."""
+        return read_wav(os.path.join(self.stimuli_path, stimulus_file))
+
+
+def open_stimulus_source(stimuli_path, ungated_path=None, gates=ALL_GATES):
+    """
+    Return the stimulus source for a stimulus directory.
+
+    If an ungated folder is given, the gates are generated from its recordings and the stimulus directory doesn't need
+    to exist. Otherwise the packed container of the directory is preferred. It is ignored (with a warning) if the
+    directory has been modified after the container was written, because the container would then serve outdated
+    stimuli.
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus directory.
+    ungated_path (str, optional): The folder with the ungated recordings and their TextGrids. Defaults to None.
+    gates (tuple, optional): The gates generated per recording if ungated_path is given. Defaults to all gates.
+
+    Returns:
+    GateGenerator, StimulusContainer or WavDirectory: The stimulus source.
+    """
+    if ungated_path is not None:
+        return GateGenerator(ungated_path, gates)
+
+    container_path = container_path_for(stimuli_path)
+    if os.path.exists(container_path):
+        if os.path.isdir(stimuli_path) and os.path.getmtime(stimuli_path) > os.path.getmtime(container_path):
+            print(f"Warning: {container_path} is older than {stimuli_path} and is ignored. Please pack the "
+                  f"stimuli again.")
+        else:
+            return StimulusContainer(container_path)
+    return WavDirectory(stimuli_path)
+
+
+class StimulusBank:
+    """
+    An in-memory bank of decoded stimuli with a memory cap and least-recently-used eviction.
+
+    Parameters:
+    stimuli_path (str): The path to the directory containing the stimulus files.
+    sample_rate (int, optional): The sample rate the buffers are converted to. Defaults to 44100.
+    memory_limit_mb (float, optional): The maximum memory the buffers may occupy, in megabytes. Defaults to 512.
+    source (optional): The stimulus source to read from. Defaults to open_stimulus_source(stimuli_path).
+    """
+
+    def __init__(self, stimuli_path, sample_rate=44100, memory_limit_mb=512, source=None):
+        self.stimuli_path = stimuli_path
+        self.source = source if source is not None else open_stimulus_source(stimuli_path)
+        self.sample_rate = sample_rate
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024)
+        self.memory_used = 0
+        self.load_times = {}  # filename -> seconds needed to load the file (last load)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._buffers = OrderedDict()
+        self._lock = threading.RLock()
+        self._update_source_limit()
+
+    def __contains__(self, stimulus_file):
+        with self._lock:
+            return stimulus_file in self._buffers
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buffers)
+
+    def _load(self, stimulus_file):
+        """Load a stimulus from the source, convert it to the bank's sample rate and record the load time."""
+        load_start = time.perf_counter()
+        samples, file_rate = self.source.load(stimulus_file)
+        samples = resample(samples, file_rate, self.sample_rate)
+        self.load_times[stimulus_file] = time.perf_counter() - load_start
+        return samples
+
+    def _update_source_limit(self):
+        """Let the recordings of the source (see GateGenerator) occupy the memory the buffers leave free."""
+        if hasattr(self.source, 'set_memory_limit'):
+            self.source.set_memory_limit(max(self.memory_limit - self.memory_used, 0))
+
+    def _store(self, stimulus_file, samples):
+        """
+        Store a buffer and evict the least recently used buffers until the memory cap is respected. The caller holds
+        the lock.
+        """
+        previous = self._buffers.pop(stimulus_file, None)
+        if previous is not None:
+            self.memory_used -= previous.nbytes
+        self._buffers[stimulus_file] = samples
+        self.memory_used += samples.nbytes
+        while self.memory_used > self.memory_limit and len(self._buffers) > 1:
+            _, evicted = self._buffers.popitem(last=False)
+            self.memory_used -= evicted.nbytes
+            self.evictions += 1
+        self._update_source_limit()
+
+    def preload(self, stimuli_files):
+        """
+        Decode the stimuli of a phase in presentation order before the phase starts.
+
+        Loading stops once the memory cap would be exceeded, so the stimuli needed first are never evicted by the
+        ones needed last; the remaining files are loaded on demand during the phase.
+
+        Parameters:
+        stimuli_files (list): The randomized list of stimulus filenames of the phase.
+
+        Returns:
+        int: The number of stimuli that are now held in memory.
+        """
+        for stimulus_file in stimuli_files:
+            if stimulus_file in self:
+                continue
+            samples = self._load(stimulus_file)
+            with self._lock:
+                if self.memory_used + samples.nbytes > self.memory_limit:
+                    break
+                self._store(stimulus_file, samples)
+        return len(self)
+
+    def get(self, stimulus_file):
+        """
+        Return the decoded samples of a stimulus, loading it if it is not in memory.
+
+        Parameters:
+        stimulus_file (str): The filename of the stimulus.
+
+        Returns:
+        numpy.ndarray: The float32 samples at the bank's sample rate.
+        """
+        with self._lock:
+            samples = self._buffers.get(stimulus_file)
+            if samples is not None:
+                self._buffers.move_to_end(stimulus_file)
+                self.hits += 1
+                return samples
+            self.misses += 1
+
+        # Decode without holding the lock, so the other thread isn't held up
+        samples = self._load(stimulus_file)
+        with self._lock:
+            self._store(stimulus_file, samples)
+        return samples
+
+    def save_load_times(self, filepath):
+        """
+        Write the per-stimulus load times to a CSV file, slowest stimulus first.
+
+        Parameters:
+        filepath (str): The path of the CSV file to write.
+        """
+        with open(filepath, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['filename', 'load_time_ms'])
+            for stimulus_file, seconds in sorted(self.load_times.items(), key=lambda item: item[1], reverse=True):
+                writer.writerow([stimulus_file, f"{seconds * 1000:.3f}"])
@@ -0,0 +1,176 @@
+"""
+gating_stimulus_pack.py
+
+This module packs a directory of stimulus WAV files into a single contiguous container and reads it back through a
+memory map.
+
+On machines with network home directories and on-access virus scanning, opening hundreds of small files per session is
+slow. A container is opened once; the samples of every stimulus are served as zero-copy views into the memory map.
+
+Container layout:
+    - 8 bytes: the magic number b'GPAK0001'.
+    - 8 bytes: the length of the index in bytes (unsigned little-endian integer).
+    - The index: UTF-8 encoded JSON with the sample format and one entry per stimulus holding filename, offset
+      (in bytes from the start of the container), frames, channels and sample rate.
+    - The samples of all stimuli as little-endian float32, each stimulus aligned to 64 bytes.
+
+The samples are converted to the playback sample rate when packing, so no conversion happens at runtime.
+
+Usage:
+    python gating_stimulus_pack.py stimuli/gated/test stimuli/gated/practice
+
+Functions:
+    - container_path_for: Returns the container path belonging to a stimulus directory.
+    - pack_stimuli: Packs a stimulus directory into a container.
+
+Classes:
+    - StimulusContainer: Reads a container through a memory map.
+"""
+
+import os
+import json
+import mmap
+import struct
+import argparse
+import numpy as np
+from gating_audio import read_wav, resample
+
+MAGIC = b'GPAK0001'
+ALIGNMENT = 64
+
+
+def container_path_for(stimuli_path):
+    """
+    Return the path of the container belonging to a stimulus directory ('stimuli/gated/test/' -> 'stimuli/gated/test.gpak').
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus directory.
+
+    Returns:
+    str: The path of the container file.
+    """
+    return os.path.normpath(stimuli_path) + '.gpak'
+
+
+def _aligned(position):
+    """Round a byte position up to the next multiple of ALIGNMENT."""
+    return (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def pack_stimuli(stimuli_path, container_path=None, sample_rate=44100):
+    """
+    Pack all WAV files of a stimulus directory into one container.
+
+    The container is written to a temporary file first and moved into place afterwards, so a running experiment never
+    sees a half-written container.
+
+    Parameters:
+    stimuli_path (str): The path to the directory containing the stimulus files.
+    container_path (str, optional): The path of the container to write. Defaults to container_path_for(stimuli_path).
+    sample_rate (int, optional): The sample rate the stimuli are converted to. Defaults to 44100.
+
+    Returns:
+    str: The path of the written container.
+    """
+    if container_path is None:
+        container_path = container_path_for(stimuli_path)
+
+    stimuli_files = sorted(f for f in os.listdir(stimuli_path) if f.endswith('.wav'))
+
+    # Decode everything first, the offsets depend on the size of the index
+    buffers = []
+    entries = []
+    for stimulus_file in stimuli_files:
+        samples, file_rate = read_wav(os.path.join(stimuli_path, stimulus_file))
+        samples = np.ascontiguousarray(resample(samples, file_rate, sample_rate), dtype='<f4')
+        buffers.append(samples)
+        entries.append({'filename': stimulus_file,
+                        'offset': 0,
+                        'frames': samples.shape[0],
+                        'channels': 1 if samples.ndim == 1 else samples.shape[1],
+                        'sample_rate': sample_rate})
+
+    # The index holds the offsets, so reserve room for the largest possible offset values before computing them
+    for entry in entries:
+        entry['offset'] = 2 ** 63 - 1
+    index_length = len(json.dumps({'dtype': '<f4', 'entries': entries}).encode('utf-8'))
+    position = _aligned(len(MAGIC) + 8 + index_length)
+    for entry, samples in zip(entries, buffers):
+        entry['offset'] = position
+        position = _aligned(position + samples.nbytes)
+
+    index = json.dumps({'dtype': '<f4', 'entries': entries}).encode('utf-8')
+
+    temporary_path = container_path + '.tmp'
+    with open(temporary_path, 'wb') as container:
+        container.write(MAGIC)
+        container.write(struct.pack('<Q', len(index)))
+        container.write(index)
+        for entry, samples in zip(entries, buffers):
+            container.write(b'\0' * (entry['offset'] - container.tell()))
+            container.write(samples.tobytes())
+        container.flush()
+        os.fsync(container.fileno())
+    os.replace(temporary_path, container_path)
+
+    return container_path
+
+
+class StimulusContainer:
+    """
+    A stimulus container opened through a read-only memory map.
+
+    Parameters:
+    container_path (str): The path of the container file.
+    """
+
+    def __init__(self, container_path):
+        self.container_path = container_path
+        with open(container_path, 'rb') as container:
+            self._mmap = mmap.mmap(container.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{container_path} is not a stimulus container")
+        index_length, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        index_start = len(MAGIC) + 8
+        index = json.loads(self._mmap[index_start:index_start + index_length].decode('utf-8'))
+
+        self.dtype = np.dtype(index['dtype'])
+        self.entries = {entry['filename']: entry for entry in index['entries']}
+
+    def list_files(self):
+        """Return the filenames of all stimuli in the container."""
+        return list(self.entries)
+
+    def load(self, stimulus_file):
+        """
+        Return the samples of a stimulus as a zero-copy, read-only view into the memory map.
+
+        Parameters:
+        stimulus_file (str): The filename of the stimulus.
+
+        Returns:
+        numpy.ndarray: The samples, shape (frames,) for mono or (frames, channels) otherwise.
+        int: The sample rate of the samples in Hz.
+        """
+        entry = self.entries[stimulus_file]
+        samples = np.frombuffer(self._mmap, dtype=self.dtype, count=entry['frames'] * entry['channels'],
+                                offset=entry['offset'])
+        if entry['channels'] > 1:
+            samples = samples.reshape(entry['frames'], entry['channels'])
+        return samples, entry['sample_rate']
+
+    def close(self):
+        """Close the memory map. Views returned by load() must not be used afterwards."""
+        self._mmap.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack stimulus directories into memory-mappable containers.')
+    parser.add_argument('stimuli_paths', nargs='+', help='stimulus directories to pack')
+    parser.add_argument('--sample-rate', type=int, default=44100, help='sample rate of the packed stimuli')
+    args = parser.parse_args()
+
+    for path in args.stimuli_paths:
+        print(f"Packed {path} into {pack_stimuli(path, sample_rate=args.sample_rate)}")
@@ -0,0 +1,274 @@
+"""
+gating_timeline.py
+
+This module contains the scheduled trial timeline of the gating experiment.
+
+present_trial() chains window.flip(), play() and core.wait() calls: every wait starts when the previous call returned,
+so the delays add up from trial to trial, and the sound starts when play() is called instead of with the flip that
+shows the audio pictogram. In scheduled mode (scheduled_timeline in gating_configuration.py) every phase is compiled
+into a timeline before its first trial: for every trial the target times of the fixation, blank, audio and response
+screens, relative to the fixation flip and rounded to whole frames. The durations of the stimuli are taken from the
+stimulus manifest; without a manifest, the timeline of each trial is compiled from its prefetched stimulus just before
+the trial, so the stimuli are not all decoded before the phase. A tight scheduler loop then runs each trial:
+
+    - every screen is flipped at the frame closest to its target time, computed from the fixation flip of the trial,
+      so waits don't accumulate drift;
+    - the sound is scheduled for the predicted time of the flip that shows the audio pictogram
+      (play(when=window.getFutureFlipTime(clock='ptb'))), so it starts with the pictogram;
+    - the pause after the response ends at a fixed time after the flip that cleared the response screen.
+
+The target and achieved time of every event are logged and saved next to the results as '<results_file>_timeline.csv'.
+For the sound, the scheduled onset is logged as the target, and the onset reported by the PTB audio stream (if it is
+available) as the achieved time.
+
+All times are on the clock of core.getTime(), which is also the clock of the key presses and of the PTB audio stream
+(getFutureFlipTime(clock='ptb')). window.flip() returns the time on PsychoPy's logging clock, which starts when PsychoPy
+is imported, so every flip is timestamped with core.getTime() as soon as it returns. Before the first trial of a phase,
+check_clocks() flips twice and checks that the predicted flip time is on the same clock as the achieved one.
+
+Functions:
+    - compile_trial_timeline: Compiles the timeline of one trial.
+    - compile_phase_timeline: Compiles the timelines of all trials of a phase.
+    - check_clocks: Checks that the predicted and the achieved flip times are on the same clock.
+    - run_trial_timeline: Runs the timeline of one trial.
+
+Classes:
+    - TimelineEvent: An event of a trial timeline.
+    - TimelineLog: The target and achieved times of all events of a phase.
+"""
+
+import os
+import csv
+import math
+import collections
+from contextlib import nullcontext
+from gating_backend import core
+from gating_trace import NULL_TRACER
+
+# Durations of the fixed parts of a trial, in seconds
+FIXATION_DURATION = 1.0
+POST_SOUND_DURATION = 0.5
+POST_RESPONSE_DURATION = 1.0
+
+# An event of a trial timeline: the screen to flip, its target time relative to the fixation flip in seconds, the
+# stimuli to draw and whether the sound starts with the flip
+TimelineEvent = collections.namedtuple('TimelineEvent', ['name', 'offset', 'draw', 'plays_sound'])
+
+
+def _frames(seconds, frame_interval):
+    """Round a duration to whole frames."""
+    return round(seconds / frame_interval) * frame_interval
+
+
+def compile_trial_timeline(duration, frame_interval):
+    """
+    Compile the timeline of one trial.
+
+    Parameters:
+    duration (float): The duration of the stimulus of the trial, in seconds.
+    frame_interval (float): The refresh interval of the monitor, in seconds.
+
+    Returns:
+    tuple of TimelineEvent: The events of the trial, in the order they are flipped.
+    """
+    fixation = _frames(FIXATION_DURATION, frame_interval)
+    audio = fixation + frame_interval  # the audio pictogram follows the blank screen on the next frame
+    return (
+        TimelineEvent('fixation', 0.0, ('fixation_cross',), False),
+        TimelineEvent('blank', fixation, (), False),
+        TimelineEvent('audio', audio, ('audio_pic',), True),
+        TimelineEvent('response', audio + _frames(duration + POST_SOUND_DURATION, frame_interval),
+                      ('bracket_pic', 'nobracket_pic'), False),
+    )
+
+
+def compile_phase_timeline(durations, frame_interval):
+    """
+    Compile the timelines of all trials of a phase.
+
+    Parameters:
+    durations (list of float): The duration of the stimulus of every trial, in seconds.
+    frame_interval (float): The refresh interval of the monitor, in seconds.
+
+    Returns:
+    list of tuple of TimelineEvent: The events of every trial, in the order they are flipped.
+    """
+    return [compile_trial_timeline(duration, frame_interval) for duration in durations]
+
+
+class TimelineLog:
+    """
+    The target and achieved times of all events of a phase, in seconds on the clock of core.getTime().
+    """
+
+    FIELDNAMES = ['trial', 'event', 'target_time', 'achieved_time', 'error_ms']
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, trial, event, target_time, achieved_time):
+        """
+        Log an event.
+
+        Parameters:
+        trial (int): The trial number.
+        event (str): The name of the event.
+        target_time (float): The time the event was scheduled for.
+        achieved_time (float): The time the event happened, or None if it is unknown.
+        """
+        error_ms = (achieved_time - target_time) * 1000 if achieved_time is not None else None
+        self.rows.append({'trial': trial, 'event': event, 'target_time': target_time,
+                          'achieved_time': achieved_time, 'error_ms': error_ms})
+
+    def trial_error(self, trial):
+        """
+        Return the largest absolute timing error of the events of a trial, in milliseconds.
+
+        Parameters:
+        trial (int): The trial number; it must be the last trial added.
+
+        Returns:
+        float: The error, NaN if no event of the trial has a known achieved time.
+        """
+        errors = []
+        for row in reversed(self.rows):
+            if row['trial'] != trial:
+                break
+            if row['error_ms'] is not None:
+                errors.append(abs(row['error_ms']))
+        return max(errors) if errors else math.nan
+
+    def summary(self):
+        """
+        Return the median and maximum absolute timing error of every event, in milliseconds.
+
+        Returns:
+        dict: Event -> (median, maximum).
+        """
+        errors = {}
+        for row in self.rows:
+            if row['error_ms'] is not None:
+                errors.setdefault(row['event'], []).append(abs(row['error_ms']))
+        return {event: (sorted(values)[len(values) // 2], max(values)) for event, values in errors.items()}
+
+    def save(self, filename):
+        """
+        Save the log as a CSV file. The rows are appended if the file exists, e.g. when a phase was resumed.
+
+        Parameters:
+        filename (str): The path of the CSV file.
+        """
+        file_exists = os.path.exists(filename)
+        with open(filename, 'a', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=self.FIELDNAMES)
+            if not file_exists:
+                writer.writeheader()
+            writer.writerows(self.rows)
+
+
+def _flip(window):
+    """Flip the window and return the time of the flip on the clock of core.getTime()."""
+    window.flip()
+    return core.getTime()
+
+
+def _flip_at(window, target_time, frame_interval):
+    """Wait until half a frame before the target time, then flip, so the flip happens on the closest frame."""
+    remaining = target_time - frame_interval / 2 - core.getTime()
+    if remaining > 0:
+        core.wait(remaining)
+    return _flip(window)
+
+
+def check_clocks(window):
+    """
+    Check that the predicted flip times, which the sound onsets are scheduled for, and the achieved flip times are on
+    the same clock. If they weren't, every sound would be shifted against its audio pictogram by the offset between
+    the clocks.
+
+    Parameters:
+    window (psychopy.visual.Window): The window of the experiment. It is flipped twice.
+
+    Returns:
+    float: The difference between the achieved and the predicted time of a flip, in seconds.
+
+    Raises:
+    RuntimeError: If they differ by more than one and a half frames.
+    """
+    _flip(window)
+    predicted = window.getFutureFlipTime(targetTime=0, clock='ptb')
+    achieved = _flip(window)
+    if abs(achieved - predicted) > 1.5 * window.monitorFramePeriod:
+        raise RuntimeError(f"The predicted flip time ({predicted:.3f} s) and the achieved flip time ({achieved:.3f} s) "
+                           f"are not on the same clock, so the sound can't be scheduled with the flips. Set "
+                           f"scheduled_timeline to False in gating_configuration.py.")
+    return achieved - predicted
+
+
+def _audio_onset(gated_stimulus):
+    """Return the onset reported by the PTB audio stream of a sound, or None if it is not available."""
+    try:
+        onset = gated_stimulus.track.status['StartTime']
+    except (AttributeError, KeyError, TypeError):
+        return None
+    return onset or None
+
+
+def run_trial_timeline(window, timeline, stimuli, gated_stimulus, responses, trial, log, tracer=NULL_TRACER,
+                       prefetcher=None):
+    """
+    Run the timeline of one trial and collect the response.
+
+    Parameters:
+    window (psychopy.visual.Window): The window to display the trial on.
+    timeline (tuple of TimelineEvent): The compiled events of the trial.
+    stimuli (dict): The visual stimuli by name ('fixation_cross', 'audio_pic', 'bracket_pic', 'nobracket_pic').
+    gated_stimulus (psychopy.sound.Sound): The gated stimulus sound.
+    responses (ResponseCollector): Collects the response from the keyboard (see gating_response.py).
+    trial (int): The trial number, for the log.
+    log (TimelineLog): The log the target and achieved times are added to.
+    tracer (TrialTracer, optional): Records the time of every stage of the trial. Defaults to a tracer that records
+        nothing.
+    prefetcher (StimulusPrefetcher, optional): Decodes upcoming stimuli during the pause after the response.
+
+    Returns:
+    Response: The response key ('left', 'right' or 'timeout') and the reaction times in seconds.
+    """
+    frame_interval = window.monitorFramePeriod
+    start_time = None
+    sound_onset = None
+
+    for event in timeline:
+        for name in event.draw:
+            stimuli[name].draw()
+
+        if start_time is None:
+            # The fixation flip anchors all target times of the trial
+            start_time = _flip(window)
+            target_time = start_time
+        else:
+            target_time = start_time + event.offset
+            if event.plays_sound:
+                sound_onset = window.getFutureFlipTime(targetTime=max(target_time - core.getTime(), 0), clock='ptb')
+                gated_stimulus.play(when=sound_onset)
+                responses.sound_started(sound_onset, gated_stimulus.getDuration())
+                tracer.mark('play')
+            flip_time = _flip_at(window, target_time, frame_interval)
+            log.add(trial, event.name, target_time, flip_time)
+        tracer.mark(f"{event.name}_flip")
+
+    responses.response_screen_shown()  # clear the keyboard buffer and reset the clock
+    response = responses.wait()  # wait until a key is pressed or the deadline has passed
+    tracer.mark('key')
+    log.add(trial, 'sound', sound_onset, _audio_onset(gated_stimulus))
+
+    end_time = _flip(window)
+    tracer.mark('end_flip')
+    remaining = end_time + POST_RESPONSE_DURATION - core.getTime()
+    with prefetcher.idle() if prefetcher is not None else nullcontext():
+        if remaining > 0:
+            core.wait(remaining)
+    log.add(trial, 'end', end_time + POST_RESPONSE_DURATION, core.getTime())
+    tracer.mark('end_wait')
+
+    return response
@@ -0,0 +1,202 @@
+"""
+gating_trace.py
+
+This module contains the optional timing trace of the trials of the gating experiment.
+
+A trial consists of the fixation flip, a 1 s wait, the audio flip, the sound, a 500 ms wait, the response screen and a
+final 1 s wait; without instrumentation it is not visible where the time within a trial goes. When tracing is enabled
+(trace_trials in gating_configuration.py), every trial records a high-resolution timestamp (time.perf_counter_ns) at
+each stage: the sound load, each flip, the play() call, the key event and the queueing of the result for the CSV file.
+The number of frames PsychoPy detected as dropped during the trial is recorded as well.
+
+Each trial is written as one compact JSON line to '<results_file>_trace.jsonl': the trial number, the stimulus, the
+start of the trial and the stages with their offset from the start in microseconds. Recording a stage costs one list
+append; the line is written to a buffered file at the end of the trial, well below a millisecond per trial. When
+tracing is disabled, the trial loop uses NULL_TRACER, whose methods do nothing.
+
+summarize_trace() computes the latency percentiles of every stage (the time since the previous stage) and the dropped
+frames of a trace file. It is called at the end of every traced phase, and can be run on a trace file:
+
+Usage:
+    python gating_trace.py results/S01/test_gating_experiment_S01_20240101_120000_trace.jsonl
+
+Functions:
+    - read_trace: Reads the trials of a trace file.
+    - summarize_trace: Computes the per-stage latency percentiles and dropped frames of a trace file.
+    - print_trace_summary: Prints a trace summary as a table.
+
+Classes:
+    - TrialTracer: Records the stages of every trial and writes them to a trace file.
+    - NullTracer: A tracer that records nothing.
+"""
+
+import json
+import time
+import argparse
+
+
+class TrialTracer:
+    """
+    Records the timestamps of the stages of every trial and writes them to a JSONL trace file.
+
+    Parameters:
+    trace_filename (str): The path of the trace file. Trials are appended if it exists.
+    window (psychopy.visual.Window, optional): The experiment window. If given, its frame intervals are recorded so the
+        dropped frames of every trial can be counted.
+    """
+
+    def __init__(self, trace_filename, window=None):
+        self.trace_filename = trace_filename
+        self.window = window
+        self._file = open(trace_filename, 'a')
+        self._marks = []
+        self._trial = None
+        self._stimulus = None
+        self._start = 0
+        self._dropped_frames = 0
+        if window is not None:
+            window.recordFrameIntervals = True
+
+    def begin_trial(self, trial, stimulus):
+        """
+        Start recording a trial.
+
+        Parameters:
+        trial (int): The trial number.
+        stimulus (str): The stimulus file of the trial.
+        """
+        self._trial = trial
+        self._stimulus = stimulus
+        self._marks = []
+        if self.window is not None:
+            self._dropped_frames = self.window.nDroppedFrames
+        self._start = time.perf_counter_ns()
+
+    def mark(self, stage):
+        """
+        Record that a stage of the current trial has been reached.
+
+        Parameters:
+        stage (str): The name of the stage, e.g. 'audio_flip'.
+        """
+        self._marks.append((stage, time.perf_counter_ns()))
+
+    def end_trial(self):
+        """Write the current trial to the trace file."""
+        start = self._start
+        trace = {'trial': self._trial,
+                 'stimulus': self._stimulus,
+                 'start_ns': start,
+                 'stages': [[stage, (timestamp - start) // 1000] for stage, timestamp in self._marks]}
+        if self.window is not None:
+            trace['dropped_frames'] = self.window.nDroppedFrames - self._dropped_frames
+        self._file.write(json.dumps(trace, separators=(',', ':')) + '\n')
+
+    def close(self):
+        """Close the trace file."""
+        self._file.close()
+
+
+class NullTracer:
+    """A tracer that records nothing, used when tracing is disabled."""
+
+    def begin_trial(self, trial, stimulus):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end_trial(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+def read_trace(trace_filename):
+    """
+    Read the trials of a trace file.
+
+    Parameters:
+    trace_filename (str): The path of the trace file.
+
+    Returns:
+    list of dict: One dict per trial, as written by TrialTracer.end_trial().
+    """
+    trials = []
+    with open(trace_filename) as trace_file:
+        for line in trace_file:
+            try:
+                trials.append(json.loads(line))
+            except ValueError:
+                # The last line is incomplete if the experiment was interrupted
+                break
+    return trials
+
+
+def _percentile(sorted_values, fraction):
+    """Return a percentile of a sorted list (nearest rank)."""
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def summarize_trace(trace_filename):
+    """
+    Compute the latency percentiles of every stage and the dropped frames of a trace file.
+
+    The latency of a stage is the time since the previous stage of the trial (since the start of the trial for the
+    first stage).
+
+    Parameters:
+    trace_filename (str): The path of the trace file.
+
+    Returns:
+    dict: 'trials' (number of trials), 'stages' (a list of dicts with the keys 'stage', 'count', 'median_ms',
+    'p95_ms', 'p99_ms' and 'max_ms', in the order the stages occur), 'dropped_frames' (the total number of dropped
+    frames) and 'trials_with_dropped_frames'.
+    """
+    trials = read_trace(trace_filename)
+    latencies = {}
+    for trial in trials:
+        previous = 0
+        for stage, offset in trial['stages']:
+            latencies.setdefault(stage, []).append((offset - previous) / 1000)
+            previous = offset
+
+    stages = []
+    for stage, values in latencies.items():
+        values.sort()
+        stages.append({'stage': stage, 'count': len(values), 'median_ms': _percentile(values, 0.5),
+                       'p95_ms': _percentile(values, 0.95), 'p99_ms': _percentile(values, 0.99),
+                       'max_ms': values[-1]})
+
+    dropped = [trial.get('dropped_frames', 0) for trial in trials]
+    return {'trials': len(trials), 'stages': stages, 'dropped_frames': sum(dropped),
+            'trials_with_dropped_frames': sum(1 for frames in dropped if frames)}
+
+
+def print_trace_summary(summary):
+    """
+    Print a trace summary as a table.
+
+    Parameters:
+    summary (dict): The summary returned by summarize_trace().
+    """
+    print(f"{summary['trials']} trials, {summary['dropped_frames']} dropped frames "
+          f"in {summary['trials_with_dropped_frames']} trials")
+    print(f"{'stage':<16}{'count':>7}{'median ms':>11}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in summary['stages']:
+        print(f"{stage['stage']:<16}{stage['count']:>7}{stage['median_ms']:>11.2f}{stage['p95_ms']:>10.2f}"
+              f"{stage['p99_ms']:>10.2f}{stage['max_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the timing trace of a phase.')
+    parser.add_argument('trace_files', nargs='+', help='trace files (*_trace.jsonl)')
+    args = parser.parse_args()
+
+    for trace_filename in args.trace_files:
+        print(trace_filename)
+        print_trace_summary(summarize_trace(trace_filename))
@@ -0,0 +1,259 @@
+"""
+gating_trial_log.py
+
+This module contains the trial log of the gating experiment.
+
+run_trial_phase() used to build a dictionary with 19 entries for every trial and keep all of them in a list, although
+most entries are the same on every trial of a phase (experiment, subject, date, phase, start time and the positions of
+the pictograms), and it formatted the end time and the duration of every trial while the participant was waiting for
+the next one. The trial log keeps the results of a phase in a fixed schema instead:
+
+    - the entries that are the same on every trial are stored once, in the header of the log;
+    - the numeric entries (trial, block, reaction times, accuracy, gate, end time) are stored in preallocated typed
+      arrays, one per column;
+    - the categorical entries (stimulus, response, speaker, item, condition) are interned: every distinct value is
+      stored once and the column holds its code.
+
+Appending a trial writes one value into each array. The result dictionary of a trial, with the formatted times, is only
+created when it is needed: by the results writer on its own thread, or when the log is exported. The memory of a log
+grows with the number of trials by a few dozen bytes per trial, however long the session is.
+
+view() returns the columns as NumPy arrays without copying them, e.g. for the analysis at the end of a phase:
+
+    columns = trial_log.view()
+    mean_rt = columns['reaction_time'][columns['accuracy'] == 1].mean()
+
+The log can be exported to a CSV file with the columns of the results files, or to a Parquet file (this requires
+pyarrow, which is not installed with PsychoPy).
+
+Classes:
+    - TrialLog: Keeps the results of the trials of a phase in typed arrays.
+"""
+
+import csv
+import datetime
+import numpy as np
+
+# The numeric columns and their types
+NUMERIC_COLUMNS = {'trial': np.int32, 'block': np.int16, 'reaction_time': np.float64, 'accuracy': np.int8,
+                   'gate': np.int16, 'end_time': np.float64, 'rt_onset': np.float64, 'rt_offset': np.float64}
+# The reaction times, which are missing (NaN) if the trial timed out
+RT_COLUMNS = ('reaction_time', 'rt_onset', 'rt_offset')
+# The categorical columns, stored as codes into the list of their values
+CATEGORICAL_COLUMNS = ('stimulus', 'response', 'speaker', 'name_stim', 'condition')
+# The entries that are the same on every trial of a phase
+HEADER_FIELDS = ('experiment', 'subjectID', 'date', 'phase', 'bracket_pic_position', 'nobracket_pic_position',
+                 'start_time')
+
+# The columns of the results files, in order
+FIELDNAMES = ['experiment', 'subjectID', 'date', 'trial', 'block', 'phase', 'stimulus', 'response', 'reaction_time',
+              'accuracy', 'speaker', 'gate', 'name_stim', 'condition', 'bracket_pic_position', 'nobracket_pic_position',
+              'start_time', 'end_time', 'duration', 'rt_onset', 'rt_offset']
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')
+
+
+def _format_duration(seconds):
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return '{:02d}:{:02d}:{:02d}'.format(int(hours), int(minutes), int(seconds))
+
+
+class TrialLog:
+    """
+    Keeps the results of the trials of a phase in preallocated typed arrays.
+
+    Parameters:
+    header (dict): The entries that are the same on every trial (see HEADER_FIELDS). 'start_time' is the start of the
+        phase as a time.time() value, e.g. from wall_time() of gating_backend.py.
+    capacity (int, optional): The number of trials to allocate memory for. The log grows if more trials are appended.
+        Defaults to 256.
+    """
+
+    def __init__(self, header, capacity=256):
+        missing = [field for field in HEADER_FIELDS if field not in header]
+        if missing:
+            raise ValueError(f"The header of the trial log lacks {', '.join(missing)}.")
+        self.header = dict(header)
+        self._header_text = {field: str(header[field]) for field in HEADER_FIELDS if field != 'start_time'}
+        self._header_text['start_time'] = _format_time(header['start_time'])
+        self._length = 0
+        self._columns = {name: np.zeros(max(capacity, 1), dtype=dtype) for name, dtype in NUMERIC_COLUMNS.items()}
+        self._columns.update({name: np.zeros(max(capacity, 1), dtype=np.int32) for name in CATEGORICAL_COLUMNS})
+        self._categories = {name: [] for name in CATEGORICAL_COLUMNS}
+        self._codes = {name: {} for name in CATEGORICAL_COLUMNS}  # value -> code
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def capacity(self):
+        """The number of trials memory is allocated for."""
+        return len(self._columns['trial'])
+
+    def _intern(self, name, value):
+        """Return the code of a value of a categorical column, adding the value if it is new."""
+        codes = self._codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self._categories[name])
+            self._categories[name].append(value)
+        return code
+
+    def _grow(self):
+        """Double the capacity. The new arrays replace the old ones only once they hold all trials."""
+        for name, column in self._columns.items():
+            grown = np.zeros(2 * len(column), dtype=column.dtype)
+            grown[:self._length] = column[:self._length]
+            self._columns[name] = grown
+
+    def append(self, trial, block, stimulus, response, reaction_time, accuracy, speaker, gate, name_stim, condition,
+               end_time, rt_onset=np.nan, rt_offset=np.nan):
+        """
+        Append the result of a trial.
+
+        Parameters:
+        trial (int): The trial number.
+        block (int): The block number.
+        stimulus (str): The stimulus file.
+        response (str): The response key.
+        reaction_time (float): The reaction time from the response screen in seconds, NaN if the trial timed out.
+        accuracy (int): 1 if the response was correct, else 0.
+        speaker (str): The speaker of the stimulus.
+        gate (int or str): The gate of the stimulus.
+        name_stim (str): The item of the stimulus.
+        condition (str): The condition of the stimulus.
+        end_time (float): The end of the trial as a time.time() value.
+        rt_onset (float, optional): The reaction time from the sound onset in seconds. Defaults to NaN (unknown).
+        rt_offset (float, optional): The reaction time from the sound offset in seconds. Defaults to NaN (unknown).
+
+        Returns:
+        int: The index of the trial in the log.
+        """
+        if self._length == self.capacity:
+            self._grow()
+        index = self._length
+        columns = self._columns
+        columns['trial'][index] = trial
+        columns['block'][index] = block
+        columns['reaction_time'][index] = reaction_time
+        columns['accuracy'][index] = accuracy
+        columns['gate'][index] = int(gate)
+        columns['end_time'][index] = end_time
+        columns['rt_onset'][index] = rt_onset
+        columns['rt_offset'][index] = rt_offset
+        columns['stimulus'][index] = self._intern('stimulus', stimulus)
+        columns['response'][index] = self._intern('response', response)
+        columns['speaker'][index] = self._intern('speaker', speaker)
+        columns['name_stim'][index] = self._intern('name_stim', name_stim)
+        columns['condition'][index] = self._intern('condition', condition)
+        self._length += 1
+        return index
+
+    def view(self):
+        """
+        Return the columns of the appended trials without copying them.
+
+        The categorical columns hold codes; categories() returns their values. The arrays must not be modified, and
+        they are only valid until the next trial is appended beyond the capacity of the log.
+
+        Returns:
+        dict: Column name -> NumPy array.
+        """
+        return {name: column[:self._length] for name, column in self._columns.items()}
+
+    def categories(self, name):
+        """
+        Return the values of a categorical column, indexed by their code.
+
+        Parameters:
+        name (str): The column (see CATEGORICAL_COLUMNS).
+
+        Returns:
+        list of str: The values.
+        """
+        return list(self._categories[name])
+
+    def record(self, index):
+        """
+        Return the result of a trial as a row of the results file.
+
+        Parameters:
+        index (int): The index of the trial, as returned by append().
+
+        Returns:
+        dict: The result, with the columns of FIELDNAMES. Missing reaction times are empty.
+        """
+        if not 0 <= index < self._length:
+            raise IndexError(f"The trial log holds {self._length} trials, not {index + 1}.")
+        columns = self._columns
+        end_time = columns['end_time'][index].item()
+        row = dict(self._header_text)
+        row.update({
+            'trial': columns['trial'][index].item(),
+            'block': columns['block'][index].item(),
+            'accuracy': columns['accuracy'][index].item(),
+            'gate': columns['gate'][index].item(),
+            'end_time': _format_time(end_time),
+            'duration': _format_duration(end_time - self.header['start_time']),
+        })
+        for name in RT_COLUMNS:
+            value = columns[name][index].item()
+            row[name] = '' if np.isnan(value) else value
+        for name in CATEGORICAL_COLUMNS:
+            row[name] = self._categories[name][columns[name][index]]
+        return {field: row[field] for field in FIELDNAMES}
+
+    def records(self):
+        """
+        Yield the results of all trials as rows of the results file, one at a time.
+
+        Yields:
+        dict: The result of a trial.
+        """
+        for index in range(self._length):
+            yield self.record(index)
+
+    def to_csv(self, filename):
+        """
+        Export the log to a CSV file with the columns of the results files.
+
+        Parameters:
+        filename (str): The path of the CSV file.
+        """
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(self.records())
+
+    def to_parquet(self, filename):
+        """
+        Export the log to a Parquet file. The categorical columns are stored as dictionary-encoded columns and the
+        header entries as constant columns, so the file has the columns of the results files.
+
+        Parameters:
+        filename (str): The path of the Parquet file.
+
+        Raises:
+        ImportError: If pyarrow is not installed.
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Exporting the trial log to Parquet requires pyarrow ('pip install pyarrow').") from error
+
+        columns = self.view()
+        end_time = columns['end_time']
+        arrays = {field: pa.DictionaryArray.from_arrays(np.zeros(self._length, dtype=np.int32), [text])
+                  for field, text in self._header_text.items()}
+        arrays.update({name: pa.array(columns[name]) for name in ('trial', 'block', 'accuracy', 'gate')})
+        arrays.update({name: pa.array(columns[name], from_pandas=True) for name in RT_COLUMNS})  # NaN -> null
+        arrays.update({name: pa.DictionaryArray.from_arrays(columns[name], self._categories[name] or [''])
+                       for name in CATEGORICAL_COLUMNS})
+        arrays['end_time'] = pa.array([_format_time(value) for value in end_time.tolist()])
+        arrays['duration'] = pa.array([_format_duration(value - self.header['start_time'])
+                                       for value in end_time.tolist()])
+        pq.write_table(pa.table({field: arrays[field] for field in FIELDNAMES}), filename)
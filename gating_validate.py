@@ -0,0 +1,339 @@
+"""
+gating_validate.py
+
+This module validates the stimulus folders of the gating experiment and writes a cache of playback-ready copies of the
+stimuli.
+
+A malformed stimulus (a compressed or 32 bit float WAV file, a file without audio, a gate that is shorter than the gate
+before it) used to be noticed only when its trial came up, partway through a session. The validation reads every WAV
+file of the given folders in a process pool, one task per file, and checks:
+
+    - the WAV header: uncompressed PCM with 8, 16, 24 or 32 bit samples (error);
+    - the filename: the 'NN_C01_b1_tXX_name_cond_gN.wav' naming scheme (error);
+    - the audio: at least one frame (error), the sample rate against the playback sample rate and the channel count
+      against mono (warnings, the stimuli are converted before playback), and clipping, i.e. samples at full scale
+      (warning);
+    - the gates of every item: the duration has to increase with the gate, and every gate of presented_gates has to
+      exist (errors).
+
+With --cache, the stimuli are then converted to the playback sample rate, again in a process pool, and saved as
+float32 arrays in the stimulus cache ('stimuli/cache/', see stimulus_cache_path in gating_configuration.py). The
+cache files are named after the content hash of the WAV file, so a changed file gets a new cache entry and an
+unchanged file is not converted again. The experiment reads the stimuli from the cache (see CachedSource), so neither
+decoding nor resampling happens during a session.
+
+With --peak-level, the gates of every item are normalized to the given peak (e.g. 0.9). All gates of an item are
+scaled by the same factor, derived from the loudest gate, so the loudness doesn't change between the gates of an
+item. As the factor depends on every gate of the item, the names of normalized cache files also contain a hash of the
+contents of all gates of the item: if one gate changes, the cache files of all gates of the item are written again.
+The experiment only uses normalized cache files if stimulus_peak_level in gating_configuration.py is set to the same
+level.
+
+Usage:
+    python gating_validate.py stimuli/gated/test stimuli/gated/practice
+    python gating_validate.py stimuli/gated/test stimuli/gated/practice --cache --peak-level 0.9 --workers 4
+
+Functions:
+    - validate_stimuli: Validates the WAV files of a stimulus folder.
+    - item_hashes: Returns the combined content hash of the gates of every item.
+    - cache_filename: Returns the name of the cache file of a stimulus.
+    - write_cache: Writes the playback-ready copies of the stimuli of a folder to the stimulus cache.
+    - print_report: Prints the problems found by the validation.
+
+Classes:
+    - CachedSource: A stimulus source reading the playback-ready copies from the stimulus cache.
+"""
+
+import os
+import wave
+import hashlib
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from gating_audio import read_wav, resample
+from gating_manifest import parse_stimulus_filename
+
+ERROR = 'error'
+WARNING = 'warning'
+
+CLIPPING_LEVEL = 0.999
+PRESENTED_GATES = (2, 3, 4, 5, 7)
+
+
+def _validate_file(stimuli_path, stimulus_file, sample_rate):
+    """
+    Check the header and the audio of one WAV file. Runs in a worker process.
+
+    Returns:
+    dict: The filename, its content hash, item, gate, sample rate, channels, frames, duration and peak, and the list
+    of (severity, message) problems.
+    """
+    filepath = os.path.join(stimuli_path, stimulus_file)
+    report = {'filename': stimulus_file, 'content_hash': None, 'item': None, 'gate': None, 'sample_rate': None,
+              'channels': None, 'frames': 0, 'duration': 0.0, 'peak': 0.0, 'problems': []}
+    problems = report['problems']
+
+    try:
+        metadata = parse_stimulus_filename(stimulus_file)
+        report['item'], report['gate'] = metadata['item'], metadata['gate']
+    except ValueError as error:
+        problems.append((ERROR, str(error)))
+
+    with open(filepath, 'rb') as stimulus:
+        report['content_hash'] = hashlib.sha256(stimulus.read()).hexdigest()
+
+    try:
+        with wave.open(filepath, 'rb') as wav_file:
+            if wav_file.getcomptype() != 'NONE':
+                problems.append((ERROR, f"compressed WAV ({wav_file.getcompname()}), only PCM is supported"))
+                return report
+            report['sample_rate'] = wav_file.getframerate()
+            report['channels'] = wav_file.getnchannels()
+            report['frames'] = wav_file.getnframes()
+        samples, _ = read_wav(filepath)
+    except (wave.Error, EOFError, ValueError) as error:
+        problems.append((ERROR, f"unreadable WAV file: {error or 'the file is truncated'}"))
+        return report
+
+    if report['frames'] == 0:
+        problems.append((ERROR, "the file contains no audio"))
+        return report
+    report['duration'] = report['frames'] / report['sample_rate']
+    report['peak'] = float(np.abs(samples).max())
+
+    if report['sample_rate'] != sample_rate:
+        problems.append((WARNING, f"sample rate {report['sample_rate']} Hz instead of {sample_rate} Hz"))
+    if report['channels'] != 1:
+        problems.append((WARNING, f"{report['channels']} channels instead of mono"))
+    if report['peak'] >= CLIPPING_LEVEL:
+        clipped = int((np.abs(samples) >= CLIPPING_LEVEL).sum())
+        problems.append((WARNING, f"clipping: {clipped} samples at full scale"))
+    return report
+
+
+def _check_gates(reports, gates):
+    """Check that the gates of every item exist and that their durations increase with the gate."""
+    by_item = defaultdict(dict)
+    for report in reports:
+        if report['item'] is not None and report['frames']:
+            by_item[report['item']][report['gate']] = report
+
+    for item, item_gates in sorted(by_item.items()):
+        missing = sorted(set(gates) - set(item_gates))
+        if missing:
+            first = item_gates[min(item_gates)]
+            first['problems'].append((ERROR, f"gates {', '.join(map(str, missing))} of {item} are missing"))
+
+        ordered = [item_gates[gate] for gate in sorted(item_gates)]
+        for previous, report in zip(ordered, ordered[1:]):
+            if report['duration'] <= previous['duration']:
+                report['problems'].append((ERROR, f"gate {report['gate']} ({report['duration'] * 1000:.1f} ms) is "
+                                                  f"not longer than gate {previous['gate']} "
+                                                  f"({previous['duration'] * 1000:.1f} ms)"))
+
+
+def validate_stimuli(stimuli_path, sample_rate=44100, gates=PRESENTED_GATES, workers=None):
+    """
+    Validate the WAV files of a stimulus folder.
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus folder.
+    sample_rate (int, optional): The playback sample rate. Defaults to 44100.
+    gates (tuple, optional): The gates every item must have. Defaults to (2, 3, 4, 5, 7).
+    workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+    list of dict: One report per file, sorted by filename, with the list of (severity, message) problems.
+    """
+    stimuli_files = sorted(f for f in os.listdir(stimuli_path) if f.endswith('.wav'))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(_validate_file, [stimuli_path] * len(stimuli_files), stimuli_files,
+                                    [sample_rate] * len(stimuli_files)))
+    _check_gates(reports, gates)
+    return reports
+
+
+def item_hashes(files):
+    """
+    Return the combined content hash of the gates of every item.
+
+    Parameters:
+    files (iterable of tuple): The (item, content hash) of every file of a stimulus folder.
+
+    Returns:
+    dict: Item -> SHA-256 hex digest of the content hashes of all its gates.
+    """
+    by_item = defaultdict(list)
+    for item, content_hash in files:
+        by_item[item].append(content_hash)
+    return {item: hashlib.sha256('|'.join(sorted(hashes)).encode('ascii')).hexdigest()
+            for item, hashes in by_item.items()}
+
+
+def cache_filename(content_hash, sample_rate, peak_level=None, item_hash=None):
+    """
+    Return the name of the cache file of a stimulus.
+
+    Parameters:
+    content_hash (str): The SHA-256 hash of the WAV file.
+    sample_rate (int): The playback sample rate.
+    peak_level (float, optional): The peak level of the normalization, or None if not normalized.
+    item_hash (str, optional): The combined content hash of the gates of the item (see item_hashes()). Required if
+        peak_level is given, as the scale of a normalized file depends on all gates of its item.
+
+    Returns:
+    str: The filename, e.g. '3f2a..._44100.npy' or '3f2a..._44100_peak0.90_9c1e....npy'.
+    """
+    if peak_level is None:
+        return f"{content_hash}_{sample_rate}.npy"
+    if item_hash is None:
+        raise ValueError("The cache filename of a normalized stimulus needs the hash of its item.")
+    return f"{content_hash}_{sample_rate}_peak{peak_level:.2f}_{item_hash[:16]}.npy"
+
+
+def _write_cache_file(filepath, cache_filepath, sample_rate, scale):
+    """Convert one WAV file to the playback sample rate, scale it and save it to the cache. Runs in a worker process."""
+    samples, file_rate = read_wav(filepath)
+    samples = np.ascontiguousarray(resample(samples, file_rate, sample_rate) * scale, dtype=np.float32)
+    # Write to a temporary file first, so the experiment never reads a half-written cache file
+    with open(cache_filepath + '.tmp', 'wb') as cache_file:
+        np.save(cache_file, samples)
+    os.replace(cache_filepath + '.tmp', cache_filepath)
+
+
+def write_cache(stimuli_path, reports, cache_path, sample_rate=44100, peak_level=None, workers=None):
+    """
+    Write the playback-ready copies of the valid stimuli of a folder to the stimulus cache.
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus folder.
+    reports (list of dict): The reports of validate_stimuli() for the folder. Files with errors are not cached.
+    cache_path (str): The stimulus cache folder. It is created if it doesn't exist.
+    sample_rate (int, optional): The playback sample rate. Defaults to 44100.
+    peak_level (float, optional): Normalize the gates of every item to this peak. Defaults to None (not normalized).
+    workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+    int: The number of cache files written; files that are in the cache already are skipped.
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    valid = [report for report in reports if not any(severity == ERROR for severity, _ in report['problems'])]
+
+    # One scale per item, so the gates of an item keep their relative loudness
+    item_peaks = defaultdict(float)
+    for report in valid:
+        item_peaks[report['item']] = max(item_peaks[report['item']], report['peak'])
+    # The scale depends on all gates of the item, so a change to any of them gives all its files new cache files
+    hashes = item_hashes((report['item'], report['content_hash']) for report in reports if report['item'] is not None)
+
+    tasks = []
+    for report in valid:
+        cache_filepath = os.path.join(cache_path, cache_filename(report['content_hash'], sample_rate, peak_level,
+                                                                 hashes[report['item']]))
+        if os.path.exists(cache_filepath):
+            continue
+        scale = peak_level / item_peaks[report['item']] if peak_level is not None and item_peaks[report['item']] \
+            else 1.0
+        tasks.append((os.path.join(stimuli_path, report['filename']), cache_filepath, sample_rate, scale))
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_write_cache_file, *zip(*tasks)))
+    return len(tasks)
+
+
+def print_report(stimuli_path, reports):
+    """
+    Print the problems found by the validation of a stimulus folder. Errors are listed per file; identical warnings
+    (e.g. the same sample rate in all files) are listed once with the number of files.
+
+    Parameters:
+    stimuli_path (str): The path to the stimulus folder.
+    reports (list of dict): The reports of validate_stimuli().
+
+    Returns:
+    int: The number of errors.
+    """
+    errors = []
+    warnings = defaultdict(list)  # message -> filenames
+    for report in reports:
+        for severity, message in report['problems']:
+            if severity == ERROR:
+                errors.append((report['filename'], message))
+            else:
+                warnings[message].append(report['filename'])
+
+    print(f"{stimuli_path}: {len(reports)} files, {len(errors)} errors, "
+          f"{sum(len(filenames) for filenames in warnings.values())} warnings")
+    for stimulus_file, message in errors:
+        print(f"  {ERROR:<8}{stimulus_file}: {message}")
+    for message, filenames in warnings.items():
+        if len(filenames) == 1:
+            print(f"  {WARNING:<8}{filenames[0]}: {message}")
+        else:
+            print(f"  {WARNING:<8}{len(filenames)} files (e.g. {filenames[0]}): {message}")
+    return len(errors)
+
+
+class CachedSource:
+    """
+    A stimulus source reading the playback-ready copies of the stimuli from the stimulus cache.
+
+    Stimuli without a cache file are read from the underlying source; the stimulus bank then converts them to the
+    playback sample rate when they are loaded.
+
+    Parameters:
+    source (WavDirectory): The stimulus source of the stimulus folder.
+    manifest (StimulusManifest): The manifest of the folder, which holds the content hash of every file.
+    cache_path (str): The stimulus cache folder.
+    sample_rate (int): The playback sample rate.
+    peak_level (float, optional): The peak level of the normalized cache files to use. Defaults to None.
+    """
+
+    def __init__(self, source, manifest, cache_path, sample_rate, peak_level=None):
+        self.source = source
+        self.sample_rate = sample_rate
+        self.cache_files = {}  # filename -> path of its cache file
+        hashes = item_hashes((record.item, record.content_hash) for record in manifest)
+        for record in manifest:
+            cache_filepath = os.path.join(cache_path, cache_filename(record.content_hash, sample_rate, peak_level,
+                                                                     hashes[record.item]))
+            if os.path.exists(cache_filepath):
+                self.cache_files[record.filename] = cache_filepath
+        self.missing = sorted(set(manifest.filenames()) - set(self.cache_files))
+
+    def list_files(self):
+        """Return the filenames of all stimuli of the underlying source."""
+        return self.source.list_files()
+
+    def load(self, stimulus_file):
+        """Return the samples of a stimulus and their sample rate, from the cache if possible."""
+        cache_filepath = self.cache_files.get(stimulus_file)
+        if cache_filepath is None:
+            return self.source.load(stimulus_file)
+        return np.load(cache_filepath), self.sample_rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate the stimulus folders and cache playback-ready copies.')
+    parser.add_argument('stimuli_paths', nargs='+', help='stimulus folders to validate')
+    parser.add_argument('--sample-rate', type=int, default=44100, help='playback sample rate')
+    parser.add_argument('--gates', type=int, nargs='+', default=list(PRESENTED_GATES),
+                        help='gates every item must have')
+    parser.add_argument('--cache', action='store_true', help='write the playback-ready copies to the stimulus cache')
+    parser.add_argument('--cache-path', default=os.path.join('stimuli', 'cache'), help='stimulus cache folder')
+    parser.add_argument('--peak-level', type=float, default=None, help='normalize the gates of every item to this peak')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    total_errors = 0
+    for path in args.stimuli_paths:
+        folder_reports = validate_stimuli(path, args.sample_rate, args.gates, args.workers)
+        folder_errors = print_report(path, folder_reports)
+        total_errors += folder_errors
+        if args.cache:
+            written = write_cache(path, folder_reports, args.cache_path, args.sample_rate, args.peak_level,
+                                  args.workers)
+            print(f"  {written} files written to {args.cache_path} (files with errors are left out)")
+    raise SystemExit(1 if total_errors else 0)